@@ -1,171 +1,222 @@
+import asyncio
 import logging
 import json
 import httpx
-import random
-import base64
-from typing import List, Dict, Any, AsyncGenerator, Callable
+import time
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, AsyncGenerator, Callable, Optional
 from fastapi import HTTPException
-from function_calls import handle_function_calls, TOOLS
+from function_calls import run_function_call, TOOLS
 from multimodal_classes import *
 from chara_read import use_folder_chara
+from http_pool import http_pool
+from json_stream import JSONArrayStreamParser
+from tool_loop import ToolExecutor, ToolLoop
+from media_cache import get_media_cache
+from log_utils import LazyJSON, LazyText
+from key_pool import KeyPool, KeyPoolExhausted, RateLimitedError, get_key_pool, get_llm_key_pool, parse_retry_after
+from context_window import estimate_message
+from upload_store import get_upload_store
+from media_upload import GeminiResumableUpload, UploadError, UploadSource, get_upload_config, log_throughput, open_for_multipart
 
 # 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Gemini 文件上传 
-async def upload_to_gemini_media(file_content: bytes, mime_type: str, config, key) -> str:
-    url = f"{config.api['llm']['gemini']['base_url']}/upload/v1beta/files?key={key}"
-    headers = {
-        "Content-Type": mime_type,
-        "X-Goog-Upload-Protocol": "raw"
-    }
-    async with httpx.AsyncClient(timeout=100) as client:
-        response = await client.post(url, headers=headers, content=file_content)
-        if response.status_code != 200:
-            logger.error(f"文件上传失败: {response.text}")
-            raise HTTPException(status_code=response.status_code, detail=response.text)
-        data = response.json()
-        file_uri = data.get("file", {}).get("uri")
-        if not file_uri:
-            logger.error(f"未获取到 fileUri: {response.text}")
-            raise HTTPException(status_code=500, detail="文件上传成功但未返回 fileUri")
-        logger.info(f"文件上传成功，获取到 fileUri: {file_uri}")
-        return file_uri
-
-# OpenAI 文件上传
-async def upload_to_openai_media(file_content: bytes, mime_type: str, config, key) -> str:
+# Gemini 文件上传（可恢复分块上传）
+async def upload_to_gemini_media(file_content: UploadSource, mime_type: str, config, key, size: int = None) -> str:
+    """
+    :param file_content: bytes/memoryview、文件路径，或异步字节迭代器（此时需要 size）
+    """
+    base_url = config.api['llm']['gemini']['base_url']
+    client = http_pool.get_client(config, base_url, use_proxy=False)
+    uploader = GeminiResumableUpload(client, base_url, key, get_upload_config(config))
+    try:
+        file_info = await uploader.upload(file_content, mime_type, size=size,
+                                          display_name=f"upload.{mime_type.split('/')[-1]}")
+    except UploadError as e:
+        logger.error(f"文件上传失败: {e.detail}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    file_uri = file_info.get("uri")
+    if not file_uri:
+        logger.error("未获取到 fileUri: %s", LazyJSON(file_info))
+        raise HTTPException(status_code=500, detail="文件上传成功但未返回 fileUri")
+    logger.info(f"文件上传成功，获取到 fileUri: {file_uri}")
+    return file_uri
+
+# OpenAI 文件上传（multipart 按块读取文件对象）
+async def upload_to_openai_media(file_content: UploadSource, mime_type: str, config, key, size: int = None) -> str:
     url = f"{config.api['llm']['openai']['base_url']}/files"
     headers = {
         "Authorization": f"Bearer {key}",
     }
+    client = http_pool.get_client(config, config.api['llm']['openai']['base_url'])
+    fileobj = await open_for_multipart(file_content, size)
     files = {
-        "file": (f"file.{mime_type.split('/')[-1]}", file_content, mime_type),
+        "file": (f"file.{mime_type.split('/')[-1]}", fileobj, mime_type),
         "purpose": (None, "assistants")
     }
-    if config.api["proxy"]["http_proxy"]:
-        proxies = {"http://": config.api["proxy"]["http_proxy"], "https://": config.api["proxy"]["http_proxy"]}
-    else:
-        proxies = None
-    async with httpx.AsyncClient(timeout=100, proxies=proxies) as client:
+    started = time.perf_counter()
+    try:
+        response = await client.post(url, headers=headers, files=files, timeout=get_upload_config(config)["chunk_timeout"])
+        response.raise_for_status()
+        data = response.json()
+        file_id = data.get("id")
+        if not file_id:
+            logger.error(f"未获取到 file_id: {response.text}")
+            raise HTTPException(status_code=500, detail="文件上传成功但未返回 file_id")
+        log_throughput("OpenAI", fileobj.tell(), started)
+        logger.info(f"文件上传成功，获取到 file_id: {file_id}")
+        return file_id
+    except httpx.HTTPStatusError as e:
+        logger.error(f"文件上传失败: {e.response.text}")
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    finally:
+        fileobj.close()
+
+# 由消息中的 source 构造媒体对象：upload_id 指向 /upload 接收的临时文件，其余为 base64/bytes
+def media_from_source(media_cls, source: Dict[str, Any], config):
+    if "upload_id" in source:
         try:
-            response = await client.post(url, headers=headers, files=files)
-            response.raise_for_status()
-            data = response.json()
-            file_id = data.get("id")
-            if not file_id:
-                logger.error(f"未获取到 file_id: {response.text}")
-                raise HTTPException(status_code=500, detail="文件上传成功但未返回 file_id")
-            logger.info(f"文件上传成功，获取到 file_id: {file_id}")
-            return file_id
-        except httpx.HTTPStatusError as e:
-            logger.error(f"文件上传失败: {e.response.text}")
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+            meta = get_upload_store(config).resolve(source["upload_id"])
+        except UploadError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        media = media_cls(path=meta["path"])
+        media.source["mime_type"] = source.get("mime_type") or meta["mime_type"]
+        media.source["filename"] = meta["filename"]
+        return media
+    return media_cls(base64=source.get("base64"), byte=source.get("byte"), mime_type=source.get("mime_type"))
+
+# 附件并发处理：下载/上传互不等待，输出顺序与输入一致
+async def construct_concurrently(message_list: List[Dict[str, Any]], build: Callable, config) -> List[Dict[str, Any]]:
+    """
+    对每个消息项并发调用 build(item)，返回值为 None 的项被忽略。
+
+    :param build: 把单个消息项转换为提示元素的协程函数
+    """
+    semaphore = asyncio.Semaphore(max(int(get_upload_config(config)["max_concurrent_attachments"]), 1))
+    timings: List[tuple] = [None] * len(message_list)
+
+    async def run(index: int, item: Dict[str, Any]):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await build(item)
+            finally:
+                timings[index] = (item.get("type"), round((time.perf_counter() - started) * 1000, 1))
+
+    started = time.perf_counter()
+    tasks = [asyncio.ensure_future(run(index, item)) for index, item in enumerate(message_list)]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # 任一附件失败时取消其余仍在进行的下载/上传
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    if len(message_list) > 1 or any(item.get("type") != "text" for item in message_list):
+        logger.info(f"提示元素构造完成，总耗时 {(time.perf_counter() - started) * 1000:.1f}ms，"
+                    f"各项耗时(ms): {timings}")
+    return [result for result in results if result is not None]
+
+# Gemini 单个提示元素
+async def gemini_prompt_element(item: Dict[str, Any], config, key) -> Optional[Dict[str, Any]]:
+    if item["type"] == "text":
+        return {"text": item["content"]}
+    elif item["type"] == "image":
+        img = media_from_source(Image, item["source"], config)
+        return await img.to_dict()  # 只返回 inline 数据
+    elif item["type"] == "audio":
+        audio = media_from_source(Audio, item["source"], config)
+        blob = await audio.load()
+        #if blob.nbytes > 20 * 1024 * 1024:  # 示例阈值
+        file_uri = await get_media_cache(config).get_or_upload(
+            "gemini", key, await blob.aview(), lambda: upload_to_gemini_media(blob.path or blob.view(), audio.source["mime_type"], config, key))
+        return {"fileData": {"mimeType": audio.source["mime_type"], "fileUri": file_uri}}
+        #else:
+            #return await audio.to_dict()
+    elif item["type"] == "video":
+        video = media_from_source(Video, item["source"], config)
+        blob = await video.load()
+        #if blob.nbytes > 20 * 1024 * 1024:
+        file_uri = await get_media_cache(config).get_or_upload(
+            "gemini", key, await blob.aview(), lambda: upload_to_gemini_media(blob.path or blob.view(), video.source["mime_type"], config, key))
+        return {"fileData": {"mimeType": video.source["mime_type"], "fileUri": file_uri}}
+        #else:
+            #return await video.to_dict()
+    elif item["type"] == "file":
+        file = media_from_source(CustomFile, item["source"], config)
+        blob = await file.load()
+        # 只比较字节数，小文件不需要解码 base64
+        if blob.nbytes > 20 * 1024 * 1024:
+            file_uri = await get_media_cache(config).get_or_upload(
+                "gemini", key, await blob.aview(), lambda: upload_to_gemini_media(blob.path or blob.view(), file.source["mime_type"], config, key))
+            return {"fileData": {"mimeType": file.source["mime_type"], "fileUri": file_uri}}
+        else:
+            return await file.inline_dict()
+    return None
 
 # Gemini 提示元素构造
 async def gemini_prompt_elements_construct(message_list: List[Dict[str, Any]], config, key) -> List[Dict[str, Any]]:
-    logger.info(f"构造提示元素，输入消息列表: {json.dumps(message_list, indent=2)}")
-    prompt_elements = []
+    logger.debug("构造提示元素，输入消息列表: %s", LazyJSON(message_list))
+    prompt_elements = await construct_concurrently(
+        message_list, lambda item: gemini_prompt_element(item, config, key), config)
+    logger.debug("生成的提示元素: %s", LazyJSON(prompt_elements))
+    return prompt_elements
 
-    for item in message_list:
+# OpenAI 单个提示元素
+async def openai_prompt_element(item: Dict[str, Any], config, key, use_legacy_prompt: bool) -> Optional[Dict[str, Any]]:
+    if use_legacy_prompt:
         if item["type"] == "text":
-            prompt_elements.append({"text": item["content"]})
-        elif item["type"] == "image":
-            img = Image(base64=item["source"]["base64"] if "base64" in item["source"] else None,
-                        byte=item["source"]["byte"] if "byte" in item["source"] else None,
-                        mime_type=item["source"].get("mime_type"))
-            prompt_elements.append(await img.to_dict())  # 只返回 inline 数据
-        elif item["type"] == "audio":
-            audio = Audio(base64=item["source"]["base64"] if "base64" in item["source"] else None,
-                          byte=item["source"]["byte"] if "byte" in item["source"] else None,
-                          mime_type=item["source"].get("mime_type"))
-            base64_data = (await audio.to_dict())["inline_data"]["data"]
-            #if len(base64.b64decode(base64_data)) > 20 * 1024 * 1024:  # 示例阈值
-            file_uri = await upload_to_gemini_media(base64.b64decode(base64_data), audio.source["mime_type"], config, key)
-            prompt_elements.append({"fileData": {"mimeType": audio.source["mime_type"], "fileUri": file_uri}})
-            #else:
-                #prompt_elements.append(await audio.to_dict())
-        elif item["type"] == "video":
-            video = Video(base64=item["source"]["base64"] if "base64" in item["source"] else None,
-                          byte=item["source"]["byte"] if "byte" in item["source"] else None,
-                          mime_type=item["source"].get("mime_type"))
-            base64_data = (await video.to_dict())["inline_data"]["data"]
-            #if len(base64.b64decode(base64_data)) > 20 * 1024 * 1024:
-            file_uri = await upload_to_gemini_media(base64.b64decode(base64_data), video.source["mime_type"], config, key)
-            prompt_elements.append({"fileData": {"mimeType": video.source["mime_type"], "fileUri": file_uri}})
-            #else:
-                #prompt_elements.append(await video.to_dict())
-        elif item["type"] == "file":
-            file = CustomFile(base64=item["source"]["base64"] if "base64" in item["source"] else None,
-                              byte=item["source"]["byte"] if "byte" in item["source"] else None,
-                              mime_type=item["source"].get("mime_type"))
-            base64_data = (await file.to_dict())["inline_data"]["data"]
-            if len(base64.b64decode(base64_data)) > 20 * 1024 * 1024:
-                file_uri = await upload_to_gemini_media(base64.b64decode(base64_data), file.source["mime_type"], config, key)
-                prompt_elements.append({"fileData": {"mimeType": file.source["mime_type"], "fileUri": file_uri}})
-            else:
-                prompt_elements.append(await file.to_dict())
-
-    logger.info(f"生成的提示元素: {json.dumps(prompt_elements, indent=2)}")
-    return prompt_elements
+            return {"text": item["content"]}
+        elif item["type"] in ["image", "file"]:
+            logger.warning("使用旧版prompt结构，不支持多模态输入，忽略非文本内容")
+        return None
+
+    if item["type"] == "text":
+        return {"text": item["content"]}
+    elif item["type"] == "image":
+        img = media_from_source(Image, item["source"], config)
+        blob = await img.load()
+        return {
+            "image_url": {"url": f"data:{img.source['mime_type']};base64,{await blob.ab64()}"}
+        }
+    elif item["type"] == "audio":
+        audio = media_from_source(Audio, item["source"], config)
+        blob = await audio.load()
+        if blob.nbytes > 20 * 1024 * 1024:  # 示例阈值
+            file_uri = await get_media_cache(config).get_or_upload(
+                "openai", key, await blob.aview(), lambda: upload_to_openai_media(blob.path or blob.view(), audio.source["mime_type"], config, key))
+            return {"fileData": {"mimeType": audio.source["mime_type"], "fileUri": file_uri}}
+        else:
+            return {"text": f"data:{audio.source['mime_type']};base64,{await blob.ab64()}"}
+    elif item["type"] == "file":
+        file = media_from_source(CustomFile, item["source"], config)
+        blob = await file.load()
+        if blob.nbytes > 20 * 1024 * 1024:
+            file_id = await get_media_cache(config).get_or_upload(
+                "openai", key, await blob.aview(), lambda: upload_to_openai_media(blob.path or blob.view(), file.source["mime_type"], config, key))
+            return {"file_id": file_id}
+        else:
+            return {"text": f"data:{file.source['mime_type']};base64,{await blob.ab64()}"}
+    return None
 
 # OpenAI 提示元素构造
-async def openai_prompt_elements_construct(message_list: List[Dict[str, Any]], config) -> List[Dict[str, Any]]:
+async def openai_prompt_elements_construct(message_list: List[Dict[str, Any]], config, key) -> List[Dict[str, Any]]:
     use_legacy_prompt = config.api["llm"]["openai"].get("使用旧版prompt结构", False)
-    prompt_elements = []
-    
-    for item in message_list:
-        if use_legacy_prompt:
-            if item["type"] == "text":
-                prompt_elements.append({"text": item["content"]})
-            elif item["type"] in ["image", "file"]:
-                logger.warning("使用旧版prompt结构，不支持多模态输入，忽略非文本内容")
-        else:
-            if item["type"] == "text":
-                prompt_elements.append({"text": item["content"]})
-            elif item["type"] == "image":
-                img = Image(base64=item["source"]["base64"] if "base64" in item["source"] else None,
-                            byte=item["source"]["byte"] if "byte" in item["source"] else None,
-                            mime_type=item["source"].get("mime_type"))
-                base64_data = (await img.to_dict())["inline_data"]["data"]
-                prompt_elements.append({
-                    "image_url": {"url": f"data:{img.source['mime_type']};base64,{base64_data}"}
-                })
-            elif item["type"] == "audio":
-                audio = Audio(base64=item["source"]["base64"] if "base64" in item["source"] else None,
-                            byte=item["source"]["byte"] if "byte" in item["source"] else None,
-                            mime_type=item["source"].get("mime_type"))
-                base64_data = (await audio.to_dict())["inline_data"]["data"]
-                if len(base64.b64decode(base64_data)) > 20 * 1024 * 1024:  # 示例阈值
-                    file_uri = await upload_to_openai_media(base64.b64decode(base64_data), audio.source["mime_type"],config)
-                    prompt_elements.append({"fileData": {"mimeType": audio.source["mime_type"], "fileUri": file_uri}})
-                else:
-                    prompt_elements.append({"text": f"data:{audio.source['mime_type']};base64,{base64_data}"})
-            elif item["type"] == "file":
-                file = CustomFile(base64=item["source"]["base64"] if "base64" in item["source"] else None,
-                                  byte=item["source"]["byte"] if "byte" in item["source"] else None,
-                                  mime_type=item["source"].get("mime_type"))
-                base64_data = (await file.to_dict())["inline_data"]["data"]
-                if len(base64.b64decode(base64_data)) > 20 * 1024 * 1024:
-                    file_id = await upload_to_openai_media(base64.b64decode(base64_data), file.source["mime_type"], config)
-                    prompt_elements.append({"file_id": file_id})
-                else:
-                    prompt_elements.append({"text": f"data:{file.source['mime_type']};base64,{base64_data}"})
-    return prompt_elements
+    return await construct_concurrently(
+        message_list, lambda item: openai_prompt_element(item, config, key, use_legacy_prompt), config)
 
 # 统一的提示元素构造接口
 async def prompt_elements_construct(message_list: List[Dict[str, Any]], config, api_key) -> List[Dict[str, Any]]:
     model_type = config.api["llm"]["model"]
     if model_type == "openai":
-        return await openai_prompt_elements_construct(message_list, config)
+        return await openai_prompt_elements_construct(message_list, config, api_key)
     else:  # 默认 gemini
         return await gemini_prompt_elements_construct(message_list, config, api_key)
 
-# Gemini 非流式请求
-async def gemini_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key) -> str:
-    base_url = config.api["llm"]["gemini"]["base_url"]
-    model = config.api["llm"]["gemini"]["model"]
-    url = f"{base_url}/v1beta/models/{model}:generateContent?key={api_key}"
+# Gemini 请求体
+def gemini_payload(history: List[Dict[str, Any]], config, tools: bool = True) -> Dict[str, Any]:
     payload = {
         "contents": history,
         "systemInstruction": {"parts": [{"text": config.api["llm"]["system"] or ""}]},
@@ -183,72 +234,12 @@ async def gemini_request(history: List[Dict[str, Any]], config, client_id: str,
             "responseMimeType": "text/plain"
         }
     }
-    if config.api["llm"]["gemini"]["func_calling"]:
+    if tools and config.api["llm"]["gemini"]["func_calling"]:
         payload["tools"] = [{"function_declarations": TOOLS}]
-    
-    logger.info(f"发送非流式请求到: {url}")
-    logger.debug(f"请求内容: {json.dumps(payload, ensure_ascii=False, indent=2)}")
-
-    headers = {"Content-Type": "application/json"}
-    if config.api["proxy"]["http_proxy"]:
-        proxies = {"http://": config.api["proxy"]["http_proxy"], "https://": config.api["proxy"]["http_proxy"]}
-    else:
-        proxies = None
-    try:
-        async with httpx.AsyncClient(timeout=30, proxies=proxies) as client:
-            try:
-                response = await client.post(url, json=payload, headers=headers)
-                print(f"POST 返回内容: {response.text}")
-                response.raise_for_status()
-            except httpx.HTTPStatusError as e:
-                logger.error(f"非流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
-                raise
-            data = response.json()
-            
-            if "error" in data:
-                logger.error(f"API 返回错误: {data['error']['message']}")
-                raise HTTPException(status_code=400, detail=data["error"]["message"])
-            
-            candidate = data["candidates"][0]["content"]
-            parts = candidate.get("parts", [])
-            
-            if config.api["llm"]["gemini"]["func_calling"]:
-                function_calls = [part["functionCall"] for part in parts if "functionCall" in part]
-                if function_calls:
-                    history.append({
-                        "role": "model",
-                        "parts": [{"functionCall": fc} for fc in function_calls]
-                    })
-                    func_responses = await handle_function_calls(function_calls, config, client_id, send_message)
-                    history.append({
-                        "role": "function",
-                        "parts": func_responses
-                    })
-                    return await gemini_request(history, config, client_id, send_message, api_key)
-            
-            content = "".join(part["text"] for part in parts if "text" in part)
-            if content:
-                return content
-            else:
-                return "我会按你说的做。"
-    except httpx.RequestError as e:
-        logger.error(f"网络请求失败: {str(e)}")
-        raise HTTPException(status_code=503, detail=f"无法连接到 API: {str(e)}")
-    except httpx.HTTPStatusError as e:
-        logger.error(f"API 返回状态错误: {e.response.text}")
-        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    return payload
 
-# OpenAI 非流式请求
-async def openai_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable) -> str:
-    base_url = config.api["llm"]["openai"]["base_url"]
-    api_key = random.choice(config.api["llm"]["openai"]["api_keys"])
-    model = config.api["llm"]["openai"]["model"]
-    url = f"{base_url}/chat/completions"
-    if config.api["proxy"]["http_proxy"]:
-        proxies = {"http://": config.api["proxy"]["http_proxy"], "https://": config.api["proxy"]["http_proxy"]}
-    else:
-        proxies = None
-    
+# OpenAI 消息列表
+def openai_messages(history: List[Dict[str, Any]], config) -> List[Dict[str, Any]]:
     use_legacy_prompt = config.api["llm"]["openai"].get("使用旧版prompt结构", False)
     messages = []
     for msg in history:
@@ -286,337 +277,475 @@ async def openai_request(history: List[Dict[str, Any]], config, client_id: str,
                         }
                     })
             messages.append({"role": msg["role"], "content": content if content else None})
+    return messages
 
+# OpenAI 请求体
+def openai_payload(history: List[Dict[str, Any]], config, stream: bool = False, tools: bool = True) -> Dict[str, Any]:
     payload = {
-        "model": model,
-        "messages": messages,
+        "model": config.api["llm"]["openai"]["model"],
+        "messages": openai_messages(history, config),
         "temperature": config.api["llm"]["openai"]["temperature"],
         "max_tokens": config.api["llm"]["openai"]["maxOutputTokens"],
         "top_p": 0.95,
     }
-    if config.api["llm"]["openai"]["func_calling"]:
+    if stream:
+        payload["stream"] = True
+    if tools and config.api["llm"]["openai"]["func_calling"]:
         payload["tools"] = [{"type": "function", "function": tool} for tool in TOOLS]
         payload["tool_choice"] = "auto"
-    
-    logger.info(f"发送非流式请求到: {url}")
-    print(f"请求内容: {json.dumps(payload, ensure_ascii=False, indent=2)}")
+    return payload
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    async with httpx.AsyncClient(timeout=30, proxies=proxies) as client:
+# 函数调用预算用完后，后续请求禁止模型再调用函数，直接给出回答
+def disable_tools(payload: Dict[str, Any], model_type: str):
+    logger.warning("函数调用轮数或时间已达上限，本次回复不再调用函数")
+    if model_type == "openai":
+        payload["tool_choice"] = "none"
+    else:
+        payload["toolConfig"] = {"functionCallingConfig": {"mode": "NONE"}}
+
+def tool_executor(config, client_id: str, send_message: Callable, round_stats) -> ToolExecutor:
+    return ToolExecutor(lambda function_call: run_function_call(function_call, config, client_id, send_message), round_stats)
+
+def estimate_history_tokens(history: List[Dict[str, Any]]) -> int:
+    return sum(estimate_message(message)[0] for message in history)
+
+# 发送请求；429 转换为 RateLimitedError，由 key 池冷却该 key 并换一个 key 重试
+async def send_checked(client: httpx.AsyncClient, request: httpx.Request, stream: bool = False) -> httpx.Response:
+    response = await client.send(request, stream=stream)
+    if response.status_code == 429:
+        body = (await response.aread()).decode("utf-8", errors="replace")
+        await response.aclose()
+        logger.warning(f"请求被限流 (429): {LazyText(body)}")
+        raise RateLimitedError(parse_retry_after(response.headers, body), body[:500])
+    return response
+
+@asynccontextmanager
+async def open_stream(client: httpx.AsyncClient, pool: KeyPool, build: Callable[[str], httpx.Request],
+                      session_id: Optional[str], api_key: Optional[str], tokens: int):
+    """由 key 池选择 key 发起流式请求，返回的响应在退出时关闭；读完正文之前 key 一直计为进行中"""
+    async with pool.lease(lambda key: send_checked(client, build(key), stream=True), session_id, api_key, tokens) as response:
         try:
-            response = await client.post(url, json=payload, headers=headers)
-            logger.info(f"POST 返回内容: {response.text}")
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"非流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
-            raise
-        data = response.json()
-        
-        if "choices" not in data or not data["choices"]:
-            logger.error(f"API 返回无有效响应: {data}")
-            raise HTTPException(status_code=500, detail="API 返回无有效响应")
-        
-        choice = data["choices"][0]
-        if "message" in choice:
+            yield response
+        finally:
+            await response.aclose()
+
+# Gemini 非流式请求
+async def gemini_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key,
+                         session_id: Optional[str] = None) -> str:
+    base_url = config.api["llm"]["gemini"]["base_url"]
+    model = config.api["llm"]["gemini"]["model"]
+    url = f"{base_url}/v1beta/models/{model}:generateContent"
+    payload = gemini_payload(history, config)  # contents 引用 history，函数调用结果追加后无需重建
+    func_calling = config.api["llm"]["gemini"]["func_calling"]
+    logger.info(f"发送非流式请求到: {url}")
+
+    headers = {"Content-Type": "application/json"}
+    client = http_pool.get_client(config, base_url)
+    pool = get_key_pool(config, "gemini")
+    tool_loop = ToolLoop.from_config(config, client_id)
+    tools_disabled = False
+    try:
+        while True:
+            logger.debug("请求内容: %s", LazyJSON(payload))
+            round_stats = tool_loop.begin_round()
+            try:
+                response = await pool.call(
+                    lambda key: send_checked(client, client.build_request("POST", url, params={"key": key}, json=payload, headers=headers)),
+                    session_id, api_key, estimate_history_tokens(history))
+                round_stats.response_done()
+                logger.debug("POST 返回内容: %s", LazyText(response.text))
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                logger.error(f"非流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
+                raise
+            data = response.json()
+
+            if "error" in data:
+                logger.error(f"API 返回错误: {data['error']['message']}")
+                raise HTTPException(status_code=400, detail=data["error"]["message"])
+
+            candidate = data["candidates"][0]["content"]
+            parts = candidate.get("parts", [])
+
+            function_calls = [part["functionCall"] for part in parts if "functionCall" in part]
+            if func_calling and function_calls and not tools_disabled:
+                executor = tool_executor(config, client_id, send_message, round_stats)
+                for function_call in function_calls:
+                    executor.start(function_call)
+                history.append({
+                    "role": "model",
+                    "parts": [{"functionCall": fc} for fc in function_calls]
+                })
+                history.append({
+                    "role": "function",
+                    "parts": await executor.results()
+                })
+                if tool_loop.exhausted():
+                    tools_disabled = True
+                    disable_tools(payload, "gemini")
+                continue
+
+            content = "".join(part["text"] for part in parts if "text" in part)
+            if content:
+                return content
+            else:
+                return "我会按你说的做。"
+    except httpx.RequestError as e:
+        logger.error(f"网络请求失败: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"无法连接到 API: {str(e)}")
+    except httpx.HTTPStatusError as e:
+        logger.error(f"API 返回状态错误: {e.response.text}")
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except KeyPoolExhausted as e:
+        logger.error(str(e))
+        raise HTTPException(status_code=429, detail=str(e))
+    finally:
+        tool_loop.finish()
+
+# OpenAI 非流式请求
+async def openai_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key=None,
+                         session_id: Optional[str] = None) -> str:
+    base_url = config.api["llm"]["openai"]["base_url"]
+    url = f"{base_url}/chat/completions"
+    payload = openai_payload(history, config)
+    logger.info(f"发送非流式请求到: {url}")
+
+    headers = {"Content-Type": "application/json"}
+    client = http_pool.get_client(config, base_url)
+    pool = get_key_pool(config, "openai")
+    tool_loop = ToolLoop.from_config(config, client_id)
+    tools_disabled = False
+    try:
+        while True:
+            logger.debug("请求内容: %s", LazyJSON(payload))
+            round_stats = tool_loop.begin_round()
+            try:
+                response = await pool.call(
+                    lambda key: send_checked(client, client.build_request(
+                        "POST", url, json=payload, headers={**headers, "Authorization": f"Bearer {key}"})),
+                    session_id, api_key, estimate_history_tokens(history))
+                round_stats.response_done()
+                logger.debug("POST 返回内容: %s", LazyText(response.text))
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                logger.error(f"非流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
+                raise
+            except KeyPoolExhausted as e:
+                logger.error(str(e))
+                raise HTTPException(status_code=429, detail=str(e))
+            data = response.json()
+
+            if "choices" not in data or not data["choices"]:
+                logger.error("API 返回无有效响应: %s", LazyJSON(data))
+                raise HTTPException(status_code=500, detail="API 返回无有效响应")
+
+            choice = data["choices"][0]
+            if "message" not in choice:
+                return "错误，请清除记录"
             message = choice["message"]
-            if message.get("tool_calls"):
-                tool_calls = message["tool_calls"]
+            if message.get("tool_calls") and not tools_disabled:
+                function_calls = [{"name": call["function"]["name"], "args": json.loads(call["function"]["arguments"])}
+                                  for call in message["tool_calls"]]
+                executor = tool_executor(config, client_id, send_message, round_stats)
+                for function_call in function_calls:
+                    executor.start(function_call)
                 history.append({
                     "role": "assistant",
-                    "parts": [{"functionCall": {"name": call["function"]["name"], "args": json.loads(call["function"]["arguments"])}} for call in tool_calls]
+                    "parts": [{"functionCall": fc} for fc in function_calls]
                 })
-                func_responses = await handle_function_calls([{"name": call["function"]["name"], "args": json.loads(call["function"]["arguments"])} for call in tool_calls], config, client_id, send_message)
                 history.append({
                     "role": "function",
-                    "parts": func_responses
+                    "parts": await executor.results()
                 })
-                return await openai_request(history, config, client_id, send_message)
+                payload["messages"] = openai_messages(history, config)
+                if tool_loop.exhausted():
+                    tools_disabled = True
+                    disable_tools(payload, "openai")
+                continue
             content = message["content"]
             if config.api["llm"]["openai"]["COT"]:
                 content = template.replace("{{reasoning_content}}",message["reasoning_content"]) + content
             return content if content else "我会按你说的做"
-        return "错误，请清除记录"
+    finally:
+        tool_loop.finish()
 
 # 统一的非流式请求接口
-async def request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key) -> str:
+async def request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key,
+                  session_id: Optional[str] = None) -> str:
     model_type = config.api["llm"]["model"]
     if model_type == "openai":
-        return await openai_request(history, config, client_id, send_message)
+        return await openai_request(history, config, client_id, send_message, api_key, session_id)
     else:  # 默认 gemini
-        return await gemini_request(history, config, client_id, send_message, api_key)
+        return await gemini_request(history, config, client_id, send_message, api_key, session_id)
+
+# 摘要请求：单次非流式调用，不带函数声明也不进入函数调用循环，模型只能返回文本
+async def summary_request(prompt: str, config, api_key) -> str:
+    model_type = config.api["llm"]["model"]
+    history = [{"role": "user", "parts": [{"text": prompt}]}]
+    headers = {"Content-Type": "application/json"}
+    if model_type == "openai":
+        base_url = config.api["llm"]["openai"]["base_url"]
+        url = f"{base_url}/chat/completions"
+        payload = openai_payload(history, config, tools=False)
+        build = lambda key: client.build_request("POST", url, json=payload, headers={**headers, "Authorization": f"Bearer {key}"})
+    else:
+        base_url = config.api["llm"]["gemini"]["base_url"]
+        url = f"{base_url}/v1beta/models/{config.api['llm']['gemini']['model']}:generateContent"
+        payload = gemini_payload(history, config, tools=False)
+        build = lambda key: client.build_request("POST", url, params={"key": key}, json=payload, headers=headers)
+    client = http_pool.get_client(config, base_url)
+    pool = get_llm_key_pool(config)
+    logger.info(f"发送摘要请求到: {url}")
+    try:
+        response = await pool.call(lambda key: send_checked(client, build(key)), None, api_key,
+                                   estimate_history_tokens(history))
+        logger.debug("摘要请求返回内容: %s", LazyText(response.text))
+        response.raise_for_status()
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=503, detail=f"无法连接到 API: {str(e)}")
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except KeyPoolExhausted as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    data = response.json()
+    if model_type == "openai":
+        choices = data.get("choices") or [{}]
+        content = (choices[0].get("message") or {}).get("content") or ""
+    else:
+        candidates = data.get("candidates") or [{}]
+        parts = (candidates[0].get("content") or {}).get("parts", [])
+        content = "".join(part["text"] for part in parts if "text" in part)
+    if not content.strip():
+        raise HTTPException(status_code=500, detail="摘要请求未返回文本")
+    return content.strip()
 
 # Gemini 流式请求
-async def gemini_stream_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, conversation_history: Dict[str, List[Dict[str, Any]]], api_key) -> AsyncGenerator[str, None]:
+async def gemini_stream_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key,
+                                session_id: Optional[str] = None) -> AsyncGenerator[str, None]:
     base_url = config.api["llm"]["gemini"]["base_url"]
     model = config.api["llm"]["gemini"]["model"]
-    url = f"{base_url}/v1beta/models/{model}:streamGenerateContent?key={api_key}"
-    if config.api["proxy"]["http_proxy"]:
-        proxies = {"http://": config.api["proxy"]["http_proxy"], "https://": config.api["proxy"]["http_proxy"]}
-    else:
-        proxies = None
-    payload = {
-        "contents": history,
-        "systemInstruction": {"parts": [{"text": config.api["llm"]["system"] or ""}]},
-        "safetySettings": [
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
-        ],
-        "generationConfig": {
-            "temperature": config.api["llm"]["gemini"]["temperature"],
-            "topK": 40,
-            "topP": 0.95,
-            "maxOutputTokens": config.api["llm"]["gemini"]["maxOutputTokens"],
-            "responseMimeType": "text/plain"
-        }
-    }
-    if config.api["llm"]["gemini"]["func_calling"]:
-        payload["tools"] = [{"function_declarations": TOOLS}]
-    
+    url = f"{base_url}/v1beta/models/{model}:streamGenerateContent"
+    payload = gemini_payload(history, config)
+    func_calling = config.api["llm"]["gemini"]["func_calling"]
     logger.info(f"发送流式请求到: {url}")
-    logger.debug(f"请求内容: {json.dumps(payload, ensure_ascii=False, indent=2)}")
 
     headers = {"Content-Type": "application/json"}
 
     async def generate() -> AsyncGenerator[str, None]:
-        full_content = ""
-        json_buffer = ""
-        function_calls = []
-        has_finished = False
-
-        async with httpx.AsyncClient(timeout=30,proxies=proxies) as client:
-            async with client.stream("POST", url, json=payload, headers=headers) as response:
-                try:
-                    response.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    logger.error(f"流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
-                    yield f"data: {json.dumps({'content': f'流式请求失败: {e.response.status_code} - {e.response.text}', 'start_stream': False, 'end_stream': True})}\n\n"
-                    return
-
-                yield f"data: {json.dumps({'content': '', 'start_stream': True, 'end_stream': False})}\n\n"
-                async for chunk in response.aiter_text():
-                    logger.info(f"流式响应原始数据块: {chunk}")
-                    cleaned_chunk = chunk.strip()
-                    if cleaned_chunk == ']':
-                        logger.info("收到流式响应结束标志 ']'")
-                        break
-                    if cleaned_chunk.startswith('[') and not json_buffer:
-                        cleaned_chunk = cleaned_chunk[1:]
-                    elif cleaned_chunk.startswith(','):
-                        cleaned_chunk = cleaned_chunk[1:]
-                    
-                    json_buffer += cleaned_chunk
+        client = http_pool.get_client(config, base_url)
+        pool = get_key_pool(config, "gemini")
+        tool_loop = ToolLoop.from_config(config, client_id)
+        tools_disabled = False
+        executor = None
+        yield f"data: {json.dumps({'content': '', 'start_stream': True, 'end_stream': False})}\n\n"
+        try:
+            while True:
+                logger.debug("请求内容: %s", LazyJSON(payload))
+                round_stats = tool_loop.begin_round()
+                executor = tool_executor(config, client_id, send_message, round_stats)
+                round_content = ""
+                parser = JSONArrayStreamParser()
+                async with open_stream(client, pool, lambda key: client.build_request("POST", url, params={"key": key}, json=payload, headers=headers),
+                                       session_id, api_key, estimate_history_tokens(history)) as response:
                     try:
-                        data = json.loads(json_buffer)
-                        json_buffer = ""
-                        logger.debug(f"解析后的数据块: {json.dumps(data, ensure_ascii=False, indent=2)}")
-                        
-                        # 解析并发送当前块的内容
-                        parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
-                        for part in parts:
-                            if "text" in part:
-                                content = part["text"]
-                                full_content += content
-                                logger.info(f"解析结果 - 当前块内容: {content}")
-                                yield f"data: {json.dumps({'content': content, 'start_stream': False, 'end_stream': False})}\n\n"
-                            elif "functionCall" in part and config.api["llm"]["gemini"]["func_calling"]:
-                                function_calls.append(part["functionCall"])
-
-                        # 检查是否结束，但不退出循环
-                        if "finishReason" in data.get("candidates", [{}])[0] and data["candidates"][0]["finishReason"] == "STOP":
-                            has_finished = True
-
-                        # 处理函数调用
-                        if function_calls:
-                            history.append({
-                                "role": "model",
-                                "parts": [{"functionCall": fc} for fc in function_calls]
-                            })
-                            func_responses = await handle_function_calls(function_calls, config, client_id, send_message)
-                            history.append({
-                                "role": "function",
-                                "parts": func_responses
-                            })
-                            async for sub_chunk in await gemini_stream_request(history, config, client_id, send_message, conversation_history, api_key):
-                                yield sub_chunk
-                            return
-
-                    except json.JSONDecodeError:
-                        logger.debug("JSON 未完整，继续缓冲")
-                        continue
-
-                # 所有块解析完成后发送结束标志
-                if full_content:
-                    conversation_history.setdefault("default_user", []).append({
-                        "role": "model",
-                        "parts": [{"text": full_content}]
-                    })
-                    logger.info(f"流式响应总内容: {full_content}")
-                yield f"data: {json.dumps({'content': '', 'start_stream': False, 'end_stream': True})}\n\n"
-                logger.info("流式响应结束")
+                        response.raise_for_status()
+                    except httpx.HTTPStatusError as e:
+                        await e.response.aread()
+                        logger.error(f"流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
+                        yield f"data: {json.dumps({'content': f'流式请求失败: {e.response.status_code} - {e.response.text}', 'start_stream': False, 'end_stream': True})}\n\n"
+                        return
+
+                    async for chunk in response.aiter_text():
+                        round_stats.first_byte()
+                        logger.debug("流式响应原始数据块: %s", LazyText(chunk))
+                        for data in parser.feed(chunk):
+                            logger.debug("解析后的数据块: %s", LazyJSON(data))
+
+                            # 解析并发送当前块的内容；函数调用一解析出来就开始执行，不等响应结束
+                            parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+                            for part in parts:
+                                if "text" in part:
+                                    content = part["text"]
+                                    round_content += content
+                                    logger.debug("解析结果 - 当前块内容: %s", content)
+                                    yield f"data: {json.dumps({'content': content, 'start_stream': False, 'end_stream': False})}\n\n"
+                                elif "functionCall" in part and func_calling and not tools_disabled:
+                                    executor.start(part["functionCall"])
+
+                    if parser.pending:
+                        logger.warning("流式响应结束时仍有未闭合的 JSON 对象")
+                round_stats.response_done()
+
+                if not executor:
+                    break
+                model_parts = [{"text": round_content}] if round_content else []
+                model_parts.extend({"functionCall": fc} for fc in executor.calls)
+                history.append({"role": "model", "parts": model_parts})
+                history.append({"role": "function", "parts": await executor.results()})
+                if tool_loop.exhausted():
+                    tools_disabled = True
+                    disable_tools(payload, "gemini")
+
+            # 所有块解析完成后发送结束标志
+            if round_content:
+                history.append({
+                    "role": "model",
+                    "parts": [{"text": round_content}]
+                })
+                logger.debug("流式响应总内容: %s", LazyText(round_content))
+            yield f"data: {json.dumps({'content': '', 'start_stream': False, 'end_stream': True})}\n\n"
+            logger.info("流式响应结束")
+        except KeyPoolExhausted as e:
+            logger.error(str(e))
+            yield f"data: {json.dumps({'content': f'流式请求失败: {e}', 'start_stream': False, 'end_stream': True})}\n\n"
+        finally:
+            if executor is not None:
+                await executor.cancel()
+            tool_loop.finish()
 
     return generate()
 
+# OpenAI 流式函数调用参数分多个 delta 到达，按 index 拼接
+class OpenAIToolCallAssembler:
+    def __init__(self, executor: ToolExecutor):
+        self.executor = executor
+        self._calls: Dict[int, Dict[str, str]] = {}
+        self._started = set()
+
+    def feed(self, tool_calls: List[Dict[str, Any]]):
+        for tool_call in tool_calls:
+            index = tool_call.get("index", len(self._calls))
+            entry = self._calls.setdefault(index, {"name": "", "arguments": ""})
+            function = tool_call.get("function") or {}
+            if function.get("name"):
+                entry["name"] = function["name"]
+            entry["arguments"] += function.get("arguments") or ""
+            # 出现下一个调用时，前面的调用参数已经完整，可以提前执行
+            self._start(lambda i: i < index)
+
+    def flush(self):
+        self._start(lambda i: True)
+
+    def _start(self, ready: Callable[[int], bool]):
+        for index in sorted(self._calls):
+            if index in self._started or not ready(index):
+                continue
+            self._started.add(index)
+            entry = self._calls[index]
+            try:
+                args = json.loads(entry["arguments"]) if entry["arguments"] else {}
+            except json.JSONDecodeError:
+                logger.warning(f"函数 {entry['name']} 的参数不是合法 JSON: {entry['arguments']}")
+                args = {}
+            self.executor.start({"name": entry["name"], "args": args})
+
 # OpenAI 流式请求
-async def openai_stream_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, conversation_history: Dict[str, List[Dict[str, Any]]]) -> AsyncGenerator[str, None]:
+async def openai_stream_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key=None,
+                                session_id: Optional[str] = None) -> AsyncGenerator[str, None]:
     base_url = config.api["llm"]["openai"]["base_url"]
-    api_key = random.choice(config.api["llm"]["openai"]["api_keys"])
-    model = config.api["llm"]["openai"]["model"]
     url = f"{base_url}/chat/completions"
-    if config.api["proxy"]["http_proxy"]:
-        proxies = {"http://": config.api["proxy"]["http_proxy"], "https://": config.api["proxy"]["http_proxy"]}
-    else:
-        proxies = None
-    
-    use_legacy_prompt = config.api["llm"]["openai"].get("使用旧版prompt结构", False)
-    messages = []
-    for msg in history:
-        if use_legacy_prompt:
-            text_content = "".join(part["text"] for part in msg["parts"] if "text" in part)
-            if text_content:
-                messages.append({"role": msg["role"], "content": text_content})
-            elif "functionCall" in msg["parts"][0]:
-                messages.append({
-                    "role": msg["role"],
-                    "content": None,
-                    "tool_calls": [{
-                        "type": "function",
-                        "function": {
-                            "name": msg["parts"][0]["functionCall"]["name"],
-                            "arguments": json.dumps(msg["parts"][0]["functionCall"]["args"])
-                        }
-                    }]
-                })
-        else:
-            content = []
-            for part in msg["parts"]:
-                if "text" in part:
-                    content.append({"type": "text", "text": part["text"]})
-                elif "image_url" in part:
-                    content.append({"type": "image_url", "image_url": part["image_url"]})
-                elif "file_id" in part:
-                    content.append({"type": "text", "text": f"File ID: {part['file_id']}"})
-                elif "functionCall" in part:
-                    content.append({
-                        "type": "function_call",
-                        "function_call": {
-                            "name": part["functionCall"]["name"],
-                            "arguments": json.dumps(part["functionCall"]["args"])
-                        }
-                    })
-            messages.append({"role": msg["role"], "content": content if content else None})
-    
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": config.api["llm"]["openai"]["temperature"],
-        "max_tokens": config.api["llm"]["openai"]["maxOutputTokens"],
-        "top_p": 0.95,
-        "stream": True
-    }
-    if config.api["llm"]["openai"]["func_calling"]:
-        payload["tools"] = [{"type": "function", "function": tool} for tool in TOOLS]
-        payload["tool_choice"] = "auto"
-    
+    payload = openai_payload(history, config, stream=True)
+    func_calling = config.api["llm"]["openai"]["func_calling"]
     logger.info(f"发送流式请求到: {url}")
-    logger.debug(f"请求内容: {json.dumps(payload, ensure_ascii=False, indent=2)}")
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    headers = {"Content-Type": "application/json"}
 
     async def generate() -> AsyncGenerator[str, None]:
-        full_content = ""
-        is_first_chunk = True
-        function_calls = []
-
-        async with httpx.AsyncClient(timeout=30,proxies=proxies) as client:
-            async with client.stream("POST", url, json=payload, headers=headers) as response:
-                try:
-                    response.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    logger.error(f"流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
-                    yield f"data: {json.dumps({'content': f'流式请求失败: {e.response.status_code} - {e.response.text}', 'start_stream': False, 'end_stream': True})}\n\n"
-                    return
-
-                yield f"data: {json.dumps({'content': '', 'start_stream': True, 'end_stream': False})}\n\n"
-                async for chunk in response.aiter_lines():
-                    if not chunk.strip():
-                        continue
-                    logger.info(f"流式响应原始数据块: {chunk}")
-                    cleaned_chunk = chunk.strip()
-
-                    if cleaned_chunk.startswith('data: '):
+        client = http_pool.get_client(config, base_url)
+        pool = get_key_pool(config, "openai")
+        tool_loop = ToolLoop.from_config(config, client_id)
+        tools_disabled = False
+        executor = None
+        yield f"data: {json.dumps({'content': '', 'start_stream': True, 'end_stream': False})}\n\n"
+        try:
+            while True:
+                logger.debug("请求内容: %s", LazyJSON(payload))
+                round_stats = tool_loop.begin_round()
+                executor = tool_executor(config, client_id, send_message, round_stats)
+                assembler = OpenAIToolCallAssembler(executor)
+                round_content = ""
+                async with open_stream(client, pool, lambda key: client.build_request(
+                        "POST", url, json=payload, headers={**headers, "Authorization": f"Bearer {key}"}),
+                        session_id, api_key, estimate_history_tokens(history)) as response:
+                    try:
+                        response.raise_for_status()
+                    except httpx.HTTPStatusError as e:
+                        await e.response.aread()
+                        logger.error(f"流式请求失败，状态码: {e.response.status_code}, 响应内容: {e.response.text}")
+                        yield f"data: {json.dumps({'content': f'流式请求失败: {e.response.status_code} - {e.response.text}', 'start_stream': False, 'end_stream': True})}\n\n"
+                        return
+
+                    async for chunk in response.aiter_lines():
+                        round_stats.first_byte()
+                        if not chunk.strip():
+                            continue
+                        logger.debug("流式响应原始数据块: %s", LazyText(chunk))
+                        cleaned_chunk = chunk.strip()
+                        if not cleaned_chunk.startswith('data: '):
+                            continue
                         data_str = cleaned_chunk[len('data: '):]
                         if data_str == '[DONE]':
-                            if full_content:
-                                conversation_history.setdefault("default_user", []).append({
-                                    "role": "assistant",
-                                    "parts": [{"text": full_content}]
-                                })
-                                logger.info(f"流式响应总内容已写入历史: {full_content}")
-                            yield f"data: {json.dumps({'content': '', 'start_stream': False, 'end_stream': True})}\n\n"
-                            logger.info("流式响应结束")
-                            return
+                            break
 
                         try:
                             data = json.loads(data_str)
-                            delta = data.get("choices", [{}])[0].get("delta", {})
-                            if "content" in delta and delta["content"]:
-                                content = delta["content"]
-                                full_content += content
-                                logger.info(f"解析结果 - 当前块内容: {content}")
-                                yield f"data: {json.dumps({'content': content, 'start_stream': False, 'end_stream': False})}\n\n"
-                            elif "tool_calls" in delta:
-                                tool_calls = delta.get("tool_calls", [])
-                                for tool_call in tool_calls:
-                                    if "function" in tool_call:
-                                        function_calls.append({
-                                            "name": tool_call["function"]["name"],
-                                            "args": json.loads(tool_call["function"]["arguments"])
-                                        })
-
-                            if data.get("choices", [{}])[0].get("finish_reason") == "tool_calls" and function_calls:
-                                history.append({
-                                    "role": "assistant",
-                                    "parts": [{"functionCall": {"name": fc["name"], "args": fc["args"]}} for fc in function_calls]
-                                })
-                                func_responses = await handle_function_calls(function_calls, config, client_id, send_message)
-                                history.append({
-                                    "role": "function",
-                                    "parts": func_responses
-                                })
-                                async for sub_chunk in openai_stream_request(history, config, client_id, send_message, conversation_history):
-                                    yield sub_chunk
-                                return
-
                         except json.JSONDecodeError:
                             logger.debug("JSON 未完整，继续缓冲")
-
-                # 所有块解析完成后发送结束标志
-                if full_content:
-                    conversation_history.setdefault("default_user", []).append({
-                        "role": "assistant",
-                        "parts": [{"text": full_content}]
-                    })
-                    logger.info(f"流式响应总内容: {full_content}")
-                yield f"data: {json.dumps({'content': '', 'start_stream': False, 'end_stream': True})}\n\n"
-                logger.info("流式响应结束")
+                            continue
+                        choice = data.get("choices", [{}])[0]
+                        delta = choice.get("delta", {})
+                        if "content" in delta and delta["content"]:
+                            content = delta["content"]
+                            round_content += content
+                            logger.debug("解析结果 - 当前块内容: %s", content)
+                            yield f"data: {json.dumps({'content': content, 'start_stream': False, 'end_stream': False})}\n\n"
+                        elif delta.get("tool_calls") and func_calling and not tools_disabled:
+                            assembler.feed(delta["tool_calls"])
+
+                        if choice.get("finish_reason") == "tool_calls":
+                            assembler.flush()
+                    assembler.flush()
+                round_stats.response_done()
+
+                if not executor:
+                    break
+                history.append({
+                    "role": "assistant",
+                    "parts": [{"functionCall": {"name": fc["name"], "args": fc["args"]}} for fc in executor.calls]
+                })
+                history.append({"role": "function", "parts": await executor.results()})
+                payload["messages"] = openai_messages(history, config)
+                if tool_loop.exhausted():
+                    tools_disabled = True
+                    disable_tools(payload, "openai")
+
+            # 所有块解析完成后发送结束标志
+            if round_content:
+                history.append({
+                    "role": "assistant",
+                    "parts": [{"text": round_content}]
+                })
+                logger.debug("流式响应总内容已写入历史: %s", LazyText(round_content))
+            yield f"data: {json.dumps({'content': '', 'start_stream': False, 'end_stream': True})}\n\n"
+            logger.info("流式响应结束")
+        except KeyPoolExhausted as e:
+            logger.error(str(e))
+            yield f"data: {json.dumps({'content': f'流式请求失败: {e}', 'start_stream': False, 'end_stream': True})}\n\n"
+        finally:
+            if executor is not None:
+                await executor.cancel()
+            tool_loop.finish()
 
     return generate()
 
 # 统一的流式请求接口
-async def stream_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, conversation_history: Dict[str, List[Dict[str, Any]]], api_key) -> AsyncGenerator[str, None]:
+async def stream_request(history: List[Dict[str, Any]], config, client_id: str, send_message: Callable, api_key,
+                         session_id: Optional[str] = None) -> AsyncGenerator[str, None]:
     model_type = config.api["llm"]["model"]
     if model_type == "openai":
-        return await openai_stream_request(history, config, client_id, send_message, conversation_history)
+        return await openai_stream_request(history, config, client_id, send_message, api_key, session_id)
     else:  # 默认 gemini
-        return await gemini_stream_request(history, config, client_id, send_message, conversation_history, api_key)
+        return await gemini_stream_request(history, config, client_id, send_message, api_key, session_id)
     
 template = """
 <details>
@@ -625,4 +754,32 @@ template = """
 {{reasoning_content}}
 ---
 </details>
-"""
\ No newline at end of file
+"""
+# 基准测试：一条消息带多个附件，每个附件模拟一次网络往返（下载或上传）并编码 2 MB 内容，
+# 比较逐个处理和并发处理的总耗时
+async def main():
+    import os
+    import types
+
+    attachments, latency = 6, 0.2
+    config = types.SimpleNamespace(api={"upload": {"max_concurrent_attachments": 4}})
+    payloads = [os.urandom(2 * 1024 * 1024) for _ in range(attachments)]
+    message_list = [{"type": "text", "content": "看看这些图片"}] + [
+        {"type": "image", "source": {"byte": payload, "mime_type": "image/png"}} for payload in payloads]
+
+    async def build(item: Dict[str, Any]) -> Dict[str, Any]:
+        if item["type"] == "text":
+            return {"text": item["content"]}
+        await asyncio.sleep(latency)
+        return await Image(byte=item["source"]["byte"], mime_type=item["source"]["mime_type"]).to_dict()
+
+    started = time.perf_counter()
+    sequential = [await build(item) for item in message_list]
+    print(f"{attachments} 个附件逐个处理: {(time.perf_counter() - started) * 1000:.0f}ms")
+    started = time.perf_counter()
+    concurrent = await construct_concurrently(message_list, build, config)
+    print(f"{attachments} 个附件并发处理（最多 4 个）: {(time.perf_counter() - started) * 1000:.0f}ms")
+    assert concurrent == sequential
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,221 @@
+// 流式 Markdown 渲染基准：50k 字符的回复按 20 字符分块到达，比较每块都整体重新解析（旧实现）
+// 和 StreamingMarkdownRenderer 增量渲染的单次渲染耗时，并检查围栏、块边界的处理。
+//
+//   node bench/streaming_markdown.js
+//
+// 安装了 jsdom 和 marked（npm install jsdom marked）时使用真实的 DOM 和解析器，
+// 否则使用简化的 DOM 和线性时间的替代解析器，此时数字只反映渲染器本身的开销。
+"use strict";
+const fs = require("fs");
+const path = require("path");
+const vm = require("vm");
+const { performance } = require("perf_hooks");
+
+const REPLY_CHARS = 50000;
+const CHUNK_CHARS = 20;
+
+// 从 script.js 中取出渲染器相关的定义，在独立上下文中执行
+function extract(source, start) {
+    const begin = source.indexOf(start);
+    if (begin === -1) throw new Error(`script.js 中找不到 ${start}`);
+    const end = source.indexOf("\n}\n", begin);
+    return source.slice(begin, end + 3);
+}
+
+function createEnvironment() {
+    let document, marked, label;
+    try {
+        const { JSDOM } = require("jsdom");
+        document = new JSDOM("<!DOCTYPE html><div id='chatContainer'></div>").window.document;
+        marked = require("marked");
+        label = "jsdom + marked";
+    } catch (e) {
+        ({ document, marked } = stubEnvironment());
+        label = "简化 DOM + 替代解析器（未安装 jsdom/marked）";
+    }
+    const frames = [];
+    const context = vm.createContext({
+        document,
+        marked,
+        console,
+        navigator: { clipboard: { writeText: async () => {} } },
+        requestAnimationFrame: (callback) => frames.push(callback),
+        cancelAnimationFrame: () => {},
+        renderMedia: () => {},
+        autoScrollIfAtBottom: () => {},
+    });
+    const script = fs.readFileSync(path.join(__dirname, "..", "script.js"), "utf8");
+    vm.runInContext([
+        extract(script, "function addCopyButtons(root)"),
+        extract(script, "function markdownFragment(source)"),
+        extract(script, "class StreamingMarkdownRenderer"),
+        "this.StreamingMarkdownRenderer = StreamingMarkdownRenderer;",
+    ].join("\n"), context);
+    // 每次渲染对应浏览器中的一帧
+    const runFrames = () => frames.splice(0).forEach((callback) => callback());
+    return { document, marked, label, StreamingMarkdownRenderer: context.StreamingMarkdownRenderer, runFrames };
+}
+
+function stubEnvironment() {
+    class Node {
+        constructor() {
+            this.parentNode = null;
+            this.childNodes = [];
+            this.dataset = {};
+            this.classList = { add() {} };
+        }
+        appendChild(node) {
+            return this.insertBefore(node, null);
+        }
+        insertBefore(node, reference) {
+            const nodes = node.isFragment ? node.childNodes.splice(0) : [node];
+            const index = reference ? this.childNodes.indexOf(reference) : this.childNodes.length;
+            this.childNodes.splice(index, 0, ...nodes);
+            nodes.forEach((child) => (child.parentNode = this));
+            return node;
+        }
+        remove() {
+            if (this.parentNode) {
+                this.parentNode.childNodes.splice(this.parentNode.childNodes.indexOf(this), 1);
+                this.parentNode = null;
+            }
+        }
+        querySelectorAll() {
+            return [];
+        }
+        set innerHTML(html) {
+            // 每个顶层块一个节点；template 的内容放在 content 中
+            const target = this.content || this;
+            target.childNodes.splice(0).forEach((child) => (child.parentNode = null));
+            for (const block of html.split("\n\n")) {
+                if (block) target.appendChild(Object.assign(new Node(), { html: block }));
+            }
+        }
+    }
+    const document = {
+        getElementById: () => new Node(),
+        createTextNode: () => new Node(),
+        createElement(tag) {
+            const element = new Node();
+            if (tag === "template") {
+                element.content = new Node();
+                element.content.isFragment = true;
+            }
+            return element;
+        },
+    };
+    // 线性时间的替代解析器：转义后按空行分块
+    const escape = { "&": "&amp;", "<": "&lt;", ">": "&gt;" };
+    const marked = { parse: (source) => source.replace(/[&<>]/g, (c) => escape[c]).split(/\n\s*\n/).map((b) => `<p>${b}</p>`).join("\n\n") };
+    return { document, marked };
+}
+
+// 生成包含各种块的长回复
+function buildReply(chars) {
+    const pieces = [
+        "## 小节标题\n\n这是一段普通的说明文字，包含 `行内代码` 和 **强调**。\n\n",
+        "- 第一项\n- 第二项\n\n  第二项的续行，缩进表示仍属于列表\n\n",
+        "```python\ndef f(x):\n    return x * 2\n\n\nprint(f(3))\n```\n\n",
+        "~~~\n```\n波浪线围栏内的反引号不会关闭围栏\n```\n~~~\n\n",
+        "````markdown\n```\n更长的围栏只能被同样长或更长的围栏关闭\n```\n\n````\n\n",
+        "``` 这一行的信息串里含有 ` 所以不是围栏\n\n",
+        "    缩进代码块\n\n    第二段缩进代码\n\n",
+        "> 引用\n> 第二行\n\n",
+    ];
+    let reply = "";
+    for (let i = 0; reply.length < chars; i++) {
+        reply += pieces[i % pieces.length];
+    }
+    return reply.slice(0, chars);
+}
+
+// 独立计算 source 末尾是否位于未闭合的围栏中（不依赖渲染器的增量状态）
+function insideFence(source) {
+    let fence = null;
+    for (const line of source.split("\n")) {
+        const match = /^ {0,3}(`{3,}|~{3,})(.*)$/.exec(line);
+        if (fence) {
+            if (match && match[1][0] === fence.char && match[1].length >= fence.length && !match[2].trim()) fence = null;
+        } else if (match && !(match[1][0] === "`" && match[2].includes("`"))) {
+            fence = { char: match[1][0], length: match[1].length };
+        }
+    }
+    return fence !== null;
+}
+
+// 块边界：分块到达后渲染器固定下来的前缀
+const BOUNDARY_CASES = [
+    ["段落之间的空行", "第一段\n\n第二段\n", "第一段\n\n"],
+    ["围栏内的空行不是边界", "```\ncode\n\nmore\n```\n\n下一段\n", "```\ncode\n\nmore\n```\n\n"],
+    ["未闭合的围栏内不固定", "说明\n\n```\ncode\n\nmore\n", "说明\n\n"],
+    ["~~~ 围栏不被 ``` 关闭", "~~~\na\n\n```\nb\n\n~~~\n\nc\n", "~~~\na\n\n```\nb\n\n~~~\n\n"],
+    ["更短的围栏不能关闭", "````\nx\n```\n\ny\n````\n\nz\n", "````\nx\n```\n\ny\n````\n\n"],
+    ["缩进的续行属于上一块", "- 列表项\n\n  续行\n\n下一段\n", "- 列表项\n\n  续行\n\n"],
+    ["信息串含反引号的行不是围栏", "``` 不是 ` 围栏\n\n之后\n", "``` 不是 ` 围栏\n\n"],
+    ["紧跟空行的围栏开始新块", "段落\n\n```\ncode\n```\n", "段落\n\n"],
+];
+
+function checkBoundaries(env) {
+    for (const [name, source, expected] of BOUNDARY_CASES) {
+        for (const chunkSize of [1, 3, source.length]) {
+            const renderer = new env.StreamingMarkdownRenderer(env.document.createElement("div"));
+            for (let i = 0; i < source.length; i += chunkSize) {
+                renderer.append(source.slice(i, i + chunkSize));
+                env.runFrames();
+            }
+            const committed = source.slice(0, renderer.committed);
+            if (committed !== expected) {
+                throw new Error(`${name}（每块 ${chunkSize} 字符）: 固定了 ${JSON.stringify(committed)}，应为 ${JSON.stringify(expected)}`);
+            }
+        }
+    }
+    console.log(`块边界检查通过: ${BOUNDARY_CASES.length} 种情况 × 3 种分块大小`);
+}
+
+function bench(env, reply) {
+    const chunks = [];
+    for (let i = 0; i < reply.length; i += CHUNK_CHARS) chunks.push(reply.slice(i, i + CHUNK_CHARS));
+
+    // 旧实现：每块清空气泡，整体重新解析
+    const oldContainer = env.document.createElement("div");
+    let source = "";
+    const oldTimes = chunks.map((chunk) => {
+        source += chunk;
+        const started = performance.now();
+        oldContainer.innerHTML = "";
+        oldContainer.appendChild(markdownFragmentFor(env, source));
+        return performance.now() - started;
+    });
+
+    const renderer = new env.StreamingMarkdownRenderer(env.document.createElement("div"));
+    const newTimes = chunks.map((chunk) => {
+        renderer.append(chunk);
+        const started = performance.now();
+        env.runFrames();
+        const elapsed = performance.now() - started;
+        if (insideFence(reply.slice(0, renderer.committed))) {
+            throw new Error(`固定块在围栏内部结束（位置 ${renderer.committed}）`);
+        }
+        return elapsed;
+    });
+
+    const lastTenth = (times) => {
+        const tail = times.slice(-Math.ceil(times.length / 10));
+        return tail.reduce((a, b) => a + b, 0) / tail.length;
+    };
+    const total = (times) => times.reduce((a, b) => a + b, 0);
+    console.log(`${reply.length} 字符，每块 ${CHUNK_CHARS} 字符，共 ${chunks.length} 次渲染`);
+    console.log(`整体重新解析: 接近 50k 时每次 ${lastTenth(oldTimes).toFixed(3)}ms，合计 ${total(oldTimes).toFixed(0)}ms`);
+    console.log(`增量渲染:     接近 50k 时每次 ${lastTenth(newTimes).toFixed(3)}ms，合计 ${total(newTimes).toFixed(0)}ms`);
+}
+
+function markdownFragmentFor(env, source) {
+    const template = env.document.createElement("template");
+    template.innerHTML = env.marked.parse(source);
+    return template.content;
+}
+
+const env = createEnvironment();
+console.log(`环境: ${env.label}`);
+checkBoundaries(env);
+bench(env, buildReply(REPLY_CHARS));
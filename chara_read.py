@@ -3,6 +3,7 @@ from PIL import Image
 import html
 import base64
 import os
+from executors import run_in_thread
 
 async def use_folder_chara(file_name):
     full_path = f"chara/{file_name}"
@@ -10,7 +11,8 @@ async def use_folder_chara(file_name):
         with open(full_path, "r", encoding="utf-8") as f:
             return f.read()
     elif file_name.endswith((".jpg", ".jpeg", ".png")):
-        return silly_tavern_card(full_path, clear_html=True)
+        # 读取 PNG 元数据并解码，放到线程池执行
+        return await run_in_thread(silly_tavern_card, full_path, clear_html=True)
 
 
 async def get_folder_chara():
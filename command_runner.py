@@ -0,0 +1,176 @@
+import asyncio
+import locale
+import logging
+import os
+import signal
+import subprocess
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认命令执行限制，可在 config/api.yaml 的 run_command 中覆盖
+DEFAULT_COMMAND_CONFIG = {
+    "timeout": 60,  # 命令最长运行秒数，超时后终止整个进程树
+    "max_output_bytes": 65536,  # 返回给模型的输出上限，超出时保留开头和结尾
+    "head_ratio": 0.25,  # 上限中分给开头的比例，其余保留结尾（通常是结果或报错）
+    "read_chunk": 65536,  # 每次从管道读取的字节数
+    "stream_to_client": False,  # 是否把输出实时发送给客户端
+    "stream_interval": 0.5,  # 实时输出的最短发送间隔（秒）
+}
+
+def get_command_config(config) -> Dict:
+    command_config = dict(DEFAULT_COMMAND_CONFIG)
+    command_config.update(config.api.get("run_command") or {})
+    return command_config
+
+def decode_output(data: bytes) -> str:
+    """
+    优先按 UTF-8 解码，大量字节无法解码时按系统编码（如 Windows 控制台的 GBK）解码。
+
+    截断处被切开的多字节字符只会产生个别替换字符，仍按 UTF-8 处理。
+    """
+    text = data.decode("utf-8", errors="replace")
+    if text.count("\ufffd") <= 2:
+        return text
+    return data.decode(locale.getpreferredencoding(False), errors="replace")
+
+class HeadTailBuffer:
+    """只保留前 head 字节和后 tail 字节的输出缓冲，内存占用与输出总量无关"""
+
+    def __init__(self, head: int, tail: int):
+        self.head_limit = head
+        self.tail_limit = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data: bytes):
+        self.total += len(data)
+        if len(self.head) < self.head_limit:
+            taken = self.head_limit - len(self.head)
+            self.head += data[:taken]
+            data = data[taken:]
+        if data and self.tail_limit:
+            self.tail += data
+            if len(self.tail) > self.tail_limit:
+                del self.tail[:len(self.tail) - self.tail_limit]
+
+    @property
+    def dropped(self) -> int:
+        return self.total - len(self.head) - len(self.tail)
+
+    def getvalue(self) -> str:
+        if not self.dropped:
+            return decode_output(bytes(self.head + self.tail))
+        return (f"{decode_output(bytes(self.head))}\n...(省略中间 {self.dropped} 字节输出)...\n"
+                f"{decode_output(bytes(self.tail))}")
+
+class CommandResult:
+    __slots__ = ("output", "returncode", "timed_out", "elapsed", "total_bytes")
+
+    def __init__(self, output: str, returncode: Optional[int], timed_out: bool, elapsed: float, total_bytes: int):
+        self.output = output
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.elapsed = elapsed
+        self.total_bytes = total_bytes
+
+async def _kill_tree(process: asyncio.subprocess.Process):
+    """终止 shell 及其启动的子进程，避免子进程继续占用输出管道"""
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == "nt":
+            killer = await asyncio.create_subprocess_exec(
+                "taskkill", "/T", "/F", "/PID", str(process.pid),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            await killer.wait()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, OSError):
+        pass
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    try:
+        await asyncio.wait_for(process.wait(), 5)
+    except asyncio.TimeoutError:
+        logger.warning(f"进程 {process.pid} 终止后仍未退出")
+
+async def run_shell(command: str, timeout: float, max_output_bytes: int, head_ratio: float = 0.25,
+                    read_chunk: int = 65536, on_output: Optional[Callable[[bytes], Awaitable[None]]] = None) -> CommandResult:
+    """
+    执行 shell 命令，stdout/stderr 按块读取并合并到同一个有上限的缓冲中。
+
+    :param timeout: 超过该秒数后终止整个进程树，已收到的输出照常返回
+    :param on_output: 每读到一块输出时调用，用于实时转发
+    """
+    started = time.perf_counter()
+    head = int(max_output_bytes * head_ratio)
+    buffer = HeadTailBuffer(head, max_output_bytes - head)
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # 新的进程组/会话，超时时可以一起终止 shell 启动的子进程
+        start_new_session=os.name != "nt",
+    )
+
+    async def pump(stream: asyncio.StreamReader):
+        while True:
+            data = await stream.read(read_chunk)
+            if not data:
+                return
+            buffer.write(data)
+            if on_output is not None:
+                await on_output(data)
+
+    pumps = [asyncio.ensure_future(pump(process.stdout)), asyncio.ensure_future(pump(process.stderr))]
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.gather(*pumps, process.wait()), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        logger.warning(f"命令执行超过 {timeout} 秒，已终止: {command}")
+    finally:
+        for task in pumps:
+            task.cancel()
+        await _kill_tree(process)
+    return CommandResult(buffer.getvalue(), process.returncode, timed_out, time.perf_counter() - started, buffer.total)
+
+class LiveOutput:
+    """按时间间隔合并后把命令输出发送给客户端，发送总量同样受上限约束"""
+
+    def __init__(self, send: Callable[[str], Awaitable[None]], interval: float, max_bytes: int):
+        self.send = send
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.pending = bytearray()
+        self.sent = 0
+        self.last_sent = 0.0
+        self.stopped = False
+
+    async def write(self, data: bytes):
+        if self.stopped:
+            return
+        # 待发送内容同样不超过剩余额度
+        self.pending += data[:max(self.max_bytes - self.sent - len(self.pending), 0)]
+        if time.perf_counter() - self.last_sent >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        if self.stopped or not self.pending:
+            return
+        data = bytes(self.pending)
+        self.pending.clear()
+        self.sent += len(data)
+        self.last_sent = time.perf_counter()
+        text = decode_output(data)
+        if self.sent >= self.max_bytes:
+            self.stopped = True
+            text += "\n...(输出过多，不再实时显示)"
+        await self.send(text)
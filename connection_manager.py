@@ -0,0 +1,287 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from fastapi import WebSocket, WebSocketDisconnect
+from stream_sender import release_frame_lock
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认连接管理配置，可在 config/api.yaml 的 connections 中覆盖
+DEFAULT_CONNECTION_CONFIG = {
+    "max_connections": 1000,  # 每个 worker 同时保持的连接数上限，超出时新连接以 1013 关闭
+    "heartbeat_interval": 20,  # 服务端发送 ping 的间隔（秒）
+    "heartbeat_timeout": 60,  # 超过该秒数没有收到客户端任何消息（包括 pong）时断开
+    "idle_timeout": 1800,  # 超过该秒数没有新的聊天消息时断开，0 表示不限制
+    "send_queue_size": 64,  # 每个连接待发送的帧数上限，满时发送方等待
+    "send_timeout": 30,  # 发送方等待队列空位的最长时间（秒），超时视为对端已失效并断开
+    "inbox_size": 16,  # 每个连接排队等待处理的消息数上限
+}
+
+# 关闭码：1013 为标准的“稍后重试”，4000 起为应用自定义
+CLOSE_OVERLOADED = 1013
+CLOSE_IDLE = 4000
+CLOSE_HEARTBEAT = 4001
+CLOSE_SLOW_CONSUMER = 4002
+
+def get_connection_config(config) -> Dict:
+    connection_config = dict(DEFAULT_CONNECTION_CONFIG)
+    connection_config.update(config.api.get("connections") or {})
+    return connection_config
+
+class ConnectionClosed(Exception):
+    """向已关闭的连接发送消息"""
+
+MessageHandler = Callable[["Connection", Dict[str, Any]], Awaitable[None]]
+CloseHandler = Callable[["Connection"], None]
+ControlHandler = Callable[["Connection", Any], bool]
+
+class Connection:
+    """
+    一个 WebSocket 连接。发送经过有上限的队列，由单独的写任务按顺序写出，
+    慢客户端只会阻塞给它发消息的协程，超时后连接被关闭；收到的消息按顺序交给处理任务。
+    """
+
+    def __init__(self, websocket: WebSocket, client_id: str, user_id: str, binary: bool,
+                 send_queue_size: int, send_timeout: float, inbox_size: int):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.user_id = user_id
+        self.binary = binary
+        self.send_timeout = send_timeout
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=max(send_queue_size, 1))
+        self.inbox: asyncio.Queue = asyncio.Queue(maxsize=max(inbox_size, 1))
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at  # 最近收到任何消息的时间
+        self.last_message = self.connected_at  # 最近收到聊天消息的时间
+        self.tasks: Set[asyncio.Task] = set()
+        self.closed = asyncio.Event()
+        self.close_code: Optional[int] = None
+        self.close_reason = ""
+
+    def spawn(self, coro, name: str = "") -> asyncio.Task:
+        """启动属于该连接的任务，断开时统一取消"""
+        task = asyncio.create_task(coro, name=f"{self.client_id}:{name}")
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _put(self, item):
+        if self.closed.is_set():
+            raise ConnectionClosed(self.client_id)
+        try:
+            await asyncio.wait_for(self.outbox.put(item), self.send_timeout)
+        except asyncio.TimeoutError:
+            self.close(CLOSE_SLOW_CONSUMER, "send timeout")
+            raise ConnectionClosed(self.client_id)
+
+    async def send_text(self, text: str):
+        await self._put(("text", text))
+
+    async def send_bytes(self, data: bytes):
+        await self._put(("bytes", data))
+
+    def try_send_text(self, text: str) -> bool:
+        """队列已满时直接放弃（用于心跳等可丢弃的消息）"""
+        if self.closed.is_set():
+            return False
+        try:
+            self.outbox.put_nowait(("text", text))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def close(self, code: int = 1000, reason: str = ""):
+        """标记连接关闭，由 ConnectionManager 完成关闭握手和任务清理"""
+        if not self.closed.is_set():
+            self.close_code = code
+            self.close_reason = reason
+            self.closed.set()
+
+    async def _writer(self):
+        try:
+            while True:
+                kind, payload = await self.outbox.get()
+                if kind == "text":
+                    await self.websocket.send_text(payload)
+                else:
+                    await self.websocket.send_bytes(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"客户端 {self.client_id}: 发送失败，连接已断开: {type(e).__name__}")
+            self.close(1006, "send failed")
+
+class ConnectionManager:
+    """
+    管理所有 WebSocket 连接：连接数上限、心跳与空闲断开、发送队列，
+    以及断开时取消该连接的所有任务（写任务、心跳、正在处理的消息）。
+    """
+
+    def __init__(self, max_connections: int = 1000, heartbeat_interval: float = 20, heartbeat_timeout: float = 60,
+                 idle_timeout: float = 1800, send_queue_size: int = 64, send_timeout: float = 30, inbox_size: int = 16):
+        self.max_connections = max_connections
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.send_queue_size = send_queue_size
+        self.send_timeout = send_timeout
+        self.inbox_size = inbox_size
+        self.connections: Dict[str, Connection] = {}
+        self.opened = 0
+        self.rejected = 0
+        self.evicted: Dict[str, int] = {}
+
+    @classmethod
+    def from_config(cls, config) -> "ConnectionManager":
+        return cls(**get_connection_config(config))
+
+    def get(self, client_id: str) -> Optional[Connection]:
+        return self.connections.get(client_id)
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self.connections
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    async def serve(self, websocket: WebSocket, user_id: Callable[[WebSocket, str], str], binary: bool,
+                    handler: MessageHandler, on_close: Optional[CloseHandler] = None,
+                    control: Optional[ControlHandler] = None):
+        """
+        处理一个连接直到断开。
+
+        :param user_id: UserIdSigner.resolve(websocket, client_id)，确定连接所属的用户
+        :param binary: 是否以二进制帧发送媒体
+        :param handler: handler(connection, message)，按收到的顺序逐条执行
+        :param on_close: 连接清理完成后调用，用于释放按 client_id 保存的状态
+        :param control: control(connection, message) 在消息排队前立即调用（不等待正在处理的消息），
+                        返回 True 表示已处理、不再排队，用于停止指令等
+        """
+        await websocket.accept()
+        if len(self.connections) >= self.max_connections:
+            self.rejected += 1
+            logger.warning(f"连接数已达上限 {self.max_connections}，拒绝新连接")
+            await websocket.close(code=CLOSE_OVERLOADED, reason="too many connections")
+            return
+
+        client_id = str(uuid.uuid4())
+        connection = Connection(websocket, client_id, user_id(websocket, client_id), binary,
+                                self.send_queue_size, self.send_timeout, self.inbox_size)
+        self.connections[client_id] = connection
+        self.opened += 1
+        logger.info(f"客户端 {client_id} 已连接，用户: {connection.user_id}（当前 {len(self.connections)} 个连接）")
+
+        writer = connection.spawn(connection._writer(), "writer")
+        connection.spawn(self._heartbeat(connection), "heartbeat")
+        connection.spawn(self._dispatch(connection, handler), "dispatch")
+        receiver = connection.spawn(self._receive(connection, control), "receive")
+        closed = asyncio.create_task(connection.closed.wait())
+        try:
+            await asyncio.wait({receiver, closed}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            closed.cancel()
+            await self._cleanup(connection, writer)
+            if on_close:
+                on_close(connection)
+
+    async def _receive(self, connection: Connection, control: Optional[ControlHandler]):
+        try:
+            while True:
+                message = await connection.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    connection.close(message.get("code", 1000), "client closed")
+                    return
+                connection.last_seen = time.monotonic()
+                text = message.get("text")
+                if text is None:
+                    continue
+                try:
+                    data = json.loads(text)
+                except ValueError:
+                    logger.warning(f"客户端 {connection.client_id}: 无法解析的消息 ({len(text)} 字符)")
+                    continue
+                if isinstance(data, dict) and data.get("type") == "pong":
+                    continue
+                connection.last_message = connection.last_seen
+                if control and control(connection, data):
+                    continue
+                try:
+                    connection.inbox.put_nowait(data)
+                except asyncio.QueueFull:
+                    connection.try_send_text(json.dumps([{"type": "text", "content": "消息过多，请等待当前回复完成"}],
+                                                        ensure_ascii=False))
+        except WebSocketDisconnect as e:
+            connection.close(e.code, "client closed")
+        except RuntimeError:
+            # 连接已经关闭后的 receive
+            connection.close(1006, "receive failed")
+
+    async def _dispatch(self, connection: Connection, handler: MessageHandler):
+        while True:
+            data = await connection.inbox.get()
+            try:
+                await handler(connection, data)
+            except (ConnectionClosed, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                logger.error(f"客户端 {connection.client_id}: 消息处理错误: {str(e)}")
+
+    async def _heartbeat(self, connection: Connection):
+        """定期发送 {"type": "ping"}，客户端长时间无响应或空闲时关闭连接"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            if now - connection.last_seen > self.heartbeat_timeout:
+                self._evict(connection, CLOSE_HEARTBEAT, "heartbeat timeout")
+                return
+            if self.idle_timeout and now - connection.last_message > self.idle_timeout:
+                self._evict(connection, CLOSE_IDLE, "idle")
+                return
+            connection.try_send_text('{"type": "ping"}')
+
+    def _evict(self, connection: Connection, code: int, reason: str):
+        self.evicted[reason] = self.evicted.get(reason, 0) + 1
+        logger.info(f"客户端 {connection.client_id}: 断开连接 ({reason})")
+        connection.close(code, reason)
+
+    async def _cleanup(self, connection: Connection, writer: asyncio.Task):
+        connection.close(1000)
+        self.connections.pop(connection.client_id, None)
+        # 先停止接收和处理，再给写任务最多 1 秒把已排队的消息（如错误提示）发完
+        for task in list(connection.tasks):
+            if task is not writer:
+                task.cancel()
+        deadline = time.monotonic() + 1
+        while not connection.outbox.empty() and not writer.done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        writer.cancel()
+        await asyncio.gather(*list(connection.tasks), return_exceptions=True)
+        try:
+            await connection.websocket.close(code=connection.close_code or 1000, reason=connection.close_reason)
+        except Exception:
+            pass  # 对端已断开
+        release_frame_lock(connection)
+        logger.info(f"客户端 {connection.client_id} 已断开 (code {connection.close_code} {connection.close_reason})".rstrip())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connections": len(self.connections),
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "evicted": dict(self.evicted),
+            "queued_frames": sum(connection.outbox.qsize() for connection in self.connections.values()),
+            "tasks": len(asyncio.all_tasks()),
+        }
+
+_connections: Optional[ConnectionManager] = None
+
+def get_connections(config) -> ConnectionManager:
+    """全局连接管理器，首次使用时按配置创建"""
+    global _connections
+    if _connections is None:
+        _connections = ConnectionManager.from_config(config)
+    return _connections
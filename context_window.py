@@ -0,0 +1,215 @@
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认上下文预算，可在 config/api.yaml 的 context 中覆盖
+DEFAULT_CONTEXT_CONFIG = {
+    "max_tokens": 32000,
+    "max_bytes": 8 * 1024 * 1024,
+    "max_messages": 50,
+    "keep_media_turns": 2,
+    "summarize": False,
+}
+
+SUMMARY_PREFIX = "[此前对话摘要]\n"
+IMAGE_TOKENS = 258  # Gemini 对单张图片按固定 token 计费
+INLINE_TEXT_LIMIT = 1024  # 超过该长度的 data: URL 文本视为内联媒体
+
+Summarizer = Callable[[List[Dict[str, Any]], str], Awaitable[str]]
+
+def get_context_config(config) -> Dict:
+    context_config = dict(DEFAULT_CONTEXT_CONFIG)
+    context_config.update(config.api.get("context") or {})
+    return context_config
+
+def estimate_text_tokens(text: str) -> int:
+    """近似 token 数：ASCII 约 4 字符一个 token，其余字符（中文等）约一字一个 token"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+def _is_inline_media(part: Dict[str, Any]) -> bool:
+    if "inline_data" in part:
+        return True
+    if "image_url" in part:
+        return part["image_url"].get("url", "").startswith("data:")
+    text = part.get("text")
+    return isinstance(text, str) and text.startswith("data:") and len(text) > INLINE_TEXT_LIMIT
+
+def estimate_part(part: Dict[str, Any]):
+    """估算单个 part 的 (token 数, 请求体字节数)"""
+    if "text" in part and not _is_inline_media(part):
+        text = part["text"]
+        return estimate_text_tokens(text), len(text.encode("utf-8"))
+    if "inline_data" in part:
+        data = part["inline_data"].get("data", "")
+        mime_type = part["inline_data"].get("mime_type", "")
+        tokens = IMAGE_TOKENS if mime_type.startswith("image/") else len(data) // 1024 + 1
+        return tokens, len(data)
+    if "image_url" in part:
+        url = part["image_url"].get("url", "")
+        return IMAGE_TOKENS, len(url)
+    if "text" in part:
+        return len(part["text"]) // 1024 + 1, len(part["text"])
+    if "fileData" in part:
+        return IMAGE_TOKENS, 200
+    encoded = json.dumps(part, ensure_ascii=False)
+    return estimate_text_tokens(encoded), len(encoded.encode("utf-8"))
+
+def estimate_message(message: Dict[str, Any]):
+    tokens, size = 0, 0
+    for part in message.get("parts", []):
+        part_tokens, part_size = estimate_part(part)
+        tokens += part_tokens
+        size += part_size
+    return tokens, size
+
+def _media_placeholder(part: Dict[str, Any]) -> Dict[str, str]:
+    if "inline_data" in part:
+        mime_type = part["inline_data"].get("mime_type", "application/octet-stream")
+    elif "image_url" in part:
+        mime_type = part["image_url"]["url"][5:].split(";")[0]
+    else:
+        mime_type = part["text"][5:].split(";")[0]
+    return {"text": f"[已省略的历史附件: {mime_type}]"}
+
+def _is_turn_start(message: Dict[str, Any]) -> bool:
+    """用户发起的新一轮对话（不是函数返回结果）"""
+    if message.get("role") != "user":
+        return False
+    return not any("functionResponse" in part for part in message.get("parts", []))
+
+def _is_summary_part(part: Dict[str, Any]) -> bool:
+    return isinstance(part.get("text"), str) and part["text"].startswith(SUMMARY_PREFIX)
+
+class ContextWindow:
+    """
+    按 token/字节/条数预算维护对话历史的滚动窗口（原地修改）。
+
+    较早轮次的内联媒体替换为占位文本；超出预算时从最早的完整轮次开始丢弃，
+    开启 summarize 时被丢弃的内容会并入缓存的摘要，放在窗口第一条消息前。
+    """
+
+    def __init__(self, max_tokens: int, max_bytes: int, max_messages: int, keep_media_turns: int,
+                 summarize: bool = False, summarizer: Optional[Summarizer] = None):
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.keep_media_turns = keep_media_turns
+        self.summarizer = summarizer if summarize else None
+
+    @classmethod
+    def from_config(cls, config, summarizer: Optional[Summarizer] = None) -> "ContextWindow":
+        return cls(summarizer=summarizer, **get_context_config(config))
+
+    def _strip_old_media(self, history: List[Dict[str, Any]], modified: Set[int]) -> int:
+        turn_starts = [i for i, message in enumerate(history) if _is_turn_start(message)]
+        if len(turn_starts) <= self.keep_media_turns:
+            return 0
+        boundary = turn_starts[-self.keep_media_turns] if self.keep_media_turns > 0 else len(history)
+        replaced = 0
+        for message_index, message in enumerate(history[:boundary]):
+            parts = message.get("parts", [])
+            for index, part in enumerate(parts):
+                if _is_inline_media(part):
+                    parts[index] = _media_placeholder(part)
+                    modified.add(message_index)
+                    replaced += 1
+        return replaced
+
+    def _find_cut(self, history: List[Dict[str, Any]], costs: List[tuple]) -> int:
+        """找到最小的丢弃位置，使剩余部分满足预算且从完整轮次开始"""
+        total_tokens = sum(cost[0] for cost in costs)
+        total_bytes = sum(cost[1] for cost in costs)
+        last_turn = max((i for i, message in enumerate(history) if _is_turn_start(message)), default=0)
+        cut = 0
+        while cut < last_turn:
+            fits = (total_tokens <= self.max_tokens and total_bytes <= self.max_bytes
+                    and len(history) - cut <= self.max_messages)
+            if fits and _is_turn_start(history[cut]):
+                break
+            total_tokens -= costs[cut][0]
+            total_bytes -= costs[cut][1]
+            cut += 1
+        return cut
+
+    async def apply(self, history: List[Dict[str, Any]], summary_cache: Dict[str, str]) -> Dict[str, Any]:
+        """
+        原地裁剪 history，返回裁剪前后的统计，以及丢弃的条数 (dropped) 和被改写的消息下标 (modified)。
+
+        :param history: 会话历史，最后一条通常是本轮用户消息
+        :param summary_cache: 会话级缓存，保存已生成的摘要（键 "summary"）
+        """
+        started = time.perf_counter()
+        before = [estimate_message(message) for message in history]
+        before_count = len(history)
+
+        modified: Set[int] = set()
+        replaced = self._strip_old_media(history, modified)
+        costs = [estimate_message(message) for message in history] if replaced else before
+        cut = self._find_cut(history, costs)
+
+        if cut:
+            dropped = history[:cut]
+            del history[:cut]
+            if self.summarizer is not None:
+                previous = summary_cache.get("summary", "")
+                dropped_without_summary = [
+                    {**message, "parts": [part for part in message.get("parts", []) if not _is_summary_part(part)]}
+                    for message in dropped
+                ]
+                try:
+                    summary_cache["summary"] = await self.summarizer(dropped_without_summary, previous)
+                except Exception as e:
+                    logger.error(f"生成对话摘要失败，保留旧摘要: {str(e)}")
+
+        modified = {index - cut for index in modified if index >= cut}
+
+        summary = summary_cache.get("summary") if self.summarizer is not None else None
+        if summary and history:
+            parts = history[0].setdefault("parts", [])
+            summary_part = {"text": SUMMARY_PREFIX + summary}
+            if parts and _is_summary_part(parts[0]):
+                if parts[0] != summary_part:
+                    parts[0] = summary_part
+                    modified.add(0)
+            else:
+                parts.insert(0, summary_part)
+                modified.add(0)
+
+        after = [estimate_message(message) for message in history]
+        report = {
+            "messages": (before_count, len(history)),
+            "tokens": (sum(c[0] for c in before), sum(c[0] for c in after)),
+            "bytes": (sum(c[1] for c in before), sum(c[1] for c in after)),
+            "media_replaced": replaced,
+            "dropped": cut,
+            "modified": sorted(modified),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        }
+        if cut or replaced:
+            logger.info(f"上下文窗口裁剪: {report}")
+        else:
+            logger.debug(f"上下文窗口: {report}")
+        return report
+
+def format_transcript(messages: List[Dict[str, Any]]) -> str:
+    """把要压缩的历史消息转成纯文本对话记录，媒体和函数调用只保留简述"""
+    lines = []
+    for message in messages:
+        texts = []
+        for part in message.get("parts", []):
+            if "text" in part and not _is_inline_media(part):
+                texts.append(part["text"])
+            elif "functionCall" in part:
+                texts.append(f"[调用函数 {part['functionCall'].get('name')}]")
+            elif "functionResponse" in part:
+                texts.append(f"[函数 {part['functionResponse'].get('name')} 返回结果]")
+            else:
+                texts.append("[附件]")
+        if texts:
+            lines.append(f"{message.get('role')}: {' '.join(texts)}")
+    return "\n".join(lines)
@@ -1,9 +1,122 @@
 import httpx
 import asyncio
+import logging
 from bs4 import BeautifulSoup
 import re
 import time
-from urllib.parse import urljoin, quote, unquote
+import zlib
+from typing import Dict
+from urllib.parse import quote, unquote
+from log_utils import LazyText
+from html_extract import NoHTMLError, html_to_markdown
+from executors import run_in_process
+from http_pool import http_pool
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认网页读取限制，可在 config/api.yaml 的 html_read 中覆盖
+DEFAULT_HTML_READ_CONFIG = {
+    "max_bytes": 5 * 1024 * 1024,  # 最多读取的（解压后）字节数，超过则截断
+    "max_chars": 60000,  # 提取出的文本最多保留的字符数，达到后停止解析
+    "connect_timeout": 10,
+    "read_timeout": 20,  # 两次收到数据之间的最长等待
+    "total_timeout": 30,  # 整个页面的读取时间上限，超时后使用已收到的部分
+}
+
+# 不是网页也不是文本的内容类型
+BINARY_TYPE_PREFIXES = ("image/", "audio/", "video/", "font/", "application/octet-stream", "application/pdf",
+                        "application/zip", "application/x-", "application/vnd.", "application/gzip", "application/wasm")
+# 直接返回原文的纯文本类型
+PLAIN_TEXT_TYPES = ("text/plain", "text/markdown", "application/json")
+# 常见二进制格式的文件头
+BINARY_SIGNATURES = (b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"%PDF", b"PK\x03\x04", b"\x1f\x8b", b"RIFF",
+                     b"ID3", b"OggS", b"fLaC", b"7z\xbc\xaf", b"Rar!", b"\x00asm", b"wOF")
+
+def get_html_read_config(config) -> Dict:
+    read_config = dict(DEFAULT_HTML_READ_CONFIG)
+    if config is not None:
+        read_config.update(config.api.get("html_read") or {})
+    return read_config
+
+def looks_binary(head: bytes) -> bool:
+    """根据文件头和 NUL 字节判断内容是否为二进制"""
+    return head.startswith(BINARY_SIGNATURES) or b"\x00" in head[:1024]
+
+async def iter_decoded(response: httpx.Response, limit: int):
+    """
+    逐块产出解压后的正文，最多 limit 字节。
+
+    gzip/deflate 自行解压并限制每次输出的长度，高压缩比的响应不会一次性膨胀占满内存；
+    其他编码交给 httpx 解码。
+    """
+    content_encoding = response.headers.get("content-encoding", "").strip().lower()
+    if content_encoding not in ("gzip", "x-gzip", "deflate"):
+        async for chunk in response.aiter_bytes():
+            yield chunk
+        return
+    # 16 + MAX_WBITS 只接受 gzip，32 + MAX_WBITS 自动识别 zlib/gzip 头
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if "gzip" in content_encoding else 32 + zlib.MAX_WBITS)
+    remaining = limit
+    try:
+        async for raw in response.aiter_raw():
+            data = raw
+            while data and remaining > 0:
+                chunk = decompressor.decompress(data, remaining)
+                remaining -= len(chunk)
+                if chunk:
+                    yield chunk
+                data = decompressor.unconsumed_tail
+            if remaining <= 0:
+                return
+    except zlib.error as e:
+        raise httpx.DecodingError(f"解压失败: {e}", request=response.request)
+
+class FetchedPage:
+    """有上限的页面读取结果"""
+    __slots__ = ("url", "content_type", "encoding", "body", "truncated", "timed_out", "skipped")
+
+    def __init__(self, url: str, content_type: str, encoding: str):
+        self.url = url
+        self.content_type = content_type
+        self.encoding = encoding
+        self.body = b""
+        self.truncated = False  # 超过 max_bytes 被截断
+        self.timed_out = False  # 超过 total_timeout 被截断
+        self.skipped = False  # 二进制内容，未读取
+
+async def fetch_page(client: httpx.AsyncClient, url: str, headers: Dict[str, str], timeout: httpx.Timeout,
+                     read_config: Dict) -> FetchedPage:
+    """
+    流式读取页面：先检查内容类型和文件头，二进制内容直接放弃；
+    正文按解压后的字节数计数，超过 max_bytes 或 total_timeout 时停止读取并关闭连接。
+    """
+    headers = {**headers, "Accept-Encoding": "gzip, deflate"}
+    max_bytes = read_config["max_bytes"]
+    deadline = time.monotonic() + read_config["total_timeout"]
+    async with client.stream("GET", url, headers=headers, timeout=timeout, follow_redirects=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        page = FetchedPage(str(response.url), content_type, response.charset_encoding or "utf-8")
+        if content_type.startswith(BINARY_TYPE_PREFIXES):
+            page.skipped = True
+            return page
+        body = bytearray()
+        async for chunk in iter_decoded(response, max_bytes):
+            if not body and looks_binary(chunk):
+                page.content_type = ""  # 声明的类型不可信
+                page.skipped = True
+                return page
+            body += chunk[:max_bytes - len(body)]
+            if len(body) >= max_bytes:
+                page.truncated = True
+                break
+            if time.monotonic() > deadline:
+                page.timed_out = True
+                logger.warning(f"读取页面超时，使用已收到的 {len(body)} 字节: {url}")
+                break
+        page.body = bytes(body)
+        return page
 
 async def fetch_url(url, headers):
     async with httpx.AsyncClient() as client:
@@ -38,7 +151,25 @@ def extract_div_contents(html_content):
     
     return entries
 
-async def baidu_search(query):
+def parse_searx_results(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    
+    articles = soup.find_all('article', class_='result result-default category-general')
+    
+    entries = []
+    for article in articles:
+        title = article.find('h3').get_text(strip=True)
+        link = article.find('a', class_='url_header')['href']
+        content = article.find('p', class_='content').get_text(strip=True)
+        entries.append({
+            'title': title,
+            'link': link,
+            'content': content
+        })
+    return entries
+
+async def baidu_results(query):
+    """百度搜索，返回 [{'title', 'link', 'content'}]"""
     current_timestamp = int(time.time())
     url = f"https://www.baidu.com/s?wd={query}"
     headers = {
@@ -63,7 +194,11 @@ async def baidu_search(query):
     }
     
     html_content = await fetch_url(url, headers)
-    entries = extract_div_contents(html_content)
+    # 解析放到进程池，避免大页面阻塞事件循环
+    return await run_in_process(extract_div_contents, html_content)
+
+async def baidu_search(query):
+    entries = await baidu_results(query)
     
     output = "baidu搜索结果:\n"
     for entry in entries:
@@ -74,7 +209,8 @@ async def baidu_search(query):
     
     return output
 
-async def searx_search(query):
+async def searx_results(query):
+    """searx 搜索，返回 [{'title', 'link', 'content'}]，请求失败时抛出 httpx 异常"""
     url = 'https://searx.bndkt.io/search'
     current_timestamp = int(time.time())
     params = {
@@ -110,28 +246,21 @@ async def searx_search(query):
     }
 
     async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            articles = soup.find_all('article', class_='result result-default category-general')
-            
-            results = []
-            for article in articles:
-                title = article.find('h3').get_text(strip=True)
-                link = article.find('a', class_='url_header')['href']
-                content = article.find('p', class_='content').get_text(strip=True)
-                results.append(f"标题: {title}\n链接: {link}\n内容: {content}\n{'-'* 20}")
+        response = await client.get(url, params=params, headers=headers)
+        response.raise_for_status()
+        return await run_in_process(parse_searx_results, response.text)
 
-            final = "searx搜索结果:\n" + "\n".join(results)
-            return final
-        except httpx.HTTPStatusError as exc:
-            print(f"An HTTP error occurred: {exc}")
-            print(exc.response.text)
-        except httpx.RequestError as exc:
-            print(f"An error occurred while making the request: {exc}")
+async def searx_search(query):
+    try:
+        entries = await searx_results(query)
+        results = [f"标题: {entry['title']}\n链接: {entry['link']}\n内容: {entry['content']}\n{'-'* 20}" for entry in entries]
+        final = "searx搜索结果:\n" + "\n".join(results)
+        return final
+    except httpx.HTTPStatusError as exc:
+        logger.error(f"An HTTP error occurred: {exc}")
+        logger.debug("%s", LazyText(exc.response.text))
+    except httpx.RequestError as exc:
+        logger.error(f"An error occurred while making the request: {exc}")
 
 
 async def html_read(url, config = None):
@@ -152,110 +281,85 @@ async def html_read(url, config = None):
         "Upgrade-Insecure-Requests": "1",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36 Edg/132.0.0.0"
     }
-    if config.api["proxy"]["http_proxy"]:
-        proxies = {"http://": config.api["proxy"]["http_proxy"], "https://": config.api["proxy"]["http_proxy"]}
-    else:
-        proxies = None
-    #proxies = {"http://" : "http://127.0.0.1:7890", "https://" : "http://127.0.0.1:7890"}
+    read_config = get_html_read_config(config)
+    client = http_pool.get_client(config, "html_read")
+    timeout = httpx.Timeout(read_config["read_timeout"], connect=read_config["connect_timeout"])
     
     decoded_url = unquote(url)
     parsed_url = httpx.URL(decoded_url)
     encoded_path = quote(parsed_url.path)
     encoded_url = str(parsed_url.copy_with(path=encoded_path))
     
-    async with httpx.AsyncClient(follow_redirects=True, timeout=None, proxies=proxies, headers=headers) as client:
-        try:
-            response = await client.get(encoded_url)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            if not soup.html:
-                print("未找到<html>标签，请确认网页内容是否正确加载。")
-                return "未找到<html>标签，请确认网页内容是否正确加载。"
-            
-            for script_or_style in soup(['script', 'style']):
-                script_or_style.decompose()
+    try:
+        page = await fetch_page(client, encoded_url, headers, timeout, read_config)
+    except httpx.RequestError as e:
+        logger.error(f"请求发生错误：{e}")
+        return f"请求发生错误：{e}"
+    if page.skipped:
+        logger.info(f"跳过非文本内容: {encoded_url} ({page.content_type})")
+        return f"该链接不是网页，而是 {page.content_type or '二进制'} 内容，无法读取。"
+    if page.timed_out and not page.body:
+        return f"请求发生错误：{read_config['total_timeout']} 秒内未收到页面内容"
 
-            url_attributes = {
-                'a': 'href',
-                'img': 'src',
-                'link': 'href',
-                'iframe': 'src',
-            }
+    text = page.body.decode(page.encoding, errors="replace")
+    suffix = ""
+    if page.truncated:
+        suffix = f"\n...(页面过大，只读取了前 {len(page.body) / 1024:.1f} KiB)"
+    elif page.timed_out:
+        suffix = f"\n...(读取超时，只使用了已收到的 {len(page.body) / 1024:.1f} KiB)"
+    if page.content_type in PLAIN_TEXT_TYPES:
+        return text[:read_config["max_chars"]] + suffix
+    try:
+        markdown = await run_in_process(html_to_markdown, text, page.url, None, read_config["max_chars"])
+    except NoHTMLError as e:
+        logger.warning(str(e))
+        return str(e)
+    return markdown + suffix
 
-            def recurse(node, level=0):
-                indent = '  ' * level
-                result = []
-                
-                if hasattr(node, 'name') and node.name is not None:
-                    tag_name = node.name.lower()
-                    
-                    if tag_name in ['script', 'style']:
-                        return result
-                    
-                    if tag_name == 'pre' or tag_name == 'code':
-                        all_lines = []
-                        # 检查是否有直接的`<span>`子元素
-                        spans = node.find_all('span', recursive=False)
-                        if spans:
-                            for span in spans:
-                                # 获取每个span的所有子孙节点的文本，并保持其中的空白字符
-                                line_parts = [part.get_text() if hasattr(part, "get_text") else str(part) for part in span.contents]
-                                full_line = ''.join(line_parts)
+async def benchmark():
+    """
+    对比旧的整页读取（client.get + response.text）与 fetch_page 的峰值内存和耗时：
+    20 MiB 的普通页面，以及解压后 200 MiB 的 gzip 页面。
+    """
+    import gzip
+    import tracemalloc
 
-                                # 如果行中只包含空白字符，也添加到all_lines中
-                                stripped_line = full_line.strip()
-                                if stripped_line or (full_line and not full_line.isspace()):
-                                    all_lines.append(full_line)
-                        else:
-                            # 如果没有`<span>`子元素，则直接使用`<code>`标签内的文本，并保持其中的空白字符
-                            code_text = node.get_text()
-                            lines = code_text.split('\n')
-                            for line in lines:
-                                stripped_line = line.strip()
-                                if stripped_line or (line and not line.isspace()):
-                                    all_lines.append(line)
+    chunk = b"<p>" + "压测文本".encode() * 2000 + b"</p>\n"
+    plain = chunk * (20 * 1024 * 1024 // len(chunk))
+    bomb = gzip.compress(b"<html><body>" + b"a" * (200 * 1024 * 1024), compresslevel=9)
+
+    async def stream(data: bytes):
+        # 按块流式返回；直接传入 bytes 的 Response 会被视为已读取完毕
+        for start in range(0, len(data), 64 * 1024):
+            yield data[start:start + 64 * 1024]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/bomb":
+            return httpx.Response(200, headers={"content-type": "text/html", "content-encoding": "gzip"},
+                                  content=stream(bomb))
+        return httpx.Response(200, headers={"content-type": "text/html"}, content=stream(plain))
+
+    async def old_read(client, url):
+        response = await client.get(url)
+        return response.text
 
-                        formatted_code = "\n".join([f"{indent}{line}" for line in all_lines])
-                        result.append(f"{indent}```yaml\n{formatted_code}\n{indent}```")
-                        return result
-                    
-                    if tag_name in url_attributes:
-                        attr = url_attributes[tag_name]
-                        url_attr_value = node.get(attr, '')
-                        
-                        if tag_name == 'a' and url_attr_value.lower().startswith('javascript:'):
-                            return result
-                        
-                        full_url = urljoin(str(response.url), url_attr_value)
-                        if tag_name == 'a':
-                            img_tag = node.find('img')
-                            if img_tag:
-                                alt = img_tag.get('alt', 'No description')
-                                result.append(f"{indent}[{alt}]({full_url})")
-                            else:
-                                link_text = ' '.join(node.stripped_strings)
-                                result.append(f"{indent}[{link_text}]({full_url})")
-                        elif tag_name == 'img':
-                            alt = node.get('alt', 'No description')
-                            result.append(f"{indent}[{alt}]({full_url})")
-                        else:
-                            result.append(f"{indent}[URL]({full_url})")
-                    else:
-                        for child in node.children:
-                            result.extend(recurse(child, level + 1))
-                elif isinstance(node, str) and node.strip():
-                    text = node.strip()
-                    if text and not text.startswith("//<![CDATA[") and not text.endswith("//]]>"):
-                        result.append(f"{indent}{text}")
-                
-                return result
+    async def new_read(client, url):
+        page = await fetch_page(client, url, {}, httpx.Timeout(10), read_config)
+        return page.body.decode(page.encoding, errors="replace")
 
-            extracted_info = recurse(soup.html.body if soup.html and soup.html.body else soup.html)
-            return "\n".join(extracted_info)
-        except httpx.RequestError as e:
-            print(f"请求发生错误：{e}")
-            return f"请求发生错误：{e}"
+    read_config = get_html_read_config(None)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        for name, path in (("20 MiB 页面", "/plain"), (f"gzip 炸弹（{len(bomb) // 1024} KiB → 200 MiB）", "/bomb")):
+            for label, read in (("整页读取", old_read), ("fetch_page", new_read)):
+                tracemalloc.start()
+                started = time.perf_counter()
+                text = await read(client, f"https://bench.test{path}")
+                elapsed = time.perf_counter() - started
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f"{name} {label}: {elapsed * 1000:.0f}ms，峰值内存 {peak / 1024 / 1024:.1f} MiB，"
+                      f"得到 {len(text)} 字符")
+                del text
 
 async def main():
     while True:
@@ -268,4 +372,5 @@ async def main():
             print(f"发生错误：{e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import sys
+    asyncio.run(benchmark() if "--bench" in sys.argv[1:] else main())
@@ -0,0 +1,186 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认执行器配置，可在 config/api.yaml 的 executors 中覆盖
+DEFAULT_EXECUTOR_CONFIG = {
+    "thread_workers": 8,  # 释放 GIL 的工作（图片解码、lxml 解析、大块 base64）
+    "process_workers": 2,  # 纯 Python 的 HTML 解析；0 表示不使用进程池，改用线程池
+    "lag_interval": 0.5,  # 事件循环延迟采样间隔（秒）
+    "lag_warn_ms": 100,  # 延迟超过该值时记录警告
+}
+
+class ExecutorPool:
+    """
+    CPU 密集工作的执行器：线程池处理会释放 GIL 的工作，进程池处理纯 Python 解析。
+
+    进程池按需创建，不可用（例如子进程崩溃）时回退到线程池。
+    """
+
+    def __init__(self):
+        self.config = dict(DEFAULT_EXECUTOR_CONFIG)
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._processes_broken = False
+
+    def configure(self, config):
+        self.config = dict(DEFAULT_EXECUTOR_CONFIG)
+        self.config.update(config.api.get("executors") or {})
+
+    @property
+    def threads(self) -> ThreadPoolExecutor:
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(max_workers=self.config["thread_workers"], thread_name_prefix="cpu")
+        return self._threads
+
+    @property
+    def processes(self) -> Optional[ProcessPoolExecutor]:
+        if self._processes is None and not self._processes_broken and self.config["process_workers"] > 0:
+            self._processes = ProcessPoolExecutor(max_workers=self.config["process_workers"])
+            logger.info(f"已创建解析进程池 ({self.config['process_workers']} 个进程)")
+        return self._processes
+
+    async def run_in_thread(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.threads, functools.partial(func, *args, **kwargs))
+
+    async def run_in_process(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        在进程池中执行 func，func 和参数必须可 pickle（模块级函数）。
+
+        未启用进程池或进程池损坏时在线程池中执行。
+        """
+        processes = self.processes
+        if processes is None:
+            return await self.run_in_thread(func, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(processes, functools.partial(func, *args, **kwargs))
+        except BrokenProcessPool:
+            logger.error("解析进程池已损坏，改用线程池")
+            self._processes_broken = True
+            self._processes = None
+            return await self.run_in_thread(func, *args, **kwargs)
+
+    def shutdown(self):
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+            self._processes = None
+        if self._threads is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+            self._threads = None
+
+class LoopLagMonitor:
+    """周期性 sleep 并测量实际唤醒延迟，反映事件循环被阻塞的程度"""
+
+    def __init__(self, interval: float = 0.5, warn_ms: float = 100, window: int = 120):
+        self.interval = interval
+        self.warn_ms = warn_ms
+        self.samples: deque = deque(maxlen=window)
+        self.max_ms = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag_ms = max((time.perf_counter() - started - self.interval) * 1000, 0.0)
+            self.samples.append(lag_ms)
+            self.max_ms = max(self.max_ms, lag_ms)
+            if lag_ms > self.warn_ms:
+                logger.warning(f"事件循环阻塞 {lag_ms:.1f}ms")
+
+    def stats(self) -> Dict[str, float]:
+        if not self.samples:
+            return {"samples": 0}
+        ordered = sorted(self.samples)
+        return {
+            "samples": len(ordered),
+            "avg_ms": round(sum(ordered) / len(ordered), 2),
+            "p99_ms": round(ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)], 2),
+            "recent_max_ms": round(ordered[-1], 2),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+# 全局执行器和事件循环延迟监控
+executors = ExecutorPool()
+loop_lag = LoopLagMonitor()
+
+def setup_executors(config):
+    """按配置初始化执行器，并在当前事件循环中启动延迟监控"""
+    executors.configure(config)
+    loop_lag.interval = executors.config["lag_interval"]
+    loop_lag.warn_ms = executors.config["lag_warn_ms"]
+    loop_lag.start()
+
+async def shutdown_executors():
+    await loop_lag.stop()
+    executors.shutdown()
+
+async def run_in_thread(func: Callable, *args, **kwargs) -> Any:
+    return await executors.run_in_thread(func, *args, **kwargs)
+
+async def run_in_process(func: Callable, *args, **kwargs) -> Any:
+    return await executors.run_in_process(func, *args, **kwargs)
+
+async def main():
+    """
+    测量 HTML 解析对事件循环的影响：同一批解析分别直接在事件循环中执行、放到线程池和进程池，
+    对比 LoopLagMonitor 采到的唤醒延迟。
+    """
+    from html_extract import html_to_markdown
+
+    blocks = "".join(f"<div><h2>第{i}节</h2><p>段落内容 {i} " + "文本" * 40 + f"<a href='/p/{i}'>链接{i}</a></p></div>"
+                     for i in range(3000))
+    page = f"<html><body>{blocks}</body></html>"
+    jobs = 8
+
+    async def inline(html: str) -> str:
+        return html_to_markdown(html, "https://bench.test/", "bs4")
+
+    async def in_thread(html: str) -> str:
+        return await run_in_thread(html_to_markdown, html, "https://bench.test/", "bs4")
+
+    async def in_process(html: str) -> str:
+        return await run_in_process(html_to_markdown, html, "https://bench.test/", "bs4")
+
+    executors.config["process_workers"] = 2
+    await in_process("<html><body>预热</body></html>")  # 进程启动不计入测量
+    print(f"页面 {len(page) // 1024} KiB，并发解析 {jobs} 次，采样间隔 10ms")
+    for label, parse in (("事件循环内解析（改动前）", inline), ("线程池", in_thread), ("进程池（改动后）", in_process)):
+        monitor = LoopLagMonitor(interval=0.01, warn_ms=float("inf"), window=100000)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        await asyncio.gather(*(parse(page) for _ in range(jobs)))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+        stats = monitor.stats()
+        print(f"{label}: 总耗时 {elapsed * 1000:.0f}ms，采样 {stats['samples']} 次，平均延迟 {stats['avg_ms']}ms，"
+              f"p99 {stats['p99_ms']}ms，最大 {stats['max_ms']}ms")
+    executors.shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,8 +4,11 @@ from typing import List, Dict, Any, Callable
 from multimodal_classes import Text, Image, CustomFile
 import random
 from engine_search import *
+from log_utils import LazyText
+from tool_cache import get_tool_cache
+from search_federation import SearchFederation
+from command_runner import LiveOutput, get_command_config, run_shell
 import platform
-import subprocess
 
 system = platform.system()
 
@@ -39,26 +42,17 @@ async def calculate(config, *args, client_id: str, send_message: Callable, **kwa
     except Exception as e:
         return {"error": f"计算错误: {str(e)}"}
     
+async def _search(query: str, config) -> str:
+    return await SearchFederation.from_config(config).search(query)
+
 async def search_net(config, *args, client_id: str, send_message: Callable, **kwargs) -> Dict[str, Any]:
     """计算数学表达式的结果"""
     query = kwargs.get("query") if kwargs else args[0]["query"] if args else None
     if not query:
         return {"error": "缺少query参数"}
     try:
-        final = ''
-        functions = [
-            baidu_search(query),
-            searx_search(query)
-        ]
-        tasks = [asyncio.create_task(func) for func in functions]
-        for future in asyncio.as_completed(tasks):
-            try:
-                result = await future
-                if result:
-                    final += result + '\n'
-            except Exception as e:
-                print(e)
-        print(final)
+        final = await get_tool_cache(config).get_or_call("search_net", {"query": query}, lambda: _search(query, config))
+        logger.debug("搜索结果: %s", LazyText(final))
         await send_message(client_id, [Text(f"搜索结果: {final}")])
         return {"result": final}
     except Exception as e:
@@ -70,47 +64,36 @@ async def read_html(config, *args, client_id: str, send_message: Callable, **kwa
     if not url:
         return {"error": "缺少url参数"}
     try:
-        html = await html_read(url,config)
+        html = await get_tool_cache(config).get_or_call(
+            "read_html", {"url": url}, lambda: html_read(url, config),
+            cacheable=lambda text: not text.startswith(("请求发生错误", "未找到<html>标签")))
         await send_message(client_id, [Text(f"HTML内容: {html}")])
         return {"result": html}
     except Exception as e:
         return {"error": f"读取HTML错误: {str(e)}"}
     
 async def run_command(config, *args, client_id: str, send_message: Callable, **kwargs) -> Dict[str, Any]:
-    """读取HTML文件内容"""
+    """执行命令行命令，输出有时间和长度上限"""
     command = kwargs.get("command") if kwargs else args[0]["command"] if args else None
     if not command:
         return {"error": "缺少command参数"}
+    command_config = get_command_config(config)
+    live = None
+    if command_config["stream_to_client"]:
+        live = LiveOutput(lambda text: send_message(client_id, [Text(text)]),
+                          command_config["stream_interval"], command_config["max_output_bytes"])
     try:
-        logs = ""
-        try:
-            process = await asyncio.create_subprocess_shell(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            read_stdout_task = asyncio.create_task(process.stdout.readline())
-            read_stderr_task = asyncio.create_task(process.stderr.readline())
-            while not process.stdout.at_eof() or not process.stderr.at_eof():
-                done, pending = await asyncio.wait(
-                    [read_stdout_task, read_stderr_task],
-                    return_when=asyncio.FIRST_COMPLETED
-                )
-                for task in done:
-                    line = task.result().decode('utf-8').strip()
-                    if line:
-                        logs += line + "\n"
-                        print(f"[LOG] {line}")
-                if not process.stdout.at_eof():
-                    read_stdout_task = asyncio.create_task(process.stdout.readline())
-                if not process.stderr.at_eof():
-                    read_stderr_task = asyncio.create_task(process.stderr.readline())
-            await process.wait()
-        except Exception as e:
-            logs += f"Error: {str(e)}\n"
-        return {"result": f"命令执行日志{logs}"}
+        result = await run_shell(command, command_config["timeout"], command_config["max_output_bytes"],
+                                 command_config["head_ratio"], command_config["read_chunk"],
+                                 on_output=live.write if live else None)
+        if live:
+            await live.flush()
     except Exception as e:
-        return {"error": f"读取HTML错误: {str(e)}"}
+        return {"error": f"命令执行错误: {str(e)}"}
+    logger.info(f"命令执行完成 ({result.elapsed:.1f}s, 退出码 {result.returncode}, 输出 {result.total_bytes} 字节): {command}")
+    logger.debug("[LOG] %s", LazyText(result.output))
+    status = f"命令超过 {command_config['timeout']} 秒未结束，已终止" if result.timed_out else f"退出码: {result.returncode}"
+    return {"result": f"命令执行日志\n{result.output}\n{status}"}
 
 # 函数映射表
 AVAILABLE_FUNCTIONS = {
@@ -121,29 +104,31 @@ AVAILABLE_FUNCTIONS = {
     "run_command": run_command,
 }
 
+async def run_function_call(function_call: Dict[str, Any], config, client_id: str, send_message: Callable) -> Dict[str, Any]:
+    """执行单个函数调用，返回 functionResponse 部分；函数内部异常转换为 error 结果"""
+    func_name = function_call.get("name")
+    args = function_call.get("args") or {}
+    logger.info(f"处理函数调用: {func_name}，参数: {args}")
+    if func_name not in AVAILABLE_FUNCTIONS:
+        result = {"error": f"未知函数: {func_name}"}
+    else:
+        try:
+            result = await AVAILABLE_FUNCTIONS[func_name](config, client_id=client_id, send_message=send_message, **args)
+        except Exception as e:
+            logger.error(f"函数 {func_name} 执行错误: {str(e)}")
+            result = {"error": f"函数执行错误: {str(e)}"}
+    return {
+        "functionResponse": {
+            "name": func_name,
+            "response": result
+        }
+    }
+
 async def handle_function_calls(function_calls: List[Dict[str, Any]], config, client_id: str, send_message: Callable) -> List[Dict[str, Any]]:
     """并行处理多个函数调用"""
-    tasks = []
-    for function_call in function_calls:
-        func_name = function_call.get("name")
-        args = function_call.get("args", {})
-        logger.info(f"处理函数调用: {func_name}，参数: {args}")
-
-        if func_name not in AVAILABLE_FUNCTIONS:
-            tasks.append(asyncio.ensure_future(asyncio.sleep(0, result={"error": f"未知函数: {func_name}"})))
-        else:
-            tasks.append(asyncio.ensure_future(AVAILABLE_FUNCTIONS[func_name](config, client_id=client_id, send_message=send_message, **args)))
-
-    results = await asyncio.gather(*tasks)
-    return [
-        {
-            "functionResponse": {
-                "name": function_call["name"],
-                "response": result
-            }
-        }
-        for function_call, result in zip(function_calls, results)
-    ]
+    return list(await asyncio.gather(*(
+        run_function_call(function_call, config, client_id, send_message) for function_call in function_calls
+    )))
 
 TOOLS = [
     {
@@ -0,0 +1,346 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认存储配置，可在 config/api.yaml 的 history_store 中覆盖
+DEFAULT_STORE_CONFIG = {
+    "backend": "sqlite",
+    "path": "data/history.db",
+    "compact_every": 200,
+}
+
+class HistoryStore:
+    """对话历史存储接口，所有方法都是协程，实现需自行避免阻塞事件循环"""
+
+    async def load(self, user_id: str) -> Tuple[List[Dict[str, Any]], Dict[str, str], int]:
+        """
+        读取会话。
+
+        :return: (历史消息, 摘要缓存, 第一条消息的序号)
+        """
+        return [], {}, 0
+
+    async def save(self, user_id: str, history: List[Dict[str, Any]], summary_cache: Dict[str, str],
+                   first_seq: int, persisted: int, dirty: Iterable[int]) -> Optional[float]:
+        """
+        增量保存会话：删除 first_seq 之前的消息，重写 dirty 中的下标，追加 persisted 之后的新消息。
+
+        :param first_seq: history[0] 对应的序号
+        :param persisted: history 中已经写入存储且未被修改的前缀长度
+        :param dirty: 需要重写的消息下标（小于 persisted）
+        :return: 保存后的会话版本，见 revision()
+        """
+
+    async def revision(self, user_id: str) -> Optional[float]:
+        """会话在存储中的版本，其他进程写入后会变化；不在进程间共享的存储返回 None"""
+        return None
+
+    async def acquire_lease(self, user_id: str, owner: str, ttl: float) -> bool:
+        """尝试获得会话的跨进程租约，已被其他 owner 持有且未过期时返回 False"""
+        return True
+
+    async def release_lease(self, user_id: str, owner: str):
+        pass
+
+    async def clear(self, user_id: str):
+        pass
+
+    async def close(self):
+        pass
+
+class MemoryHistoryStore(HistoryStore):
+    """不做持久化，重启后历史丢失（与旧版行为一致）"""
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    SQLite (WAL) 存储。消息按 (user_id, seq) 追加写入，
+    内联媒体按内容 SHA-256 去重后单独存放在 blobs 表中。
+
+    多个 worker 进程可以共享同一个数据库：sessions.updated_at 作为会话版本，
+    leases 表保证同一会话同时只有一个进程在执行对话轮次。
+    """
+
+    def __init__(self, path: str, compact_every: int = 200):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.path = path
+        self.compact_every = compact_every
+        self._saves = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        os.chmod(path, 0o600)  # 包含所有用户的对话，只允许运行服务的用户读写（WAL 文件沿用该权限）
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")  # 其他进程写入时等待而不是报错
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                user_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                parts TEXT NOT NULL,
+                PRIMARY KEY (user_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                mime_type TEXT NOT NULL,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS message_blobs (
+                user_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS message_blobs_seq ON message_blobs (user_id, seq);
+            CREATE INDEX IF NOT EXISTS message_blobs_hash ON message_blobs (hash);
+            CREATE TABLE IF NOT EXISTS leases (
+                user_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        """)
+        logger.info(f"对话历史存储: SQLite {path}")
+
+    # 媒体外置
+    def _externalize(self, parts: List[Dict[str, Any]]) -> Tuple[str, List[Tuple[str, str, bytes]]]:
+        blobs = []
+        stored = []
+        for part in parts:
+            if "inline_data" in part and "data" in part["inline_data"]:
+                raw = base64.b64decode(part["inline_data"]["data"])
+                digest = hashlib.sha256(raw).hexdigest()
+                mime_type = part["inline_data"].get("mime_type", "application/octet-stream")
+                blobs.append((digest, mime_type, raw))
+                stored.append({"inline_data": {"mime_type": mime_type, "blob": digest}})
+            elif "image_url" in part and part["image_url"].get("url", "").startswith("data:"):
+                header, _, data = part["image_url"]["url"].partition(",")
+                raw = base64.b64decode(data)
+                digest = hashlib.sha256(raw).hexdigest()
+                mime_type = header[5:].split(";")[0]
+                blobs.append((digest, mime_type, raw))
+                stored.append({"image_url": {"blob": digest, "mime_type": mime_type}})
+            else:
+                stored.append(part)
+        return json.dumps(stored, ensure_ascii=False), blobs
+
+    def _internalize(self, parts: List[Dict[str, Any]], blob_cache: Dict[str, bytes]) -> List[Dict[str, Any]]:
+        restored = []
+        for part in parts:
+            if "inline_data" in part and "blob" in part["inline_data"]:
+                data = base64.b64encode(self._get_blob(part["inline_data"]["blob"], blob_cache)).decode("utf-8")
+                restored.append({"inline_data": {"mime_type": part["inline_data"]["mime_type"], "data": data}})
+            elif "image_url" in part and "blob" in part["image_url"]:
+                data = base64.b64encode(self._get_blob(part["image_url"]["blob"], blob_cache)).decode("utf-8")
+                restored.append({"image_url": {"url": f"data:{part['image_url']['mime_type']};base64,{data}"}})
+            else:
+                restored.append(part)
+        return restored
+
+    def _get_blob(self, digest: str, blob_cache: Dict[str, bytes]) -> bytes:
+        if digest not in blob_cache:
+            row = self._conn.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+            blob_cache[digest] = row[0] if row else b""
+        return blob_cache[digest]
+
+    # 同步实现，在线程中执行
+    def _load(self, user_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            summary_cache = {"summary": row[0]} if row and row[0] else {}
+            rows = self._conn.execute(
+                "SELECT seq, role, parts FROM messages WHERE user_id = ? ORDER BY seq", (user_id,)
+            ).fetchall()
+            blob_cache: Dict[str, bytes] = {}
+            history = [{"role": role, "parts": self._internalize(json.loads(parts), blob_cache)} for _, role, parts in rows]
+            first_seq = rows[0][0] if rows else 0
+        return history, summary_cache, first_seq
+
+    def _write_message(self, user_id: str, seq: int, message: Dict[str, Any]):
+        parts_json, blobs = self._externalize(message.get("parts", []))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO messages (user_id, seq, role, parts) VALUES (?, ?, ?, ?)",
+            (user_id, seq, message.get("role", "user"), parts_json),
+        )
+        self._conn.execute("DELETE FROM message_blobs WHERE user_id = ? AND seq = ?", (user_id, seq))
+        for digest, mime_type, raw in blobs:
+            self._conn.execute("INSERT OR IGNORE INTO blobs (hash, mime_type, data) VALUES (?, ?, ?)", (digest, mime_type, raw))
+            self._conn.execute("INSERT INTO message_blobs (user_id, seq, hash) VALUES (?, ?, ?)", (user_id, seq, digest))
+
+    def _save(self, user_id: str, history, summary_cache, first_seq: int, persisted: int, dirty) -> float:
+        revision = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO sessions (user_id, summary, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at",
+                    (user_id, summary_cache.get("summary", ""), revision),
+                )
+                self._conn.execute("DELETE FROM messages WHERE user_id = ? AND (seq < ? OR seq >= ?)",
+                                   (user_id, first_seq, first_seq + len(history)))
+                self._conn.execute("DELETE FROM message_blobs WHERE user_id = ? AND (seq < ? OR seq >= ?)",
+                                   (user_id, first_seq, first_seq + len(history)))
+                for index in sorted(set(dirty)):
+                    if index < persisted:
+                        self._write_message(user_id, first_seq + index, history[index])
+                for index in range(persisted, len(history)):
+                    self._write_message(user_id, first_seq + index, history[index])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._saves += 1
+            if self.compact_every and self._saves % self.compact_every == 0:
+                self._compact()
+        return revision
+
+    def _revision(self, user_id: str) -> float:
+        with self._lock:
+            row = self._conn.execute("SELECT updated_at FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0.0
+
+    def _acquire_lease(self, user_id: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # 单条语句是原子的：没有租约、租约已过期或本来就属于 owner 时写入
+            self._conn.execute(
+                "INSERT INTO leases (user_id, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+                (user_id, owner, now + ttl, now),
+            )
+            row = self._conn.execute("SELECT owner FROM leases WHERE user_id = ?", (user_id,)).fetchone()
+        return bool(row) and row[0] == owner
+
+    def _release_lease(self, user_id: str, owner: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE user_id = ? AND owner = ?", (user_id, owner))
+
+    def _compact(self):
+        """删除不再被引用的媒体并截断 WAL"""
+        removed = self._conn.execute(
+            "DELETE FROM blobs WHERE hash NOT IN (SELECT DISTINCT hash FROM message_blobs)"
+        ).rowcount
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info(f"对话历史存储压缩完成，清理媒体 {removed} 个")
+
+    def _clear(self, user_id: str):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM message_blobs WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+            self._conn.execute("COMMIT")
+
+    async def load(self, user_id: str):
+        return await asyncio.to_thread(self._load, user_id)
+
+    async def save(self, user_id, history, summary_cache, first_seq, persisted, dirty):
+        # 在事件循环中拷贝外层结构，避免线程写入期间列表被修改
+        snapshot = [{"role": message.get("role"), "parts": list(message.get("parts", []))} for message in history]
+        return await asyncio.to_thread(self._save, user_id, snapshot, dict(summary_cache), first_seq, persisted, list(dirty))
+
+    async def revision(self, user_id: str) -> float:
+        return await asyncio.to_thread(self._revision, user_id)
+
+    async def acquire_lease(self, user_id: str, owner: str, ttl: float) -> bool:
+        return await asyncio.to_thread(self._acquire_lease, user_id, owner, ttl)
+
+    async def release_lease(self, user_id: str, owner: str):
+        await asyncio.to_thread(self._release_lease, user_id, owner)
+
+    async def clear(self, user_id: str):
+        await asyncio.to_thread(self._clear, user_id)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+# 可选后端
+HISTORY_BACKENDS = {
+    "sqlite": lambda store_config: SQLiteHistoryStore(store_config["path"], store_config["compact_every"]),
+    "memory": lambda store_config: MemoryHistoryStore(),
+}
+
+def create_history_store(config) -> HistoryStore:
+    store_config = dict(DEFAULT_STORE_CONFIG)
+    store_config.update(config.api.get("history_store") or {})
+    backend = store_config["backend"]
+    if backend not in HISTORY_BACKENDS:
+        raise ValueError(f"未知的对话历史存储后端: {backend}")
+    return HISTORY_BACKENDS[backend](store_config)
+
+# 基准测试：10k 个会话时追加一轮对话的延迟，以及重启后首次加载会话（冷加载）的耗时
+async def main():
+    import random
+    import tempfile
+
+    sessions, messages_per_session, samples = 10000, 20, 1000
+    image = base64.b64encode(os.urandom(64 * 1024)).decode("utf-8")  # 每 10 个会话中有一个发过同一张图片
+
+    def turn(index: int) -> List[Dict[str, Any]]:
+        return [{"role": "user", "parts": [{"text": f"第 {index} 个问题，" + "内容" * 50}]},
+                {"role": "model", "parts": [{"text": f"第 {index} 个回答，" + "回复" * 200}]}]
+
+    def percentiles(latencies: List[float]) -> str:
+        latencies = sorted(latencies)
+        return ", ".join(f"p{int(q * 100)} {latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000:.2f}ms"
+                         for q in (0.5, 0.95, 0.99))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.db")
+        store = SQLiteHistoryStore(path, compact_every=0)
+        started = time.perf_counter()
+        histories: Dict[str, List[Dict[str, Any]]] = {}
+        for index in range(sessions):
+            history = [message for turn_index in range(messages_per_session // 2) for message in turn(turn_index)]
+            if index % 10 == 0:
+                history[0]["parts"].append({"inline_data": {"mime_type": "image/png", "data": image}})
+            histories[f"user-{index}"] = history
+            store._save(f"user-{index}", history, {}, 0, 0, [])
+        print(f"写入 {sessions} 个会话（每个 {messages_per_session} 条消息）: {time.perf_counter() - started:.1f}s，"
+              f"数据库 {os.path.getsize(path) / 1024 / 1024:.0f}MiB，"
+              f"去重后媒体 {store._conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]} 个")
+
+        rng = random.Random(0)
+        latencies = []
+        for sample in range(samples):
+            user_id = f"user-{rng.randrange(sessions)}"
+            history = histories[user_id]
+            persisted = len(history)
+            history.extend(turn(messages_per_session + sample))
+            started = time.perf_counter()
+            await store.save(user_id, history, {}, 0, persisted, [])
+            latencies.append(time.perf_counter() - started)
+        print(f"追加一轮对话（{samples} 次）: {percentiles(latencies)}")
+        await store.close()
+
+        started = time.perf_counter()
+        store = SQLiteHistoryStore(path, compact_every=0)
+        print(f"重启后打开存储: {(time.perf_counter() - started) * 1000:.1f}ms（会话按需加载，不随会话数增长）")
+        latencies = []
+        for user_id in rng.sample(sorted(histories), samples):
+            started = time.perf_counter()
+            history, _, _ = await store.load(user_id)
+            latencies.append(time.perf_counter() - started)
+            assert len(history) == len(histories[user_id])
+        print(f"冷加载单个会话（{samples} 次，操作系统页缓存未清空）: {percentiles(latencies)}")
+        await store.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
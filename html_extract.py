@@ -0,0 +1,310 @@
+import re
+from typing import Callable, Dict, Iterator, List
+from urllib.parse import urljoin
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    import lxml.etree
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+# 以链接形式输出、不再展开子节点的标签及其 URL 属性
+URL_ATTRIBUTES = {
+    'a': 'href',
+    'img': 'src',
+    'link': 'href',
+    'iframe': 'src',
+}
+SKIP_TAGS = ('script', 'style')
+CODE_TAGS = ('pre', 'code')
+NO_HTML_MESSAGE = "未找到<html>标签，请确认网页内容是否正确加载。"
+TRUNCATED_MESSAGE = "...(页面内容过长，后续内容已省略)"
+
+_HTML_TAG = re.compile(r'<html[\s>]', re.IGNORECASE)
+
+class NoHTMLError(ValueError):
+    """页面中没有 <html> 标签"""
+
+def default_engine() -> str:
+    return "lxml" if LXML_AVAILABLE else "bs4"
+
+def _url_joiner(base_url: str) -> Callable[[str], str]:
+    """同一页面中重复出现的链接只做一次 urljoin"""
+    joined: Dict[str, str] = {}
+
+    def join(value: str) -> str:
+        full_url = joined.get(value)
+        if full_url is None:
+            full_url = joined[value] = urljoin(base_url, value)
+        return full_url
+    return join
+
+def _text_line(text: str, level: int):
+    text = text.strip()
+    if text and not text.startswith("//<![CDATA[") and not text.endswith("//]]>"):
+        return f"{'  ' * level}{text}"
+    return None
+
+def _code_block(lines: List[str], level: int) -> str:
+    indent = '  ' * level
+    formatted_code = "\n".join(f"{indent}{line}" for line in lines if line.strip())
+    return f"{indent}```yaml\n{formatted_code}\n{indent}```"
+
+def _link_line(value: str, label: str, join: Callable[[str], str], level: int) -> str:
+    return f"{'  ' * level}[{label}]({join(value)})"
+
+# BeautifulSoup (html.parser) 实现，未安装 lxml 时使用
+def _iter_bs4(html: str, base_url: str) -> Iterator[str]:
+    soup = BeautifulSoup(html, 'html.parser')
+    if not soup.html:
+        raise NoHTMLError(NO_HTML_MESSAGE)
+    for script_or_style in soup(list(SKIP_TAGS)):
+        script_or_style.decompose()
+    join = _url_joiner(base_url)
+
+    root = soup.html.body if soup.html.body else soup.html
+    stack = [(root, 0)]
+    while stack:
+        node, level = stack.pop()
+        if isinstance(node, str):
+            line = _text_line(node, level)
+            if line is not None:
+                yield line
+            continue
+        tag_name = node.name.lower()
+        if tag_name in SKIP_TAGS:
+            continue
+        if tag_name in CODE_TAGS:
+            spans = node.find_all('span', recursive=False)
+            if spans:
+                lines = [''.join(part.get_text() if hasattr(part, "get_text") else str(part) for part in span.contents)
+                         for span in spans]
+            else:
+                lines = node.get_text().split('\n')
+            yield _code_block(lines, level)
+            continue
+        if tag_name in URL_ATTRIBUTES:
+            value = node.get(URL_ATTRIBUTES[tag_name], '')
+            if tag_name == 'a' and value.lower().startswith('javascript:'):
+                continue
+            if tag_name == 'a':
+                img_tag = node.find('img')
+                label = img_tag.get('alt', 'No description') if img_tag else ' '.join(node.stripped_strings)
+            elif tag_name == 'img':
+                label = node.get('alt', 'No description')
+            else:
+                label = 'URL'
+            yield _link_line(value, label, join, level)
+            continue
+        stack.extend((child, level + 1) for child in reversed(node.contents))
+
+# lxml 实现：C 解析器，逐节点输出
+def _iter_lxml(html: str, base_url: str) -> Iterator[str]:
+    if not _HTML_TAG.search(html):
+        raise NoHTMLError(NO_HTML_MESSAGE)
+    # huge_tree 放宽 libxml2 默认 256 层的嵌套限制；解析器不能跨线程共享，每次新建
+    parser = lxml.html.HTMLParser(huge_tree=True)
+    try:
+        document = lxml.html.document_fromstring(html, parser=parser)
+    except ValueError:
+        # 带 XML 编码声明的字符串需要以字节形式解析
+        parser = lxml.html.HTMLParser(huge_tree=True, encoding='utf-8')
+        document = lxml.html.document_fromstring(html.encode('utf-8'), parser=parser)
+    if any(error.type_name == 'ERR_RESOURCE_LIMIT' for error in parser.error_log):
+        # 开启 huge_tree 后 libxml2 仍限制 2048 层嵌套，更深的内容会被丢弃，改用 html.parser
+        yield from _iter_bs4(html, base_url)
+        return
+    lxml.etree.strip_elements(document, *SKIP_TAGS, with_tail=False)
+    join = _url_joiner(base_url)
+
+    body = document.find('body')
+    root = body if body is not None else document
+    # 栈中的字符串是文本节点（元素的 text 或子元素的 tail），与 BeautifulSoup 的节点顺序一致
+    stack = [(root, 0)]
+    while stack:
+        node, level = stack.pop()
+        if isinstance(node, str):
+            line = _text_line(node, level)
+            if line is not None:
+                yield line
+            continue
+        tag = node.tag
+        if not isinstance(tag, str):
+            # 注释在 html.parser 中也是文本节点
+            if tag is lxml.etree.Comment and node.text:
+                line = _text_line(node.text, level)
+                if line is not None:
+                    yield line
+            continue
+        tag_name = tag.lower()
+        if tag_name in CODE_TAGS:
+            spans = [child for child in node if child.tag == 'span']
+            if spans:
+                lines = [''.join(span.itertext()) for span in spans]
+            else:
+                lines = node.text_content().split('\n')
+            yield _code_block(lines, level)
+            continue
+        if tag_name in URL_ATTRIBUTES:
+            value = node.get(URL_ATTRIBUTES[tag_name], '')
+            if tag_name == 'a' and value.lower().startswith('javascript:'):
+                continue
+            if tag_name == 'a':
+                img_tag = node.find('.//img')
+                if img_tag is not None:
+                    label = img_tag.get('alt', 'No description')
+                else:
+                    label = ' '.join(text.strip() for text in node.itertext() if text.strip())
+            elif tag_name == 'img':
+                label = node.get('alt', 'No description')
+            else:
+                label = 'URL'
+            yield _link_line(value, label, join, level)
+            continue
+        child_level = level + 1
+        children = []
+        if node.text:
+            children.append((node.text, child_level))
+        for child in node:
+            children.append((child, child_level))
+            if child.tail:
+                children.append((child.tail, child_level))
+        stack.extend(reversed(children))
+
+ENGINES = {
+    "bs4": _iter_bs4,
+    "lxml": _iter_lxml,
+}
+
+def iter_markdown(html: str, base_url: str, engine: str = None) -> Iterator[str]:
+    """
+    把 HTML 转成带缩进的 markdown 行，逐行产出。
+
+    :param engine: "lxml" 或 "bs4"，默认优先使用 lxml
+    :raises NoHTMLError: 页面中没有 <html> 标签
+    """
+    engine = engine or default_engine()
+    if engine == "lxml" and not LXML_AVAILABLE:
+        engine = "bs4"
+    return ENGINES[engine](html, base_url)
+
+def html_to_markdown(html: str, base_url: str, engine: str = None, max_chars: int = None) -> str:
+    """
+    把 HTML 转成 markdown 文本。
+
+    :param max_chars: 输出达到该字符数后停止遍历并注明已截断，None 表示不限制
+    """
+    if max_chars is None:
+        return "\n".join(iter_markdown(html, base_url, engine))
+    lines = []
+    total = 0
+    for line in iter_markdown(html, base_url, engine):
+        lines.append(line)
+        total += len(line) + 1
+        if total >= max_chars:
+            lines.append(TRUNCATED_MESSAGE)
+            break
+    return "\n".join(lines)
+
+# 旧版 html_read 中的递归实现，只用于基准测试和对比测试；嵌套过深的页面会触发 RecursionError
+def _recursive_markdown(html: str, base_url: str) -> str:
+    soup = BeautifulSoup(html, 'html.parser')
+    if not soup.html:
+        raise NoHTMLError(NO_HTML_MESSAGE)
+    for script_or_style in soup(['script', 'style']):
+        script_or_style.decompose()
+
+    def recurse(node, level=0):
+        indent = '  ' * level
+        result = []
+        if hasattr(node, 'name') and node.name is not None:
+            tag_name = node.name.lower()
+            if tag_name in ['script', 'style']:
+                return result
+            if tag_name == 'pre' or tag_name == 'code':
+                all_lines = []
+                spans = node.find_all('span', recursive=False)
+                if spans:
+                    for span in spans:
+                        full_line = ''.join(part.get_text() if hasattr(part, "get_text") else str(part) for part in span.contents)
+                        if full_line.strip() or (full_line and not full_line.isspace()):
+                            all_lines.append(full_line)
+                else:
+                    for line in node.get_text().split('\n'):
+                        if line.strip() or (line and not line.isspace()):
+                            all_lines.append(line)
+                formatted_code = "\n".join([f"{indent}{line}" for line in all_lines])
+                result.append(f"{indent}```yaml\n{formatted_code}\n{indent}```")
+                return result
+            if tag_name in URL_ATTRIBUTES:
+                url_attr_value = node.get(URL_ATTRIBUTES[tag_name], '')
+                if tag_name == 'a' and url_attr_value.lower().startswith('javascript:'):
+                    return result
+                full_url = urljoin(base_url, url_attr_value)
+                if tag_name == 'a':
+                    img_tag = node.find('img')
+                    if img_tag:
+                        result.append(f"{indent}[{img_tag.get('alt', 'No description')}]({full_url})")
+                    else:
+                        result.append(f"{indent}[{' '.join(node.stripped_strings)}]({full_url})")
+                elif tag_name == 'img':
+                    result.append(f"{indent}[{node.get('alt', 'No description')}]({full_url})")
+                else:
+                    result.append(f"{indent}[URL]({full_url})")
+            else:
+                for child in node.children:
+                    result.extend(recurse(child, level + 1))
+        elif isinstance(node, str) and node.strip():
+            text = node.strip()
+            if text and not text.startswith("//<![CDATA[") and not text.endswith("//]]>"):
+                result.append(f"{indent}{text}")
+        return result
+
+    return "\n".join(recurse(soup.html.body if soup.html and soup.html.body else soup.html))
+
+def nested_page(depth: int) -> str:
+    """嵌套 depth 层 <div> 的页面，每层带一段文本和一个链接"""
+    opening = "".join(f"<div>第{level}层<a href='/level/{level}'>链接{level}</a>" for level in range(depth))
+    return f"<html><body>{opening}最深处{'</div>' * depth}</body></html>"
+
+# 基准测试：tests/fixtures/html 中的页面、正文重复 200 次的长页面和深层嵌套的页面，取 3 次中最快的一次
+def main():
+    import os
+    import time
+
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "fixtures", "html")
+    corpus = {}
+    for name in sorted(os.listdir(fixtures)):
+        with open(os.path.join(fixtures, name), encoding="utf-8") as f:
+            html = f.read()
+        corpus[name] = html
+        # 正文重复 200 次，模拟长文档
+        head, _, rest = html.partition("<body>")
+        body, _, tail = rest.partition("</body>")
+        if body:
+            corpus[f"{name} x200"] = f"{head}<body>{body * 200}</body>{tail}"
+    corpus["嵌套 500 层"] = nested_page(500)
+    corpus["嵌套 5000 层"] = nested_page(5000)
+
+    base_url = "https://example.com/docs/page.html"
+    extractors = {"旧递归实现": _recursive_markdown}
+    extractors.update({f"iterative {engine}": (lambda html, url, engine=engine: html_to_markdown(html, url, engine))
+                       for engine in ENGINES if engine == "bs4" or LXML_AVAILABLE})
+    for label, html in corpus.items():
+        results = []
+        for name, extract in extractors.items():
+            timings = []
+            try:
+                for _ in range(3):
+                    started = time.perf_counter()
+                    extract(html, base_url)
+                    timings.append(time.perf_counter() - started)
+                results.append(f"{name} {min(timings) * 1000:.1f}ms")
+            except RecursionError:
+                results.append(f"{name} RecursionError")
+        print(f"{label} ({len(html) // 1024} KiB): " + "，".join(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+import httpx
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 默认连接池配置，可在 config/api.yaml 的 http_pool 中覆盖
+DEFAULT_POOL_CONFIG = {
+    "http2": True,
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30,
+    "connect_timeout": 10,
+    "read_timeout": 30,
+    "write_timeout": 30,
+    "pool_timeout": 10,
+}
+
+def get_proxy(config) -> Optional[str]:
+    """读取配置中的 http 代理，未配置（或没有 config）时返回 None"""
+    if config is None:
+        return None
+    return config.api["proxy"]["http_proxy"] or None
+
+def get_pool_config(config) -> Dict:
+    pool_config = dict(DEFAULT_POOL_CONFIG)
+    if config is not None:
+        pool_config.update(config.api.get("http_pool") or {})
+    return pool_config
+
+class HTTPClientPool:
+    """按 base_url/代理 组合复用 httpx.AsyncClient，生命周期与应用一致"""
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, Optional[str]], httpx.AsyncClient] = {}
+
+    def get_client(self, config, base_url: str, use_proxy: bool = True) -> httpx.AsyncClient:
+        """
+        获取（必要时创建）对应上游的长连接客户端。
+
+        :param config: 为 None 时使用默认连接池设置且不走代理（例如单独运行 engine_search 时）
+        :param base_url: 上游地址，同一地址共享连接
+        :param use_proxy: 是否走配置中的代理
+        """
+        proxy = get_proxy(config) if use_proxy else None
+        key = (base_url, proxy)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            client = self._create_client(config, proxy)
+            self._clients[key] = client
+            logger.info(f"创建上游连接池: {base_url} (代理: {proxy or '无'})")
+        return client
+
+    def _create_client(self, config, proxy: Optional[str]) -> httpx.AsyncClient:
+        pool_config = get_pool_config(config)
+        http2 = bool(pool_config["http2"])
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("未安装 h2，连接池回退到 HTTP/1.1 (pip install httpx[http2])")
+            http2 = False
+        limits = httpx.Limits(
+            max_connections=pool_config["max_connections"],
+            max_keepalive_connections=pool_config["max_keepalive_connections"],
+            keepalive_expiry=pool_config["keepalive_expiry"],
+        )
+        timeout = httpx.Timeout(
+            connect=pool_config["connect_timeout"],
+            read=pool_config["read_timeout"],
+            write=pool_config["write_timeout"],
+            pool=pool_config["pool_timeout"],
+        )
+        # 代理和连接池设置在 transport 上：httpx 0.28 起 AsyncClient 不再接受 proxies=
+        transport = httpx.AsyncHTTPTransport(http2=http2, limits=limits, proxy=httpx.Proxy(proxy) if proxy else None)
+        return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+    async def aclose(self):
+        """关闭所有客户端，在应用退出时调用"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"关闭连接池失败: {str(e)}")
+        logger.info(f"已关闭 {len(clients)} 个上游连接池")
+
+# 全局连接池
+http_pool = HTTPClientPool()
+
+# 基准测试：本地 keep-alive HTTP 服务，比较每次请求新建客户端与共享连接池的延迟
+async def _serve_bench(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    body = b'{"ok": true}'
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = next((int(line.split(b":", 1)[1]) for line in head.split(b"\r\n")
+                           if line.lower().startswith(b"content-length:")), 0)
+            if length:
+                await reader.readexactly(length)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                         b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def main():
+    import time
+    import types
+
+    server = await asyncio.start_server(_serve_bench, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1beta/models/bench:generateContent"
+    payload = {"contents": [{"role": "user", "parts": [{"text": "你好" * 200}]}]}
+    requests, concurrency = 500, 32
+
+    def percentile(samples: List[float], q: float) -> float:
+        return sorted(samples)[min(int(len(samples) * q), len(samples) - 1)] * 1000
+
+    async def run(label: str, send):
+        latencies: List[float] = []
+        counter = iter(range(requests))
+
+        async def worker():
+            for _ in counter:
+                started = time.perf_counter()
+                response = await send()
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        print(f"{label}: {requests / elapsed:.0f} 请求/秒，p50 {percentile(latencies, 0.5):.2f}ms，"
+              f"p95 {percentile(latencies, 0.95):.2f}ms，p99 {percentile(latencies, 0.99):.2f}ms")
+
+    async def per_request():
+        async with httpx.AsyncClient() as client:
+            return await client.post(url, json=payload)
+
+    pool = HTTPClientPool()
+    config = types.SimpleNamespace(api={"proxy": {"http_proxy": ""}, "http_pool": {"http2": False}})
+    client = pool.get_client(config, url)
+
+    print(f"{requests} 个请求，并发 {concurrency}（本地明文 HTTP，不含 TLS 握手，实际上游的差距更大）")
+    await run("每次请求新建客户端", per_request)
+    await run("共享连接池", lambda: client.post(url, json=payload))
+    await pool.aclose()
+    server.close()
+    await server.wait_closed()
+
+if __name__ == "__main__":
+    asyncio.run(main())
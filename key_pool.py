@@ -0,0 +1,362 @@
+import asyncio
+import email.utils
+import logging
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认 API key 调度配置，可在 config/api.yaml 的 key_pool 中覆盖
+DEFAULT_KEY_POOL_CONFIG = {
+    "rpm": 0,  # 单个 key 每分钟请求数上限，0 表示不限制
+    "tpm": 0,  # 单个 key 每分钟 token 数上限（按请求估算），0 表示不限制
+    "cooldown": 60,  # 429 未给出 Retry-After 时的冷却秒数
+    "max_cooldown": 600,  # 冷却时间上限
+    "max_attempts": 3,  # 一次请求最多尝试几个 key
+    "max_wait": 30,  # 所有 key 都不可用时最多等待的秒数，超过则直接报错
+    "sticky_ttl": 1800,  # 会话固定使用同一个 key 的有效秒数，便于命中上下文缓存
+    "max_sticky_sessions": 10000,
+}
+
+WINDOW = 60.0  # 用量统计窗口（秒），即 rpm/tpm 中的“每分钟”
+
+T = TypeVar("T")
+
+_RETRY_DELAY = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+class RateLimitedError(Exception):
+    """上游返回 429，retry_after 为建议的等待秒数（可能为 None）"""
+
+    def __init__(self, retry_after: Optional[float], detail: str = ""):
+        super().__init__(detail or "429 Too Many Requests")
+        self.retry_after = retry_after
+        self.detail = detail
+
+class KeyPoolExhausted(Exception):
+    """没有可用的 key：全部处于冷却中或已达到每分钟上限"""
+
+    def __init__(self, retry_after: Optional[float], detail: str):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+def parse_retry_after(headers, body: str = "") -> Optional[float]:
+    """从 Retry-After 头（秒数或 HTTP 日期）或 Gemini 错误体中的 retryDelay 解析等待秒数"""
+    value = headers.get("retry-after") if headers is not None else None
+    if value:
+        value = value.strip()
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+                return max(retry_at.timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    match = _RETRY_DELAY.search(body or "")
+    if match:
+        return float(match.group(1))
+    return None
+
+class KeyState:
+    """单个 key 的用量窗口和健康状态"""
+
+    def __init__(self, key: str, window: float = WINDOW):
+        self.key = key
+        self.window = window
+        self.inflight = 0
+        self.requests: deque = deque()  # 最近一分钟的请求时间
+        self.tokens: deque = deque()  # 最近一分钟的 (时间, token 数)
+        self.token_total = 0
+        self.cooldown_until = 0.0
+        self.rate_limited = 0  # 累计 429 次数
+
+    def _prune(self, now: float):
+        while self.requests and self.requests[0] <= now - self.window:
+            self.requests.popleft()
+        while self.tokens and self.tokens[0][0] <= now - self.window:
+            self.token_total -= self.tokens.popleft()[1]
+
+    def usage(self, now: float) -> Tuple[int, int]:
+        self._prune(now)
+        return len(self.requests), self.token_total
+
+    def ready_at(self, now: float, rpm: int, tpm: int, tokens: int) -> float:
+        """最早可以发出下一个请求的时间，now 表示立即可用"""
+        requests, token_total = self.usage(now)
+        ready = max(now, self.cooldown_until)
+        if rpm and requests >= rpm:
+            ready = max(ready, self.requests[requests - rpm] + self.window)
+        if tpm and self.tokens and token_total + tokens > tpm:
+            # 等到足够多的旧用量移出窗口
+            excess = token_total + tokens - tpm
+            for timestamp, count in self.tokens:
+                excess -= count
+                if excess <= 0:
+                    ready = max(ready, timestamp + self.window)
+                    break
+        return ready
+
+    def record(self, now: float, tokens: int):
+        self.requests.append(now)
+        if tokens:
+            self.tokens.append((now, tokens))
+            self.token_total += tokens
+
+class KeyPool:
+    """
+    一组同类 API key 的调度：会话优先沿用上次的 key，否则选择负载最低的可用 key；
+    429 时按 Retry-After 冷却该 key，并换一个 key 重试。
+    """
+
+    def __init__(self, name: str, keys: Iterable[str], rpm: int = 0, tpm: int = 0, cooldown: float = 60,
+                 max_cooldown: float = 600, max_attempts: int = 3, max_wait: float = 30, sticky_ttl: float = 1800,
+                 max_sticky_sessions: int = 10000, window: float = WINDOW):
+        self.name = name
+        self.window = window
+        self.states: Dict[str, KeyState] = {key: KeyState(key, window) for key in keys if key}
+        self.rpm = rpm
+        self.tpm = tpm
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        self.sticky_ttl = sticky_ttl
+        self.max_sticky_sessions = max_sticky_sessions
+        self._sticky: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # 会话 -> (key, 最近使用时间)
+        self.failovers = 0
+
+    def update_keys(self, keys: Iterable[str]):
+        """配置中的 key 列表变化时保留已有 key 的状态"""
+        keys = [key for key in keys if key]
+        self.states = {key: self.states.get(key) or KeyState(key, self.window) for key in keys}
+
+    def _sticky_key(self, session_id: Optional[str], now: float) -> Optional[str]:
+        if session_id is None:
+            return None
+        entry = self._sticky.get(session_id)
+        if entry is None or entry[0] not in self.states or now - entry[1] > self.sticky_ttl:
+            return None
+        return entry[0]
+
+    def _bind(self, session_id: Optional[str], key: str, now: float):
+        if session_id is None:
+            return
+        self._sticky[session_id] = (key, now)
+        self._sticky.move_to_end(session_id)
+        while len(self._sticky) > self.max_sticky_sessions:
+            self._sticky.popitem(last=False)
+
+    def _load(self, state: KeyState, now: float) -> Tuple[float, int, int]:
+        requests, token_total = state.usage(now)
+        ratio = max(requests / self.rpm if self.rpm else 0.0, token_total / self.tpm if self.tpm else 0.0)
+        return ratio, state.inflight, requests
+
+    def select(self, session_id: Optional[str] = None, tokens: int = 0, exclude: Iterable[str] = ()) -> Tuple[Optional[str], float]:
+        """
+        选择 key，不等待。返回 (key, 0)；没有立即可用的 key 时返回 (None, 最短等待秒数)。
+
+        会话绑定的 key 可用时优先使用，否则选择用量比例、进行中请求数最低的 key。
+        """
+        if not self.states:
+            raise KeyPoolExhausted(None, f"未配置 {self.name} 的 API key")
+        now = time.monotonic()
+        excluded = set(exclude)
+        candidates = [state for key, state in self.states.items() if key not in excluded] or list(self.states.values())
+        ready = {state.key: state.ready_at(now, self.rpm, self.tpm, tokens) for state in candidates}
+
+        sticky = self._sticky_key(session_id, now)
+        if sticky in ready and ready[sticky] <= now:
+            return sticky, 0.0
+        available = [state for state in candidates if ready[state.key] <= now]
+        if not available:
+            return None, min(ready.values()) - now
+        best = min(self._load(state, now) for state in available)
+        choices = [state.key for state in available if self._load(state, now) == best]
+        return random.choice(choices), 0.0
+
+    async def acquire(self, session_id: Optional[str] = None, tokens: int = 0, exclude: Iterable[str] = ()) -> str:
+        """选择 key，全部不可用时等待最早恢复的一个（不超过 max_wait）"""
+        waited = 0.0
+        while True:
+            key, wait = self.select(session_id, tokens, exclude)
+            if key is not None:
+                self._bind(session_id, key, time.monotonic())
+                return key
+            if waited + wait > self.max_wait:
+                raise KeyPoolExhausted(wait, f"{self.name} 的 API key 均被限流，约 {wait:.0f} 秒后恢复")
+            logger.info(f"{self.name} 的 API key 均不可用，等待 {wait:.1f} 秒")
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def penalize(self, key: str, retry_after: Optional[float]):
+        """429 后冷却 key，优先使用上游给出的等待时间"""
+        state = self.states.get(key)
+        if state is None:
+            return
+        delay = min(retry_after if retry_after is not None else self.cooldown, self.max_cooldown)
+        state.cooldown_until = max(state.cooldown_until, time.monotonic() + delay)
+        state.rate_limited += 1
+        logger.warning(f"{self.name} key ...{key[-4:]} 被限流，冷却 {delay:.0f} 秒")
+
+    async def _attempt(self, attempt: Callable[[str], Awaitable[T]], session_id: Optional[str],
+                       key: Optional[str], tokens: int) -> Tuple[T, KeyState]:
+        """call/lease 的选 key 和重试逻辑；成功时所用 key 的进行中计数由调用方释放"""
+        tried: List[str] = []
+        last_error: Optional[RateLimitedError] = None
+        for _ in range(max(self.max_attempts, 1)):
+            if key is not None and not tried and key in self.states:
+                chosen = key
+                if self.states[key].ready_at(time.monotonic(), self.rpm, self.tpm, tokens) > time.monotonic():
+                    chosen = await self.acquire(session_id, tokens)
+            else:
+                chosen = await self.acquire(session_id, tokens, exclude=tried)
+            if tried:
+                self.failovers += 1
+                logger.info(f"{self.name}: 改用 key ...{chosen[-4:]} 重试")
+            self._bind(session_id, chosen, time.monotonic())
+            state = self.states.get(chosen) or KeyState(chosen, self.window)
+            state.record(time.monotonic(), tokens)
+            state.inflight += 1
+            try:
+                return await attempt(chosen), state
+            except RateLimitedError as e:
+                state.inflight -= 1
+                self.penalize(chosen, e.retry_after)
+                tried.append(chosen)
+                last_error = e
+            except BaseException:
+                state.inflight -= 1
+                raise
+        raise KeyPoolExhausted(last_error.retry_after if last_error else None,
+                               f"{self.name} 请求被限流，已尝试 {len(tried)} 个 key: {last_error.detail if last_error else ''}")
+
+    async def call(self, attempt: Callable[[str], Awaitable[T]], session_id: Optional[str] = None,
+                   key: Optional[str] = None, tokens: int = 0) -> T:
+        """
+        用选出的 key 执行 attempt(key)。attempt 抛出 RateLimitedError 时冷却该 key，
+        换一个 key 重试，最多 max_attempts 次；会话随之绑定到新的 key。
+
+        :param key: 已为本轮选好的 key（例如上传附件时使用的 key），可用时优先使用
+        :param tokens: 本次请求的估算 token 数，计入每分钟用量
+        """
+        result, state = await self._attempt(attempt, session_id, key, tokens)
+        state.inflight -= 1
+        return result
+
+    @asynccontextmanager
+    async def lease(self, attempt: Callable[[str], Awaitable[T]], session_id: Optional[str] = None,
+                    key: Optional[str] = None, tokens: int = 0) -> AsyncIterator[T]:
+        """
+        与 call 相同，但 key 的进行中计数保持到退出上下文为止。
+
+        用于流式响应：attempt 在收到响应头时就返回，正文仍在占用该 key。
+        """
+        result, state = await self._attempt(attempt, session_id, key, tokens)
+        try:
+            yield result
+        finally:
+            state.inflight -= 1
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        result = {}
+        for key, state in self.states.items():
+            requests, token_total = state.usage(now)
+            result[f"...{key[-4:]}"] = {
+                "rpm": requests,
+                "tpm": token_total,
+                "inflight": state.inflight,
+                "cooldown_s": round(max(state.cooldown_until - now, 0.0), 1),
+                "rate_limited": state.rate_limited,
+            }
+        return result
+
+_pools: Dict[str, KeyPool] = {}
+
+def get_key_pool(config, provider: str) -> KeyPool:
+    """按 provider（gemini/openai）获取全局 key 池，配置中的 key 列表变化时同步更新"""
+    keys = config.api["llm"][provider].get("api_keys") or []
+    pool = _pools.get(provider)
+    if pool is None:
+        pool_config = dict(DEFAULT_KEY_POOL_CONFIG)
+        pool_config.update(config.api.get("key_pool") or {})
+        pool = _pools[provider] = KeyPool(provider, keys, **pool_config)
+    elif list(pool.states) != [key for key in keys if key]:
+        pool.update_keys(keys)
+    return pool
+
+def llm_provider(config) -> str:
+    """llm.model 对应的 key 池：openai 使用 openai 的 key，gemini 和 default 都使用 gemini 的 key"""
+    return "openai" if config.api["llm"]["model"] == "openai" else "gemini"
+
+def get_llm_key_pool(config) -> KeyPool:
+    """当前 llm.model 使用的 key 池"""
+    return get_key_pool(config, llm_provider(config))
+
+# 模拟测试：多个会话并发请求按 key 限速的假上游，时间压缩为 1 秒一个窗口
+async def main():
+    logging.basicConfig(level=logging.ERROR)
+    keys = [f"sim-key-{i}" for i in range(4)]
+    upstream_limit = 5  # 假上游每个 key 每个窗口允许的请求数
+    broken_key = keys[3]  # 该 key 的配额已用完，总是返回 429
+
+    def make_upstream(counter: Dict[str, int]):
+        windows: Dict[str, deque] = {}
+
+        async def upstream(key: str) -> str:
+            window = windows.setdefault(key, deque())
+            now = time.monotonic()
+            while window and window[0] <= now - 1.0:
+                window.popleft()
+            if key == broken_key or len(window) >= upstream_limit:
+                counter["429"] += 1
+                raise RateLimitedError(2.0 if key == broken_key else 1.0, "quota exceeded")
+            window.append(now)
+            await asyncio.sleep(random.uniform(0.02, 0.08))
+            return key
+        return upstream
+
+    scenarios = [
+        ("随机选择 key", None),
+        ("只按 429 冷却并换 key", dict(rpm=0)),
+        ("按 rpm 调度 + 429 冷却", dict(rpm=upstream_limit)),
+    ]
+    for label, options in scenarios:
+        counter = {"429": 0}
+        upstream = make_upstream(counter)
+        pool = KeyPool("sim", keys, cooldown=1, max_attempts=4, max_wait=5, window=1.0, **options) if options else None
+        ok = failed = 0
+        latencies: List[float] = []
+        used: Dict[str, Dict[str, int]] = {}
+
+        async def session(index: int):
+            nonlocal ok, failed
+            session_id = f"user-{index}"
+            for _ in range(10):
+                started = time.perf_counter()
+                try:
+                    if pool is None:
+                        key = await upstream(random.choice(keys))
+                    else:
+                        key = await pool.call(upstream, session_id=session_id)
+                    ok += 1
+                    counts = used.setdefault(session_id, {})
+                    counts[key] = counts.get(key, 0) + 1
+                except (RateLimitedError, KeyPoolExhausted):
+                    failed += 1
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(random.uniform(0.1, 0.3))
+
+        await asyncio.gather(*(session(i) for i in range(8)))
+        latencies.sort()
+        sticky = sum(max(counts.values()) for counts in used.values()) / max(ok, 1)
+        print(f"{label}: 成功 {ok}/{ok + failed}，上游 429 {counter['429']} 次，"
+              f"同一会话落在主 key 上的比例 {sticky:.0%}，p95 延迟 {latencies[int(len(latencies) * 0.95)] * 1000:.0f}ms")
+
+if __name__ == "__main__":
+    asyncio.run(main())
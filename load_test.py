@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+# 多 worker 压测：启动一个模拟的 Gemini 上游，按不同的 --workers 启动 main.py，
+# 多个 WebSocket 客户端并发发送非流式消息，统计吞吐和延迟，并检查共享存储中的对话历史是否完整。
+#
+#   python load_test.py --workers 1 2 4 --clients 32 --turns 20
+#
+# 每两个客户端使用同一个 user_id，它们的连接可能落在不同的 worker 上。
+#
+#   python load_test.py --soak 10000
+#
+# 连接浸泡测试：单 worker 下反复建立和关闭连接（部分连接发送消息，部分在回复前直接断开），
+# 定期采样服务端 RSS，结束后通过 /运行状态 确认没有残留的连接和任务。
+# 发送消息的连接会让 100 个测试用户的对话历史持续变长，RSS 中这部分增长受 session.max_memory_mb 限制。
+#
+#   python load_test.py --cancel
+#
+# 取消测试：模拟上游对带 [slow] 的消息持续输出（或一直不返回），分别用停止指令、断开连接、
+# 同一连接发送新消息来中断，统计从中断到上游连接关闭的时间；带 [tool] 的消息会让模型调用
+# run_command 执行一个长时间的 sleep，统计停止后该进程被终止的时间。
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SESSION_SECRET = "load-test-secret"  # 写入测试配置，客户端用它签名 user_id
+
+def signed_user_id(name: str) -> str:
+    from session_manager import UserIdSigner
+    return UserIdSigner(SESSION_SECRET.encode("utf-8")).sign(name)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def wait_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"端口 {port} 未就绪")
+
+TOOL_COMMAND = "sleep 31.5"  # 取消测试中由函数调用启动的进程，按命令行查找
+
+def run_upstream(port: int, delay: float, work: int):
+    """模拟 Gemini generateContent：等待 delay 秒后返回固定回复"""
+    import uvicorn
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    upstream = FastAPI()
+    closed: List[float] = []  # [slow] 请求的连接被客户端关闭的时间
+
+    def candidate(part: Dict) -> str:
+        return json.dumps({"candidates": [{"content": {"role": "model", "parts": [part]}}]})
+
+    async def until_disconnected(request: Request):
+        while not await request.is_disconnected():
+            await asyncio.sleep(0.002)
+        closed.append(time.time())
+
+    async def slow_stream():
+        # 客户端断开时 StreamingResponse 会取消生成器
+        try:
+            yield "["
+            for index in range(10000):
+                yield ("," if index else "") + candidate({"text": f"{index} "})
+                await asyncio.sleep(0.05)
+        finally:
+            closed.append(time.time())
+
+    @upstream.post("/v1beta/models/{model}")
+    async def generate(model: str, request: Request):
+        contents = (await request.json())["contents"]
+        text = "".join(part.get("text", "") for part in contents[-1]["parts"])
+        if "[slow]" in text:
+            if model.endswith(":streamGenerateContent"):
+                return StreamingResponse(slow_stream(), media_type="application/json")
+            await until_disconnected(request)
+            return {}
+        if "[tool]" in text:
+            part = {"functionCall": {"name": "run_command", "args": {"command": TOOL_COMMAND}}}
+            if model.endswith(":streamGenerateContent"):
+                return StreamingResponse(iter(["[", candidate(part), "]"]), media_type="application/json")
+            return json.loads(candidate(part))
+        await asyncio.sleep(delay)
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": "收到。" + "回复内容 " * work}]}}]}
+
+    @upstream.get("/closed")
+    async def closed_at():
+        return closed
+
+    uvicorn.run(upstream, host="127.0.0.1", port=port, log_level="warning")
+
+def write_config(directory: str, upstream_port: int, func_calling: bool = False) -> str:
+    from ruamel.yaml import YAML
+    yaml = YAML()
+    with open(os.path.join(ROOT, "config", "api.yaml"), "r", encoding="utf-8") as f:
+        data = yaml.load(f)
+    data["llm"]["model"] = "gemini"
+    data["llm"]["gemini"]["base_url"] = f"http://127.0.0.1:{upstream_port}"
+    data["llm"]["gemini"]["api_keys"] = ["load-test-key"]
+    data["llm"]["gemini"]["func_calling"] = func_calling
+    data["proxy"]["http_proxy"] = ""
+    data["proxy"]["socks_proxy"] = ""
+    data["http_pool"]["http2"] = False
+    data["logging"]["level"] = "WARNING"
+    data["context"]["max_messages"] = 1000000
+    data["context"]["max_tokens"] = 100000000
+    data["history_store"]["path"] = os.path.join(directory, "history.db")
+    data["media_cache"]["path"] = os.path.join(directory, "media_cache.json")
+    data["tool_cache"]["disk_path"] = ""
+    data["client_upload"]["dir"] = os.path.join(directory, "uploads")
+    data["session"]["secret"] = SESSION_SECRET
+    path = os.path.join(directory, "api.yaml")
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.dump(data, f)
+    return path
+
+async def recv_reply(ws):
+    """接收下一条回复，期间回应服务端的心跳"""
+    while True:
+        reply = json.loads(await ws.recv())
+        if isinstance(reply, dict) and reply.get("type") == "ping":
+            await ws.send(json.dumps({"type": "pong"}))
+            continue
+        return reply
+
+async def run_clients(port: int, clients: int, turns: int) -> Dict:
+    import websockets
+
+    latencies: List[float] = []
+    errors = 0
+
+    async def client(index: int):
+        nonlocal errors
+        user_id = signed_user_id(f"load-{index // 2}")
+        async with websockets.connect(f"ws://127.0.0.1:{port}/ws?user_id={user_id}", max_size=None) as ws:
+            for turn in range(turns):
+                message = {"message": [{"type": "text", "content": f"客户端 {index} 第 {turn} 条消息"}], "isStreaming": False}
+                started = time.perf_counter()
+                await ws.send(json.dumps(message))
+                reply = await recv_reply(ws)
+                latencies.append(time.perf_counter() - started)
+                if not str(reply[0].get("content", "")).startswith("收到"):
+                    errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "turns": len(latencies),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "errors": errors,
+    }
+
+def read_rss_mib(pid: int) -> float:
+    with open(f"/proc/{pid}/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+async def run_soak(port: int, pid: int, total: int, concurrency: int) -> Dict:
+    import websockets
+
+    samples: List[tuple] = []
+    errors = 0
+    done = 0
+    counter = iter(range(total))
+
+    async def one(index: int):
+        nonlocal errors
+        async with websockets.connect(f"ws://127.0.0.1:{port}/ws?user_id={signed_user_id(f'soak-{index % 100}')}", max_size=None) as ws:
+            if index % 10 == 0:
+                # 完整一轮对话
+                await ws.send(json.dumps({"message": [{"type": "text", "content": "你好"}], "isStreaming": False}))
+                if not str((await recv_reply(ws))[0].get("content", "")).startswith("收到"):
+                    errors += 1
+            elif index % 10 == 1:
+                # 回复到达前断开，服务端应取消这一轮
+                await ws.send(json.dumps({"message": [{"type": "text", "content": "你好"}], "isStreaming": False}))
+
+    async def worker():
+        nonlocal errors, done
+        for index in counter:
+            try:
+                await one(index)
+            except Exception:
+                errors += 1
+            done += 1
+            if done % 1000 == 0:
+                samples.append((done, read_rss_mib(pid)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(1)  # 等服务端处理完断开
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws?user_id={signed_user_id('soak-status')}") as ws:
+        await ws.send(json.dumps({"message": [{"type": "text", "content": "/运行状态"}], "isStreaming": False}))
+        status = (await recv_reply(ws))[0]["content"]
+    return {"elapsed": elapsed, "samples": samples, "errors": errors, "status": status}
+
+def tool_process_running() -> bool:
+    for pid in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if f.read().replace(b"\0", b" ").strip() == TOOL_COMMAND.encode():
+                    return True
+        except (OSError, ValueError):
+            continue
+    return False
+
+async def run_cancel(port: int, upstream_port: int) -> List[str]:
+    import httpx
+    import websockets
+
+    async def closed_count() -> int:
+        async with httpx.AsyncClient() as client:
+            return len((await client.get(f"http://127.0.0.1:{upstream_port}/closed")).json())
+
+    async def wait_closed(before: int, started: float) -> str:
+        async with httpx.AsyncClient() as client:
+            for _ in range(500):
+                closed = (await client.get(f"http://127.0.0.1:{upstream_port}/closed")).json()
+                if len(closed) > before:
+                    return f"{(closed[-1] - started) * 1000:.1f}ms"
+                await asyncio.sleep(0.01)
+        return "超时未关闭"
+
+    async def receive_until(ws, predicate):
+        while True:
+            message = await ws.recv()
+            if isinstance(message, str) and message.startswith("data: "):
+                if predicate(message):
+                    return
+                continue
+            reply = json.loads(message)
+            if isinstance(reply, dict) and reply.get("type") == "ping":
+                await ws.send(json.dumps({"type": "pong"}))
+            elif predicate(json.dumps(reply, ensure_ascii=False)):
+                return
+
+    def chat(text: str, streaming: bool) -> str:
+        return json.dumps({"message": [{"type": "text", "content": text}], "isStreaming": streaming})
+
+    async def scenario(name: str, streaming: bool, trigger: str) -> str:
+        before = await closed_count()
+        async with websockets.connect(f"ws://127.0.0.1:{port}/ws?user_id={signed_user_id(f'cancel-{name}')}", max_size=None) as ws:
+            await ws.send(chat("[slow] 写一篇很长的文章", streaming))
+            if streaming:
+                await receive_until(ws, lambda message: '"content": "0 "' in message)
+            else:
+                await asyncio.sleep(0.3)
+            started = time.time()
+            if trigger == "stop":
+                await ws.send(json.dumps({"type": "stop"}))
+                await receive_until(ws, lambda message: "已停止生成" in message)
+            elif trigger == "message":
+                await ws.send(chat("换个话题", streaming))
+            else:
+                await ws.close()
+            result = await wait_closed(before, started)
+        return f"{name}: 中断后上游连接关闭用时 {result}"
+
+    async def tool_scenario() -> str:
+        async with websockets.connect(f"ws://127.0.0.1:{port}/ws?user_id={signed_user_id('cancel-tool')}", max_size=None) as ws:
+            await ws.send(chat("[tool] 运行一个长命令", False))
+            for _ in range(500):
+                if tool_process_running():
+                    break
+                await asyncio.sleep(0.01)
+            else:
+                return "函数调用: 命令未启动"
+            started = time.perf_counter()
+            await ws.send(json.dumps({"type": "stop"}))
+            while tool_process_running():
+                await asyncio.sleep(0.001)
+            elapsed = (time.perf_counter() - started) * 1000
+            await receive_until(ws, lambda message: "已停止生成" in message)
+        return f"函数调用: 停止后 {TOOL_COMMAND} 进程终止用时 {elapsed:.1f}ms"
+
+    return [
+        await scenario("流式+停止", True, "stop"),
+        await scenario("非流式+停止", False, "stop"),
+        await scenario("流式+断开", True, "close"),
+        await scenario("非流式+断开", False, "close"),
+        await scenario("流式+新消息", True, "message"),
+        await tool_scenario(),
+    ]
+
+def check_history(db_path: str, clients: int, turns: int) -> str:
+    """每个 user_id 有两个客户端，应当恰好保存 2 * turns 轮（user + model 各一条）"""
+    expected = 2 * turns * 2
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT user_id, COUNT(*), MIN(seq), MAX(seq) FROM messages GROUP BY user_id").fetchall()
+    conn.close()
+    bad = [row for row in rows if row[1] != expected or row[3] - row[2] + 1 != expected]
+    if len(rows) != (clients + 1) // 2 or bad:
+        return f"不一致: {len(rows)} 个会话, 异常 {bad[:3]}"
+    return f"{len(rows)} 个会话各 {expected} 条消息，完整"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="多 worker 压测")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--upstream-delay", type=float, default=0.02, help="模拟上游延迟（秒）")
+    parser.add_argument("--reply-words", type=int, default=200, help="模拟回复的长度")
+    parser.add_argument("--soak", type=int, default=0, help="连接浸泡测试：建立并关闭的连接总数")
+    parser.add_argument("--concurrency", type=int, default=50, help="浸泡测试中同时进行的连接数")
+    parser.add_argument("--cancel", action="store_true", help="取消测试：统计中断后上游连接关闭的时间")
+    parser.add_argument("--upstream", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+async def main(args):
+    upstream_port = free_port()
+    upstream = subprocess.Popen([sys.executable, __file__, "--upstream", str(upstream_port),
+                                 "--upstream-delay", str(args.upstream_delay), "--reply-words", str(args.reply_words)])
+    print(f"CPU 核数: {os.cpu_count()}，客户端 {args.clients} 个，每个 {args.turns} 轮")
+    try:
+        await wait_port(upstream_port)
+        if args.soak:
+            await soak(args, upstream_port)
+            return
+        if args.cancel:
+            await cancel(upstream_port)
+            return
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as directory:
+                config_path = write_config(directory, upstream_port)
+                port = free_port()
+                log = open(os.path.join(directory, "server.log"), "wb")
+                server = subprocess.Popen(
+                    [sys.executable, os.path.join(ROOT, "main.py"), "--port", str(port), "--workers", str(workers)],
+                    cwd=directory, env={**os.environ, "CHAT_CONFIG": config_path}, stdout=log, stderr=subprocess.STDOUT,
+                )
+                try:
+                    await wait_port(port)
+                    await asyncio.sleep(1)  # 等所有 worker 完成启动
+                    result = await run_clients(port, args.clients, args.turns)
+                finally:
+                    server.terminate()
+                    server.wait(timeout=30)
+                    log.close()
+                consistency = check_history(os.path.join(directory, "history.db"), args.clients, args.turns)
+                print(f"workers={workers}: {result['throughput']:.1f} 轮/秒, p50 {result['p50_ms']:.0f}ms, "
+                      f"p95 {result['p95_ms']:.0f}ms, 最大 {result['max_ms']:.0f}ms, 错误 {result['errors']}, 历史: {consistency}")
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+
+async def soak(args, upstream_port: int):
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = write_config(directory, upstream_port)
+        port = free_port()
+        log = open(os.path.join(directory, "server.log"), "wb")
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "main.py"), "--port", str(port), "--workers", "1"],
+            cwd=directory, env={**os.environ, "CHAT_CONFIG": config_path}, stdout=log, stderr=subprocess.STDOUT,
+        )
+        try:
+            await wait_port(port)
+            baseline = read_rss_mib(server.pid)
+            result = await run_soak(port, server.pid, args.soak, args.concurrency)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+            log.close()
+    print(f"{args.soak} 个连接，用时 {result['elapsed']:.1f}s，错误 {result['errors']}")
+    print(f"RSS (MiB): 启动后 {baseline:.1f}, " + ", ".join(f"{n}: {rss:.1f}" for n, rss in result["samples"]))
+    print(f"结束后服务端状态:\n{result['status']}")
+
+async def cancel(upstream_port: int):
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = write_config(directory, upstream_port, func_calling=True)
+        port = free_port()
+        log = open(os.path.join(directory, "server.log"), "wb")
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "main.py"), "--port", str(port)],
+            cwd=directory, env={**os.environ, "CHAT_CONFIG": config_path}, stdout=log, stderr=subprocess.STDOUT,
+        )
+        try:
+            await wait_port(port)
+            for line in await run_cancel(port, upstream_port):
+                print(line)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+            log.close()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.upstream:
+        run_upstream(args.upstream, args.upstream_delay, args.reply_words)
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,114 @@
+import json
+import logging
+import re
+from typing import Any, Dict
+
+# 默认日志配置，可在 config/api.yaml 的 logging 中覆盖
+DEFAULT_LOGGING_CONFIG = {
+    "level": "INFO",
+    "format": "%(levelname)s:%(name)s:%(message)s",
+    "max_field_chars": 256,  # 日志中单个字符串字段最多保留的字符数
+    "modules": {},  # 模块名 -> 级别，例如 httpx: WARNING
+}
+
+# 以至少 128 个连续 base64 字符开头的字符串视为媒体数据（只检查开头，不扫描全文）
+_BASE64_PATTERN = re.compile(r'^(data:[\w/+.-]+;base64,)?[A-Za-z0-9+/=]{128}')
+
+max_field_chars = DEFAULT_LOGGING_CONFIG["max_field_chars"]
+
+def redact_text(text: str, limit: int = None) -> str:
+    """把 base64/data: URL 替换为长度说明，其余长文本截断"""
+    limit = max_field_chars if limit is None else limit
+    if len(text) <= limit:
+        return text
+    match = _BASE64_PATTERN.match(text[:256])
+    if match:
+        prefix = match.group(1) or ""
+        return f"{prefix}<base64 {len(text) - len(prefix)} 字符>"
+    return f"{text[:limit]}...(共 {len(text)} 字符)"
+
+def redact(obj: Any, limit: int = None) -> Any:
+    """返回脱敏后的副本：递归处理 dict/list 中的字符串"""
+    if isinstance(obj, str):
+        return redact_text(obj, limit)
+    if isinstance(obj, dict):
+        return {key: redact(value, limit) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [redact(value, limit) for value in obj]
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return f"<{memoryview(obj).nbytes} 字节>"
+    return obj
+
+class LazyJSON:
+    """
+    延迟序列化的日志参数，只有日志真正输出时才脱敏并 json.dumps。
+
+    用法: logger.debug("请求内容: %s", LazyJSON(payload))
+    """
+    __slots__ = ("obj", "indent")
+
+    def __init__(self, obj: Any, indent: int = None):
+        self.obj = obj
+        self.indent = indent
+
+    def __str__(self) -> str:
+        try:
+            return json.dumps(redact(self.obj), ensure_ascii=False, indent=self.indent, default=str)
+        except (TypeError, ValueError):
+            return str(redact(self.obj))
+
+class LazyText:
+    """延迟截断的日志参数，适用于原始响应文本等可能很长的字符串"""
+    __slots__ = ("text", "limit")
+
+    def __init__(self, text: Any, limit: int = None):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self) -> str:
+        return redact_text(str(self.text), self.limit)
+
+def setup_logging(config):
+    """按配置设置根日志级别和各模块级别，应在程序启动时调用一次"""
+    global max_field_chars
+    log_config = dict(DEFAULT_LOGGING_CONFIG)
+    log_config.update(config.api.get("logging") or {})
+    max_field_chars = int(log_config["max_field_chars"])
+    logging.basicConfig(level=str(log_config["level"]).upper(), format=log_config["format"])
+    modules: Dict[str, str] = log_config.get("modules") or {}
+    for name, level in modules.items():
+        logging.getLogger(name).setLevel(str(level).upper())
+
+# 微基准：带 6 MB 图片（base64 约 8 MB）的请求体，比较旧写法（f-string 中直接 json.dumps）和 LazyJSON 的日志开销
+def main():
+    import base64
+    import io
+    import os
+    import timeit
+
+    payload = {"contents": [{"role": "user", "parts": [
+        {"text": "描述这张图片"},
+        {"inline_data": {"mime_type": "image/png", "data": base64.b64encode(os.urandom(6 * 1024 * 1024)).decode()}},
+    ]}], "generationConfig": {"temperature": 0.7}}
+    logger = logging.getLogger("log_utils.bench")
+    logger.propagate = False
+    stream = io.StringIO()
+    logger.addHandler(logging.StreamHandler(stream))
+
+    def eager():
+        logger.debug(f"请求内容: {json.dumps(payload, ensure_ascii=False, indent=2)}")
+
+    def lazy():
+        logger.debug("请求内容: %s", LazyJSON(payload, indent=2))
+
+    for level in ("INFO", "DEBUG"):
+        logger.setLevel(level)
+        for label, func in (("f-string + json.dumps", eager), ("LazyJSON", lazy)):
+            stream.seek(0)
+            stream.truncate()
+            runs = 20
+            elapsed = timeit.timeit(func, number=runs) / runs
+            print(f"级别 {level} / {label}: 每次 {elapsed * 1e6:.1f}µs，写出 {len(stream.getvalue()) // runs} 字符")
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,39 @@
 import argparse
 import os
 import logging
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-import uuid
+from fastapi.responses import FileResponse
+from urllib.parse import unquote
+from starlette.requests import ClientDisconnect
 import uvicorn
 import json
 from typing import List, Dict, Any
 import asyncio
-import random
 
 # 导入模块
 import multimodal_classes
 from multimodal_classes import Text, download_and_encode_file
 from function_calls import handle_function_calls, TOOLS
 from webui_handlers import webui_listeners, WebUIEvent
-from api_interface import request, stream_request, prompt_elements_construct, upload_to_gemini_media, upload_to_openai_media
+from api_interface import request, stream_request, summary_request, prompt_elements_construct, upload_to_gemini_media, upload_to_openai_media
 from yamlLoader import YAMLManager
 from webui_handlers import webui_main
+from http_pool import http_pool
+from stream_sender import get_stream_config, media_item_type, send_framed, send_stream, stream_stats
+from session_manager import USER_ID_COOKIE, SessionManager, UserIdSigner
+from history_store import SQLiteHistoryStore
+from context_window import ContextWindow, format_transcript
+from log_utils import LazyJSON, setup_logging
+from tool_cache import close_tool_cache
+from executors import setup_executors, shutdown_executors
+from key_pool import KeyPoolExhausted, get_llm_key_pool
+from media_upload import UploadError
+from upload_store import get_upload_store
+from connection_manager import Connection, get_connections
+from tool_loop import tool_loop_stats
 
 # 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # 初始化 FastAPI 应用
@@ -35,23 +47,68 @@ app.add_middleware(
 )
 
 # 全局变量
-conversation_history: Dict[str, List[Dict[str, Any]]] = {}
-clients: Dict[str, WebSocket] = {}
-config = YAMLManager(["config/api.yaml"])  # 初始化 config
+config = YAMLManager([os.environ.get("CHAT_CONFIG", "config/api.yaml")])  # 初始化 config，可用环境变量指定其他配置文件
+setup_logging(config)
 model_type = config.api["llm"]["model"]
+sessions = SessionManager.from_config(config)
+user_ids = UserIdSigner.from_config(config)
+connections = get_connections(config)
+webui_main(config)  # 每个 worker 进程导入本模块时都注册一次指令处理器
+
+# 把移出上下文窗口的旧对话压缩为摘要（不带函数声明，摘要中不会混入函数调用的输出）
+async def summarize_history(messages: List[Dict[str, Any]], previous_summary: str) -> str:
+    prompt = (
+        "请把下面的对话压缩成简洁的摘要，保留事实、用户偏好和尚未完成的事项，不要添加评论。\n"
+        f"已有摘要:\n{previous_summary or '无'}\n\n新增对话:\n{format_transcript(messages)}"
+    )
+    api_key = await get_llm_key_pool(config).acquire()
+    return await summary_request(prompt, config, api_key)
+
+context_window = ContextWindow.from_config(config, summarize_history)
+
+# 应用启动时初始化解析线程池/进程池、事件循环延迟监控和过期附件清理
+@app.on_event("startup")
+async def startup_executors():
+    setup_executors(config)
+    app.state.upload_cleanup = asyncio.create_task(get_upload_store(config).run_cleanup())
+    logger.info(f"worker 进程 {os.getpid()} 已启动")
+
+# 应用退出时停止附件清理，关闭上游连接池、历史存储、工具缓存和执行器
+@app.on_event("shutdown")
+async def shutdown_http_pool():
+    app.state.upload_cleanup.cancel()
+    await http_pool.aclose()
+    await sessions.close()
+    close_tool_cache()
+    await shutdown_executors()
 
 # 发送消息到 WebSocket 客户端
 async def send_message(client_id: str, message_list: List[Any], is_streaming: bool = False):
-    if client_id not in clients:
+    connection = connections.get(client_id)
+    if connection is None:
         logger.warning(f"客户端 {client_id}: 不存在，跳过发送")
         return
 
     if not is_streaming:
         combined_messages = []
+        media_frames = []  # 二进制模式下随 JSON 头发送的媒体原始字节
         text_content = ""
 
         for msg in message_list:
-            if hasattr(msg, 'to_dict'):
+            if connection.binary and isinstance(msg, multimodal_classes._Media):
+                blob = await msg.load()
+                mime_type = msg.source["mime_type"]
+                combined_messages.append({
+                    "type": media_item_type(mime_type),
+                    "source": {
+                        "frame": len(media_frames),
+                        "size": blob.nbytes,
+                        "mime_type": mime_type,
+                        "filename": msg.source.get("filename", "unknown_file")
+                    }
+                })
+                media_frames.append((await blob.aview()).tobytes())
+            elif hasattr(msg, 'to_dict'):
                 if asyncio.iscoroutinefunction(msg.to_dict):
                     msg_dict = await msg.to_dict()
                 else:
@@ -61,42 +118,14 @@ async def send_message(client_id: str, message_list: List[Any], is_streaming: bo
                 elif "inline_data" in msg_dict:
                     mime_type = msg_dict["inline_data"]["mime_type"]
                     filename = getattr(msg, "source", {}).get("filename", "unknown_file")
-                    if mime_type.startswith("image/"):
-                        combined_messages.append({
-                            "type": "image",
-                            "source": {
-                                "base64": msg_dict["inline_data"]["data"],
-                                "mime_type": mime_type,
-                                "filename": filename
-                            }
-                        })
-                    elif mime_type.startswith("audio/"):
-                        combined_messages.append({
-                            "type": "audio",
-                            "source": {
-                                "base64": msg_dict["inline_data"]["data"],
-                                "mime_type": mime_type,
-                                "filename": filename
-                            }
-                        })
-                    elif mime_type.startswith("video/"):
-                        combined_messages.append({
-                            "type": "video",
-                            "source": {
-                                "base64": msg_dict["inline_data"]["data"],
-                                "mime_type": mime_type,
-                                "filename": filename
-                            }
-                        })
-                    else:
-                        combined_messages.append({
-                            "type": "file",
-                            "source": {
-                                "base64": msg_dict["inline_data"]["data"],
-                                "mime_type": mime_type,
-                                "filename": filename
-                            }
-                        })
+                    combined_messages.append({
+                        "type": media_item_type(mime_type),
+                        "source": {
+                            "base64": msg_dict["inline_data"]["data"],
+                            "mime_type": mime_type,
+                            "filename": filename
+                        }
+                    })
                 elif "fileData" in msg_dict:
                     filename = getattr(msg, "source", {}).get("filename", "uploaded_file")
                     combined_messages.append({
@@ -113,36 +142,92 @@ async def send_message(client_id: str, message_list: List[Any], is_streaming: bo
         if text_content:
             combined_messages.insert(0, {"type": "text", "content": text_content})
 
-        if combined_messages:
+        if media_frames:
+            sent_bytes = await send_framed(connection, combined_messages, media_frames)
+            logger.info(f"客户端 {client_id}: 非流式消息已发送 ({len(media_frames)} 个二进制帧，共 {sent_bytes} 字节)")
+            logger.debug("客户端 %s: 非流式消息内容: %s", client_id, LazyJSON(combined_messages))
+        elif combined_messages:
             message_json = json.dumps(combined_messages)
-            await clients[client_id].send_text(message_json)
-            logger.info(f"客户端 {client_id}: 非流式消息已发送: {message_json}")
+            await connection.send_text(message_json)
+            logger.info(f"客户端 {client_id}: 非流式消息已发送 ({len(message_json)} 字符)")
+            logger.debug("客户端 %s: 非流式消息内容: %s", client_id, LazyJSON(combined_messages))
     else:
-        async for chunk in message_list:
-            await clients[client_id].send_text(chunk)
-            logger.info(f"客户端 {client_id}: 流式数据块已发送: {chunk}")
-            await asyncio.sleep(0.1)
+        await send_stream(connection, message_list, client_id, config)
+
+# 签发 user_id：请求中已有签名有效的 user_id 时原样返回，否则签发新的；同时写入 cookie
+@app.post("/session")
+async def issue_user_id(request: Request, response: Response):
+    token = user_ids.token(request) or user_ids.issue()
+    response.set_cookie(USER_ID_COOKIE, token, max_age=10 * 365 * 24 * 3600, httponly=True, samesite="lax")
+    return {"user_id": token}
+
+# 附件上传：请求体是文件原始字节，按块写入临时文件，返回的 upload_id 在聊天消息中引用
+# 需要签名有效的 user_id，附件总量按用户计入配额
+@app.post("/upload")
+async def upload_attachment(request: Request):
+    user_id = user_ids.resolve(request, None)
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="缺少有效的 user_id，请刷新页面")
+    filename = os.path.basename(unquote(request.headers.get("x-filename") or "")) or "upload"
+    mime_type = request.headers.get("content-type") or "application/octet-stream"
+    length = request.headers.get("content-length")
+    try:
+        meta = await get_upload_store(config).save(request.stream(), filename, mime_type, user_id,
+                                                   int(length) if length and length.isdigit() else None)
+    except UploadError as e:
+        logger.warning(f"附件上传失败: {filename}: {e.detail}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except ClientDisconnect:
+        logger.info(f"附件上传中断: {filename}")
+        return Response(status_code=400)
+    return {key: meta[key] for key in ("upload_id", "filename", "mime_type", "size")}
 
 # WebSocket 端点
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    client_id = str(uuid.uuid4())
-    clients[client_id] = websocket
-    logger.info(f"客户端 {client_id} 已连接")
+    # 心跳、空闲断开、发送队列和断开时的任务取消由 ConnectionManager 负责；
+    # 断开后由前端重新建立连接
+    binary = websocket.query_params.get("binary") == "1" and get_stream_config(config)["binary_media"]
+    await connections.serve(websocket, user_ids.resolve, binary, on_connection_message, on_close=forget_client,
+                            control=on_control_message)
 
+def is_command(message_list: List[Dict[str, Any]]) -> bool:
+    first_message = next((item.get("content", "") for item in message_list if item.get("type") == "text"), "")
+    return first_message.startswith("/")
+
+def on_control_message(connection: Connection, message_data: Any) -> bool:
+    """
+    消息排队前调用，不等待正在进行的回复：
+    {"type": "stop"} 停止该用户正在进行的回复；同一连接发来新的聊天消息时先中断它自己的上一轮。
+    """
+    if not isinstance(message_data, dict):
+        return False
+    session = sessions.peek(connection.user_id)
+    if message_data.get("type") == "stop":
+        if session is None or not session.cancel_turn():
+            connection.try_send_text(json.dumps([{"type": "text", "content": "当前没有正在进行的回复"}], ensure_ascii=False))
+        logger.info(f"客户端 {connection.client_id}: 收到停止指令")
+        return True
+    message_list = message_data.get("message") or []
+    if session is not None and message_list and not is_command(message_list):
+        if session.cancel_turn(connection.client_id):
+            logger.info(f"客户端 {connection.client_id}: 收到新消息，中断上一轮回复")
+    return False
+
+async def on_connection_message(connection: Connection, message_data: Dict[str, Any]):
+    client_id = connection.client_id
+    logger.info(f"从客户端 {client_id} 接收到消息")
+    logger.debug("客户端 %s 消息内容: %s", client_id, LazyJSON(message_data))
     try:
-        while True:
-            data = await websocket.receive_text()
-            logger.info(f"从客户端 {client_id} 接收到消息: {data}")
-            message_data = json.loads(data)
-            await handle_message(client_id, message_data)
+        await handle_message(client_id, message_data)
     except Exception as e:
+        logger.error(f"客户端 {client_id}: 消息处理错误: {str(e)}")
         await send_message(client_id, [Text(f"WebSocket 错误: {str(e)}")])
-    finally:
-        del clients[client_id]
-        logger.info(f"客户端 {client_id} 已断开,正在重连")
-        await websocket_endpoint(websocket)
+
+def forget_client(connection: Connection):
+    """释放按 client_id 保存的统计"""
+    stream_stats.pop(connection.client_id, None)
+    tool_loop_stats.pop(connection.client_id, None)
 
 # 处理 WebSocket 消息
 async def handle_message(client_id: str, message_data: Dict[str, Any]):
@@ -163,61 +248,115 @@ async def handle_message(client_id: str, message_data: Dict[str, Any]):
             logger.error(f"客户端 {client_id}: 监听函数 {listener.__name__} 执行错误: {str(e)}")
 
     # 检查是否以 "/" 开头
-    first_message = next((item["content"] for item in message_list if item["type"] == "text"), "")
-    if first_message.startswith("/"):
+    if is_command(message_list):
+        first_message = next(item["content"] for item in message_list if item["type"] == "text")
         logger.info(f"客户端 {client_id}: 消息以 '/' 开头: {first_message}")
         if len(message_list) == 1 and message_list[0].get("type") == "text" and message_list[0].get("content") == "/clear":
             logger.info(f"客户端 {client_id}: 接收到清除命令，清除对话历史")
-            conversation_history["default_user"] = []
+            await sessions.clear(connections.get(client_id).user_id)
             await send_message(client_id, [Text("聊天记录已清除")])
         return
 
-    user_id = "default_user"
-    api_key = random.choice(config.api["llm"]["gemini"]["api_keys"])
-    if user_id not in conversation_history:
-        logger.info(f"客户端 {client_id}: 初始化新对话历史，用户: {user_id}")
-        conversation_history[user_id] = []
+    user_id = connections.get(client_id).user_id
+    session = sessions.get(user_id)
+    # 同一用户的对话轮次串行执行（多 worker 时跨进程），不同用户互不阻塞；
+    # 本轮作为单独的任务执行，停止指令、新消息和断开都会取消它（包括上游请求和函数调用）
+    async with sessions.turn(session):
+        try:
+            turn = await sessions.run_turn(session, run_turn(client_id, session, message_list, is_streaming), client_id)
+        finally:
+            session.touch()
+            await sessions.persist(session)
+    if not turn.cancelled():
+        turn.result()  # 抛出本轮的异常（如果有）
+        return
+    logger.info(f"客户端 {client_id}: 本轮回复已停止")
+    connection = connections.get(client_id)
+    if connection is not None:
+        if is_streaming:
+            # 结束前端正在显示的流式气泡
+            await connection.send_text(f"data: {json.dumps({'content': '', 'start_stream': False, 'end_stream': True})}\n\n")
+        await send_message(client_id, [Text("已停止生成")])
+
+# 执行一轮对话
+async def run_turn(client_id: str, session, message_list: List[Dict[str, Any]], is_streaming: bool):
+    user_id = session.user_id
+    # 同一会话尽量固定使用同一个 key，附件上传和上下文缓存都与 key 绑定
+    try:
+        api_key = await get_llm_key_pool(config).acquire(user_id)
+    except KeyPoolExhausted as e:
+        logger.warning(f"客户端 {client_id}: {e}")
+        await send_message(client_id, [Text(f"处理错误: {e}")])
+        return
 
     current_prompt = await prompt_elements_construct(message_list, config, api_key)
-    history = conversation_history[user_id]
+    history = session.history
     history.append({"role": "user", "parts": current_prompt})
-
-    if is_streaming:
-        logger.info(f"客户端 {client_id}: 流式模式，处理用户: {user_id}")
-        stream_generator = await stream_request(history, config, client_id, send_message, conversation_history, api_key)
-        await send_message(client_id, stream_generator, is_streaming=True)  # 流式发送
-    else:
-        logger.info(f"客户端 {client_id}: 开始非流式处理，用户: {user_id}")
-        try:
-            answer = await request(history, config, client_id, send_message, api_key)
-            if config.api["llm"]["model"] == "gemini":
-                history.append({"role": "model", "parts": [{"text": answer}]})
-            else:
-                history.append({"role": "assistant", "parts": [{"text": answer}]})
-            conversation_history[user_id] = history[-50:]
-            await send_message(client_id, [Text(answer)])
-        except Exception as e:
-            logger.error(f"客户端 {client_id}: 非流式处理错误: {str(e)}")
-            await send_message(client_id, [Text(f"处理错误: {str(e)}")])  # 默认非流式
+    turn_start = None
+    try:
+        session.record_trim(await context_window.apply(history, session.summary_cache))
+        turn_start = len(history)
+        if is_streaming:
+            logger.info(f"客户端 {client_id}: 流式模式，处理用户: {user_id}")
+            stream_generator = await stream_request(history, config, client_id, send_message, api_key, user_id)
+            await send_message(client_id, stream_generator, is_streaming=True)  # 流式发送
+        else:
+            logger.info(f"客户端 {client_id}: 开始非流式处理，用户: {user_id}")
+            try:
+                answer = await request(history, config, client_id, send_message, api_key, user_id)
+                if config.api["llm"]["model"] == "gemini":
+                    history.append({"role": "model", "parts": [{"text": answer}]})
+                else:
+                    history.append({"role": "assistant", "parts": [{"text": answer}]})
+                await send_message(client_id, [Text(answer)])
+            except Exception as e:
+                logger.error(f"客户端 {client_id}: 非流式处理错误: {str(e)}")
+                await send_message(client_id, [Text(f"处理错误: {str(e)}")])  # 默认非流式
+    except asyncio.CancelledError:
+        # 丢弃本轮已追加的函数调用和部分回答，用一条简短的回复结束本轮，保持 user/model 交替
+        if turn_start is not None:
+            del history[turn_start:]
+        role = "model" if config.api["llm"]["model"] == "gemini" else "assistant"
+        history.append({"role": role, "parts": [{"text": "（回复已被用户停止）"}]})
+        raise
 
 # 主函数
 def main():
-    webui_main(config)
     parser = argparse.ArgumentParser(description="启动 AI 聊天后端服务器")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
     parser.add_argument("--port", type=int, default=8000, help="服务器运行的端口号")
+    parser.add_argument("--workers", type=int, default=1, help="worker 进程数，大于 1 时各进程共享 data/ 下的存储")
     args = parser.parse_args()
 
     port = args.port
     if not (1 <= port <= 65535):
         port = 8000
 
-    app.mount("/", StaticFiles(directory=os.path.dirname(__file__), html=True), name="static")
-    uvicorn.run(app, host="127.0.0.1", port=port)
+    if args.workers > 1:
+        if not isinstance(sessions.store, SQLiteHistoryStore):
+            logger.warning("history_store 不是 sqlite，多个 worker 之间不会共享对话历史")
+        # 多进程模式下 uvicorn 需要导入字符串，由各 worker 自行导入本模块
+        uvicorn.run("main:app", host=args.host, port=port, workers=args.workers,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        uvicorn.run(app, host=args.host, port=port)
 
 # 注入实现
 multimodal_classes.download_and_encode_file = download_and_encode_file
 multimodal_classes.upload_to_gemini_media = upload_to_gemini_media
 multimodal_classes.upload_to_openai_media = upload_to_openai_media
 
+# 前端页面：只提供这几个文件，data/（对话历史、附件、缓存）和 config/（api key）不能通过 HTTP 访问
+STATIC_ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = {"": "index.html", "index.html": "index.html", "script.js": "script.js", "style.css": "style.css"}
+
+# 最后注册，前面的 /ws、/upload 等路由优先匹配
+@app.get("/{name:path}")
+async def static_file(name: str):
+    filename = STATIC_FILES.get(name)
+    if filename is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return FileResponse(os.path.join(STATIC_ROOT, filename))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
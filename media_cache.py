@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from single_flight import SingleFlight
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认缓存配置，可在 config/api.yaml 的 media_cache 中覆盖
+DEFAULT_MEDIA_CACHE_CONFIG = {
+    "path": "data/media_cache.json",
+    "max_entries": 1000,
+    "gemini_ttl": 47 * 3600,  # Gemini 文件 48 小时后过期，留一小时余量
+    "openai_ttl": 0,  # 0 表示不过期
+}
+
+HASH_IN_THREAD_SIZE = 1024 * 1024  # 超过该大小的内容在线程中计算哈希
+
+async def sha256_hex(raw) -> str:
+    """计算内容哈希（接受 bytes/memoryview），大文件放到线程中（hashlib 会释放 GIL）"""
+    if memoryview(raw).nbytes >= HASH_IN_THREAD_SIZE:
+        return await asyncio.to_thread(lambda: hashlib.sha256(raw).hexdigest())
+    return hashlib.sha256(raw).hexdigest()
+
+class MediaUploadCache:
+    """
+    以内容 SHA-256 为键缓存上传到 Gemini/OpenAI 文件接口后得到的 fileUri/file_id。
+
+    条目按提供方的文件有效期过期，超过 max_entries 时按 LRU 淘汰并持久化到磁盘；
+    同一内容的并发上传会合并为一次。
+    """
+
+    def __init__(self, path: Optional[str], max_entries: int, ttls: Dict[str, float]):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # 键 -> (uri, 过期时间戳, 0 为不过期)
+        self._inflight = SingleFlight()
+        self._load()
+
+    @classmethod
+    def from_config(cls, config) -> "MediaUploadCache":
+        cache_config = dict(DEFAULT_MEDIA_CACHE_CONFIG)
+        cache_config.update(config.api.get("media_cache") or {})
+        ttls = {"gemini": cache_config["gemini_ttl"], "openai": cache_config["openai_ttl"]}
+        return cls(cache_config["path"], cache_config["max_entries"], ttls)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"媒体上传缓存读取失败，忽略: {str(e)}")
+            return
+        now = time.time()
+        for key, (uri, expires_at) in data.items():
+            if not expires_at or expires_at > now:
+                self._entries[key] = (uri, expires_at)
+        logger.info(f"已加载媒体上传缓存 {len(self._entries)} 条")
+
+    def _write(self, snapshot: Dict[str, Tuple[str, float]]):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"  # 多个 worker 同时写入时互不覆盖临时文件
+        # 文件句柄可用于访问用户上传的媒体，只允许运行服务的用户读写
+        with open(tmp_path, "w", encoding="utf-8", opener=lambda path, flags: os.open(path, flags, 0o600)) as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+    async def _save(self):
+        if not self.path:
+            return
+        try:
+            await asyncio.to_thread(self._write, dict(self._entries))
+        except OSError as e:
+            logger.warning(f"媒体上传缓存写入失败: {str(e)}")
+
+    @staticmethod
+    def _key(provider: str, api_key: str, digest: str) -> str:
+        # 文件只对上传时使用的 key 所属项目可见，因此键中包含 key 的指纹
+        key_fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+        return f"{provider}:{key_fingerprint}:{digest}"
+
+    def _lookup(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        uri, expires_at = entry
+        if expires_at and expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return uri
+
+    async def get_or_upload(self, provider: str, api_key: str, raw, upload: Callable[[], Awaitable[str]]) -> str:
+        """
+        命中缓存时直接返回 uri，否则调用 upload() 上传并缓存结果。
+
+        :param provider: "gemini" 或 "openai"，决定过期时间
+        :param api_key: 上传使用的 key
+        :param raw: 原始文件内容（bytes 或 memoryview），用于计算哈希
+        :param upload: 实际执行上传的协程函数
+        """
+        key = self._key(provider, api_key or "", await sha256_hex(raw))
+        uri = self._lookup(key)
+        if uri is not None:
+            self.hits += 1
+            logger.info(f"媒体上传缓存命中: {uri}")
+            return uri
+
+        if key in self._inflight:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return await self._inflight.run(key, lambda: self._upload(key, provider, upload))
+
+    async def _upload(self, key: str, provider: str, upload: Callable[[], Awaitable[str]]) -> str:
+        uri = await upload()
+        ttl = self.ttls.get(provider, 0)
+        self._entries[key] = (uri, time.time() + ttl if ttl else 0)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        await self._save()
+        return uri
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+_media_cache: Optional[MediaUploadCache] = None
+
+def get_media_cache(config) -> MediaUploadCache:
+    """全局媒体上传缓存，首次使用时按配置创建"""
+    global _media_cache
+    if _media_cache is None:
+        _media_cache = MediaUploadCache.from_config(config)
+    return _media_cache
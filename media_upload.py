@@ -0,0 +1,252 @@
+import asyncio
+import io
+import logging
+import os
+import tempfile
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
+import httpx
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认上传配置，可在 config/api.yaml 的 upload 中覆盖
+DEFAULT_UPLOAD_CONFIG = {
+    "chunk_size": 8 * 1024 * 1024,  # Gemini 要求除最后一块外都是 256 KiB 的整数倍
+    "max_retries": 5,
+    "retry_backoff": 1.0,
+    "chunk_timeout": 120,
+    "max_concurrent_attachments": 4,  # 同一条消息中同时处理的附件数
+}
+
+GRANULARITY = 256 * 1024
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+# 可上传的内容：bytes/memoryview、文件路径，或异步字节迭代器（需要同时给出 size）
+UploadSource = Union[bytes, bytearray, memoryview, str, os.PathLike, AsyncIterator[bytes]]
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+def get_upload_config(config) -> Dict:
+    upload_config = dict(DEFAULT_UPLOAD_CONFIG)
+    upload_config.update(config.api.get("upload") or {})
+    chunk_size = max(int(upload_config["chunk_size"]) // GRANULARITY, 1) * GRANULARITY
+    upload_config["chunk_size"] = chunk_size
+    return upload_config
+
+def source_size(source: UploadSource, size: Optional[int] = None) -> int:
+    if size is not None:
+        return size
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source).nbytes
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    raise ValueError("异步迭代器上传需要提供 size")
+
+async def iter_chunks(source: UploadSource, chunk_size: int) -> AsyncIterator[bytes]:
+    """按 chunk_size 读取上传内容，文件在线程中读取，不会整体载入内存"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for offset in range(0, view.nbytes, chunk_size):
+            yield view[offset:offset + chunk_size].tobytes()
+    elif isinstance(source, (str, os.PathLike)):
+        f = await asyncio.to_thread(open, source, "rb")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+    else:
+        # 迭代器给出的块大小不定，重新切成固定大小
+        buffer = bytearray()
+        async for data in source:
+            buffer.extend(data)
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+        if buffer:
+            yield bytes(buffer)
+
+def log_throughput(target: str, nbytes: int, started: float, retries: int = 0):
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    logger.info(f"{target} 上传完成: {nbytes / 1024 / 1024:.2f} MiB, 用时 {elapsed:.2f}s, "
+                f"{nbytes / 1024 / 1024 / elapsed:.2f} MiB/s, 重试 {retries} 次")
+
+class GeminiResumableUpload:
+    """
+    Gemini 文件接口的可恢复上传 (X-Goog-Upload-Protocol: resumable)。
+
+    先 start 获取上传地址，再按块 upload，最后一块带 finalize；
+    某块失败时用 query 询问服务端已收到的字节数，从该位置继续。
+    """
+
+    def __init__(self, client: httpx.AsyncClient, base_url: str, key: str, upload_config: Dict):
+        self.client = client
+        self.base_url = base_url
+        self.key = key
+        self.chunk_size = upload_config["chunk_size"]
+        self.max_retries = upload_config["max_retries"]
+        self.retry_backoff = upload_config["retry_backoff"]
+        self.chunk_timeout = upload_config["chunk_timeout"]
+        self.retries = 0
+
+    async def start(self, size: int, mime_type: str, display_name: str) -> str:
+        headers = {
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(size),
+            "X-Goog-Upload-Header-Content-Type": mime_type,
+            "Content-Type": "application/json",
+        }
+        response = await self.client.post(f"{self.base_url}/upload/v1beta/files?key={self.key}", headers=headers,
+                                          json={"file": {"display_name": display_name}}, timeout=self.chunk_timeout)
+        upload_url = response.headers.get("x-goog-upload-url")
+        if response.status_code != 200 or not upload_url:
+            raise UploadError(response.status_code, f"创建上传会话失败: {response.text}")
+        return upload_url
+
+    async def query(self, upload_url: str) -> Tuple[str, int, httpx.Response]:
+        """返回 (上传状态, 服务端已收到的字节数, 响应)"""
+        response = await self.client.post(upload_url, headers={"X-Goog-Upload-Command": "query"},
+                                          timeout=self.chunk_timeout)
+        if response.status_code != 200:
+            raise UploadError(response.status_code, f"查询上传进度失败: {response.text}")
+        status = response.headers.get("x-goog-upload-status", "active")
+        received = int(response.headers.get("x-goog-upload-size-received", 0))
+        return status, received, response
+
+    async def send_chunk(self, upload_url: str, chunk: bytes, offset: int, final: bool) -> Optional[httpx.Response]:
+        """
+        上传 [offset, offset + len(chunk)) 这一块，失败时查询进度并续传。
+
+        :return: finalize 时返回包含文件信息的响应
+        """
+        sent = 0
+        attempt = 0
+        while True:
+            command = "upload, finalize" if final else "upload"
+            try:
+                response = await self.client.post(upload_url, content=chunk[sent:], timeout=self.chunk_timeout, headers={
+                    "X-Goog-Upload-Command": command,
+                    "X-Goog-Upload-Offset": str(offset + sent),
+                })
+                if response.status_code == 200:
+                    return response if final else None
+                if response.status_code not in RETRY_STATUS:
+                    raise UploadError(response.status_code, response.text)
+                error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {str(e)}"
+
+            attempt += 1
+            self.retries += 1
+            if attempt > self.max_retries:
+                raise UploadError(503, f"上传在偏移 {offset + sent} 处失败，已重试 {self.max_retries} 次: {error}")
+            logger.warning(f"上传块失败 ({error})，{self.retry_backoff * attempt:.1f}s 后查询进度并续传")
+            await asyncio.sleep(self.retry_backoff * attempt)
+            try:
+                status, received, response = await self.query(upload_url)
+            except httpx.TransportError as e:
+                logger.warning(f"查询上传进度失败: {str(e)}")
+                continue
+            if status == "final":
+                return response if final else None
+            if status != "active":
+                raise UploadError(410, f"上传会话已失效: {status}")
+            if received >= offset + len(chunk):
+                return None
+            sent = max(received - offset, 0)
+
+    async def upload(self, source: UploadSource, mime_type: str, size: Optional[int] = None,
+                     display_name: str = "upload") -> Dict:
+        """上传并返回服务端的 file 对象"""
+        started = time.perf_counter()
+        total = source_size(source, size)
+        upload_url = await self.start(total, mime_type, display_name)
+        offset = 0
+        response = None
+        async for chunk in iter_chunks(source, self.chunk_size):
+            final = offset + len(chunk) >= total
+            response = await self.send_chunk(upload_url, chunk, offset, final)
+            offset += len(chunk)
+            if final:
+                break
+        if offset != total:
+            raise UploadError(400, f"上传内容长度 {offset} 与声明的 {total} 不一致")
+        if response is None:
+            # 空文件或最后一块由 query 确认
+            response = await self.send_chunk(upload_url, b"", offset, True)
+        log_throughput("Gemini", total, started, self.retries)
+        return response.json().get("file", {})
+
+class MemoryviewReader(io.RawIOBase):
+    """
+    只读的类文件对象，按需从 memoryview 切出每次 read 的块。
+
+    与 BytesIO 不同，构造时不复制整个缓冲区，mmap 的文件和 MediaBlob 的视图保持零拷贝。
+    """
+
+    def __init__(self, data):
+        super().__init__()
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        end = self._view.nbytes if size is None or size < 0 else min(self._position + size, self._view.nbytes)
+        chunk = self._view[self._position:end].tobytes()
+        self._position = max(end, self._position)
+        return chunk
+
+    def readinto(self, buffer) -> int:
+        chunk = self.read(memoryview(buffer).nbytes)
+        memoryview(buffer)[:len(chunk)] = chunk
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._view.nbytes}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+async def open_for_multipart(source: UploadSource, size: Optional[int] = None):
+    """
+    把上传内容转成可供 httpx multipart 逐块读取的文件对象。
+
+    路径直接打开；bytes/memoryview 包装为 MemoryviewReader，不复制整个缓冲区；
+    异步迭代器先写入临时文件。调用方负责关闭返回的文件对象。
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return MemoryviewReader(source)
+    if isinstance(source, (str, os.PathLike)):
+        return await asyncio.to_thread(open, source, "rb")
+    spool = tempfile.TemporaryFile()
+    try:
+        async for chunk in source:
+            await asyncio.to_thread(spool.write, chunk)
+        await asyncio.to_thread(spool.seek, 0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
@@ -1,6 +1,17 @@
 import base64
+import binascii
+import mmap
+import os
 from pathlib import Path
 from typing import Dict, Any
+from executors import run_in_thread
+
+# 超过该字节数的 base64 编解码在线程池中分段执行，避免阻塞事件循环
+OFFLOAD_BYTES = 1024 * 1024
+# 分段大小，3 的倍数保证各段编码结果可以直接拼接；段与段之间会释放 GIL
+B64_CHUNK = 3 * 1024 * 1024
+# base64 解码时忽略的空白字符
+B64_WHITESPACE = " \t\r\n\v\f"
 
 # 多模态输入类
 class Text:
@@ -11,131 +22,239 @@ class Text:
     def to_dict(self):
         return {"text": self.content}
 
-class Image:
+class MediaBlob:
+    """
+    媒体内容的统一表示：原始字节、内存视图或按需 mmap 的文件。
+
+    base64 只在第一次需要时计算并缓存，nbytes 不需要解码即可得到。
+    """
+    __slots__ = ("_data", "_path", "_mmap", "_base64", "_nbytes")
+
+    def __init__(self, data=None, path: str = None, base64_str: str = None):
+        self._data = data  # bytes / bytearray / memoryview
+        self._path = path
+        self._mmap = None
+        self._base64 = base64_str
+        self._nbytes = None
+
+    @classmethod
+    def from_bytes(cls, data) -> "MediaBlob":
+        return cls(data=data)
+
+    @classmethod
+    def from_path(cls, path: str) -> "MediaBlob":
+        return cls(path=str(path))
+
+    @classmethod
+    def from_base64(cls, base64_str: str) -> "MediaBlob":
+        return cls(base64_str=base64_str)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def nbytes(self) -> int:
+        """原始内容的字节数，不触发读取或解码"""
+        if self._nbytes is None:
+            if self._data is not None:
+                self._nbytes = memoryview(self._data).nbytes
+            elif self._path is not None:
+                self._nbytes = os.path.getsize(self._path)
+            else:
+                self._nbytes = b64_decoded_size(self._base64)
+        return self._nbytes
+
+    def view(self) -> memoryview:
+        """零拷贝访问原始内容；文件在第一次访问时以只读方式 mmap"""
+        if self._data is None:
+            if self._path is not None:
+                if self.nbytes == 0:
+                    self._data = b""
+                else:
+                    with open(self._path, "rb") as f:
+                        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._data = self._mmap
+            else:
+                self._data = base64.b64decode(self._base64)
+        return memoryview(self._data)
+
+    async def aview(self) -> memoryview:
+        """同 view()，大块 base64 在线程池中解码"""
+        if self._data is None and self._path is None and self.nbytes >= OFFLOAD_BYTES:
+            self._data = await run_in_thread(b64decode_chunked, self._base64)
+        return self.view()
+
+    def tobytes(self) -> bytes:
+        """返回 bytes，底层已经是 bytes 时不拷贝"""
+        if isinstance(self._data, bytes):
+            return self._data
+        return self.view().tobytes()
+
+    @property
+    def b64(self) -> str:
+        """base64 字符串，只计算一次"""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.view()).decode("utf-8")
+        return self._base64
+
+    async def ab64(self) -> str:
+        """同 b64，大块内容在线程池中编码"""
+        if self._base64 is None and self.nbytes >= OFFLOAD_BYTES:
+            self._base64 = await run_in_thread(b64encode_chunked, await self.aview())
+        return self.b64
+
+    def close(self):
+        if self._mmap is not None:
+            self._data = None
+            self._mmap.close()
+            self._mmap = None
+
+class MediaSource(dict):
+    """
+    媒体对象的 source：只保存 mime_type 和 filename，内容在 blob 中。
+
+    兼容旧代码（webui 监听函数等）读写 source["base64"]：读取时由 blob 按需编码并缓存，
+    写入时替换 blob。迭代、json.dumps 等不包含 base64，需要内联数据时请使用 to_dict()。
+    """
+
+    def __init__(self, media: "_Media"):
+        super().__init__()
+        self._media = media
+
+    def __getitem__(self, key):
+        if key == "base64":
+            if self._media.blob is None:
+                raise KeyError(key)
+            return self._media.blob.b64
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if key == "base64":
+            self._media.blob = MediaBlob.from_base64(value)
+            return
+        super().__setitem__(key, value)
+
+    def __contains__(self, key) -> bool:
+        if key == "base64":
+            return self._media.blob is not None
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class _Media:
+    """图片/音频/视频/文件的公共实现，内容保存在 blob 中，source 见 MediaSource"""
+    type = "file"
+    default_mime_type = "application/octet-stream"
+    default_name = "file"
+
     def __init__(self, path: str = None, url: str = None, base64: str = None, byte: bytes = None, mime_type: str = None):
-        self.type = "image"
-        self.source = {}
+        self.source = MediaSource(self)
         self.url = url  # 保存 URL，延迟异步处理
+        self.blob = None
         if path:
-            self.source["base64"] = encode_file_to_base64(Path(path).read_bytes())
+            self.blob = MediaBlob.from_path(path)
             self.source["mime_type"] = get_mime_type(path)
             self.source["filename"] = Path(path).name
         elif url:
-            self.source["mime_type"] = mime_type or "image/jpeg"
-            self.source["filename"] = url.split("/")[-1] or "downloaded_image"
+            self.source["mime_type"] = mime_type or self.default_mime_type
+            self.source["filename"] = url.split("/")[-1] or f"downloaded_{self.default_name}"
         elif base64:
-            self.source["base64"] = base64
-            self.source["mime_type"] = mime_type or "image/jpeg"
-            self.source["filename"] = "inline_image"
+            self.blob = MediaBlob.from_base64(base64)
+            self.source["mime_type"] = mime_type or self.default_mime_type
+            self.source["filename"] = f"inline_{self.default_name}"
         elif byte:
-            self.source["base64"] = encode_file_to_base64(byte)
-            self.source["mime_type"] = mime_type or "image/jpeg"
-            self.source["filename"] = "byte_image"
+            self.blob = MediaBlob.from_bytes(byte)
+            self.source["mime_type"] = mime_type or self.default_mime_type
+            self.source["filename"] = f"byte_{self.default_name}"
 
-    async def to_dict(self):
-        if self.url and "base64" not in self.source:
+    async def load(self) -> MediaBlob:
+        """确保内容可用，URL 来源在此时下载"""
+        if self.blob is None and self.url:
             data = await download_and_encode_file(self.url)
-            self.source["base64"] = data["data"]
+            self.blob = MediaBlob.from_base64(data["data"])
             self.source["mime_type"] = data["mime_type"]
-        return {"inline_data": {"mime_type": self.source["mime_type"], "data": self.source["base64"]}}
+        return self.blob
 
-class Audio:
-    def __init__(self, path: str = None, url: str = None, base64: str = None, byte: bytes = None, mime_type: str = None):
-        self.type = "audio"
-        self.source = {}
-        self.url = url
-        if path:
-            self.source["base64"] = encode_file_to_base64(Path(path).read_bytes())
-            self.source["mime_type"] = get_mime_type(path)
-            self.source["filename"] = Path(path).name
-        elif url:
-            self.source["mime_type"] = mime_type or "audio/mpeg"
-            self.source["filename"] = url.split("/")[-1] or "downloaded_audio"
-        elif base64:
-            self.source["base64"] = base64
-            self.source["mime_type"] = mime_type or "audio/mpeg"
-            self.source["filename"] = "inline_audio"
-        elif byte:
-            self.source["base64"] = encode_file_to_base64(byte)
-            self.source["mime_type"] = mime_type or "audio/mpeg"
-            self.source["filename"] = "byte_audio"
+    async def inline_dict(self):
+        return {"inline_data": {"mime_type": self.source["mime_type"], "data": await self.blob.ab64()}}
+
+    async def to_dict(self):
+        await self.load()
+        return await self.inline_dict()
+
+class Image(_Media):
+    type = "image"
+    default_mime_type = "image/jpeg"
+    default_name = "image"
+
+class Audio(_Media):
+    type = "audio"
+    default_mime_type = "audio/mpeg"
+    default_name = "audio"
 
     async def to_dict(self, upload: bool = False):
-        if self.url and "base64" not in self.source:
-            data = await download_and_encode_file(self.url)
-            self.source["base64"] = data["data"]
-            self.source["mime_type"] = data["mime_type"]
+        await self.load()
         if upload:
-            file_uri = await upload_to_gemini_media(base64.b64decode(self.source["base64"]), self.source["mime_type"])
+            file_uri = await upload_to_gemini_media(self.blob.path or await self.blob.aview(), self.source["mime_type"])
             return {"fileData": {"mimeType": self.source["mime_type"], "fileUri": file_uri}}
-        return {"inline_data": {"mime_type": self.source["mime_type"], "data": self.source["base64"]}}
+        return await self.inline_dict()
 
-class Video:
-    def __init__(self, path: str = None, url: str = None, base64: str = None, byte: bytes = None, mime_type: str = None):
-        self.type = "video"
-        self.source = {}
-        self.url = url
-        if path:
-            self.source["base64"] = encode_file_to_base64(Path(path).read_bytes())
-            self.source["mime_type"] = get_mime_type(path)
-            self.source["filename"] = Path(path).name
-        elif url:
-            self.source["mime_type"] = mime_type or "video/mp4"
-            self.source["filename"] = url.split("/")[-1] or "downloaded_video"
-        elif base64:
-            self.source["base64"] = base64
-            self.source["mime_type"] = mime_type or "video/mp4"
-            self.source["filename"] = "inline_video"
-        elif byte:
-            self.source["base64"] = encode_file_to_base64(byte)
-            self.source["mime_type"] = mime_type or "video/mp4"
-            self.source["filename"] = "byte_video"
+class Video(_Media):
+    type = "video"
+    default_mime_type = "video/mp4"
+    default_name = "video"
 
     async def to_dict(self, upload: bool = False):
-        if self.url and "base64" not in self.source:
-            data = await download_and_encode_file(self.url)
-            self.source["base64"] = data["data"]
-            self.source["mime_type"] = data["mime_type"]
+        await self.load()
         if upload:
-            file_uri = await upload_to_gemini_media(base64.b64decode(self.source["base64"]), self.source["mime_type"])
+            file_uri = await upload_to_gemini_media(self.blob.path or await self.blob.aview(), self.source["mime_type"])
             return {"fileData": {"mimeType": self.source["mime_type"], "fileUri": file_uri}}
-        return {"inline_data": {"mime_type": self.source["mime_type"], "data": self.source["base64"]}}
+        return await self.inline_dict()
 
-class CustomFile:
-    def __init__(self, path: str = None, url: str = None, base64: str = None, byte: bytes = None, mime_type: str = None):
-        self.type = "file"
-        self.source = {}
-        self.url = url
-        if path:
-            self.source["base64"] = encode_file_to_base64(Path(path).read_bytes())
-            self.source["mime_type"] = get_mime_type(path)
-            self.source["filename"] = Path(path).name
-        elif url:
-            self.source["mime_type"] = mime_type or "application/octet-stream"
-            self.source["filename"] = url.split("/")[-1] or "downloaded_file"
-        elif base64:
-            self.source["base64"] = base64
-            self.source["mime_type"] = mime_type or "application/octet-stream"
-            self.source["filename"] = "inline_file"
-        elif byte:
-            self.source["base64"] = encode_file_to_base64(byte)
-            self.source["mime_type"] = mime_type or "application/octet-stream"
-            self.source["filename"] = "byte_file"
+class CustomFile(_Media):
+    type = "file"
+    default_mime_type = "application/octet-stream"
+    default_name = "file"
 
     async def to_dict(self, upload: bool = False):
-        if self.url and "base64" not in self.source:
-            data = await download_and_encode_file(self.url)
-            self.source["base64"] = data["data"]
-            self.source["mime_type"] = data["mime_type"]
-        if upload and len(base64.b64decode(self.source["base64"])) > 20 * 1024 * 1024:
-            file_uri = await upload_to_gemini_media(base64.b64decode(self.source["base64"]), self.source["mime_type"])
+        await self.load()
+        if upload and self.blob.nbytes > 20 * 1024 * 1024:
+            file_uri = await upload_to_gemini_media(self.blob.path or await self.blob.aview(), self.source["mime_type"])
             return {"fileData": {"mimeType": self.source["mime_type"], "fileUri": file_uri}}
-        return {"inline_data": {"mime_type": self.source["mime_type"], "data": self.source["base64"]}}
+        return await self.inline_dict()
 
 # 辅助函数
 def encode_file_to_base64(file_content: bytes) -> str:
     return base64.b64encode(file_content).decode("utf-8")
 
+def b64encode_chunked(data) -> str:
+    view = memoryview(data)
+    return "".join(base64.b64encode(view[i:i + B64_CHUNK]).decode("ascii") for i in range(0, view.nbytes, B64_CHUNK))
+
+def b64_decoded_size(text: str) -> int:
+    """base64 解码后的字节数，不解码也不拷贝；忽略 MIME 等格式按行折断时插入的换行和空白"""
+    chars = len(text) - sum(text.count(char) for char in B64_WHITESPACE)
+    padding = 0
+    for char in reversed(text):
+        if char == "=":
+            padding += 1
+        elif char not in B64_WHITESPACE:
+            break
+    return chars * 3 // 4 - padding
+
+def b64decode_chunked(text: str) -> bytes:
+    step = B64_CHUNK // 3 * 4
+    try:
+        return b"".join(base64.b64decode(text[i:i + step]) for i in range(0, len(text), step))
+    except binascii.Error:
+        # 含换行等非 base64 字符时分段边界可能错位，整体解码
+        return base64.b64decode(text)
+
 def get_mime_type(file_path: str) -> str:
     extension = Path(file_path).suffix.lower() if '.' in file_path else '.bin'
     mime_types = {
@@ -150,4 +269,45 @@ async def download_and_encode_file(url: str) -> Dict[str, str]:
     raise NotImplementedError("download_and_encode_file 必须由外部模块实现")
 
 async def upload_to_gemini_media(file_content: bytes, mime_type: str) -> str:
-    raise NotImplementedError("upload_to_gemini_media 必须由外部模块实现")
\ No newline at end of file
+    raise NotImplementedError("upload_to_gemini_media 必须由外部模块实现")
+# 峰值内存测试：在独立进程中处理一条 200 MB 视频消息（构造、取大小、按上传分块读取全部内容）
+UPLOAD_CHUNK = 8 * 1024 * 1024
+
+def _video_message_peak_rss(scenario: str, path: str) -> float:
+    import hashlib
+    import resource
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    digest = hashlib.sha256()
+    if scenario == "base64 字符串":
+        # 旧实现：构造时读入整个文件并编码，判断大小和上传时各解码一次
+        source = {"base64": encode_file_to_base64(Path(path).read_bytes())}
+        size = len(base64.b64decode(source["base64"]))
+        content = base64.b64decode(source["base64"])
+    else:
+        video = Video(path=path)
+        size = video.blob.nbytes
+        content = video.blob.view()
+    for offset in range(0, size, UPLOAD_CHUNK):
+        digest.update(content[offset:offset + UPLOAD_CHUNK])
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (after - before) / 1024  # Linux 上 ru_maxrss 以 KiB 为单位
+
+def main():
+    import tempfile
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    size_mb = 200
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+        f.flush()
+        for scenario in ("base64 字符串", "MediaBlob"):
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                growth = pool.submit(_video_message_peak_rss, scenario, f.name).result()
+            note = "（mmap 映射的文件页属于页缓存，内存紧张时可直接回收）" if scenario == "MediaBlob" else ""
+            print(f"{size_mb} MB 视频消息 / {scenario}: 峰值 RSS 增加 {growth:.0f} MiB{note}")
+
+if __name__ == "__main__":
+    main()
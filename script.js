@@ -16,31 +16,81 @@ let BASE_URL = 'ws://127.0.0.1:8000';
     console.log(`WebSocket URL配置为: ${BASE_URL}`);
 })();
 
+// 服务端签发并签名的用户 ID，用于在服务端区分对话会话；服务端只接受自己签发的 ID
+let userToken = localStorage.getItem('chat-user-token') || '';
+
+// 确认本地保存的 ID 仍然有效（无效时服务端签发新的），同时写入 cookie
+async function ensureUserToken() {
+    const query = userToken ? `?user_id=${encodeURIComponent(userToken)}` : '';
+    const response = await fetch(`${BASE_URL.replace(/^ws/, 'http')}/session${query}`, {
+        method: 'POST',
+        credentials: 'include'
+    });
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+    userToken = (await response.json()).user_id;
+    localStorage.setItem('chat-user-token', userToken);
+    localStorage.removeItem('chat-user-id'); // 旧版本在浏览器生成的 ID，服务端已不再接受
+}
+
 let ws;
 let currentStreamContent = '';
 let currentStreamBubble = null;
+let currentStreamRenderer = null;
 let isStreaming = false;
 let isStreamingEnabled = false;
 let uploadedFiles = [];
+let pendingMediaBatch = null; // 等待二进制帧的媒体消息
+let mediaObjectUrls = []; // 清空聊天时释放
+let reconnectAttempts = 0;
+let reconnectTimer = null;
+let idleClosed = false; // 服务端因空闲断开后不自动重连，下次发送时再连接
+let outgoingQueue = []; // 连接建立前待发送的消息
 const inputBox = document.getElementById('messageInput');
 const dragOverlay = document.getElementById('dragOverlay');
 
 function initWebSocket() {
-    ws = new WebSocket(`${BASE_URL}/ws`);
+    // binary=1 表示支持以二进制帧接收媒体
+    ws = new WebSocket(`${BASE_URL}/ws?user_id=${encodeURIComponent(userToken)}&binary=1`);
+    ws.binaryType = 'arraybuffer';
+    pendingMediaBatch = null;
     ws.onopen = () => {
         console.log("WebSocket 已连接");
         addServerMessage("已连接到服务器");
+        reconnectAttempts = 0;
+        idleClosed = false;
+        const queued = outgoingQueue;
+        outgoingQueue = [];
+        queued.forEach(message => ws.send(message));
     };
     ws.onmessage = async (event) => {
         const data = event.data;
+        if (typeof data !== 'string') {
+            handleBinaryFrame(data);
+            return;
+        }
+        if (data === '{"type": "ping"}') {
+            ws.send('{"type": "pong"}');
+            return;
+        }
         console.log("收到 WebSocket 消息:", data);
         if (data.startsWith('data: ')) {
-            await handleStreamingMessage(data);
+            // 服务端会把多个流式分块合并为一帧，以空行分隔
+            for (const chunk of data.split('\n\n')) {
+                if (chunk.startsWith('data: ')) {
+                    await handleStreamingMessage(chunk);
+                }
+            }
         } else {
             try {
                 const messageData = JSON.parse(data);
                 console.log("解析后的非流式消息:", messageData);
-                renderServerMessage(messageData);
+                if (messageData.type === 'media_batch') {
+                    startMediaBatch(messageData);
+                } else {
+                    renderServerMessage(messageData);
+                }
             } catch (e) {
                 console.error("解析非流式消息失败:", e, "原始数据:", data);
                 addServerMessage(`解析错误: ${e.message}`);
@@ -56,9 +106,9 @@ function initWebSocket() {
             isStreaming = false;
             addServerMessage("流式输出中断，因连接错误");
         }
-        addServerMessage("WebSocket 连接错误，请刷新页面重试");
+        addServerMessage("WebSocket 连接错误");
     };
-    ws.onclose = () => {
+    ws.onclose = (event) => {
         if (isStreaming && currentStreamBubble) {
             currentStreamBubble.remove();
             currentStreamContent = '';
@@ -66,12 +116,78 @@ function initWebSocket() {
             isStreaming = false;
             addServerMessage("流式输出中断，因连接断开");
         }
-        console.log("WebSocket 已断开，尝试重连...");
-        addServerMessage("WebSocket 已断开，正在尝试重连...");
-        setTimeout(initWebSocket, 1000);
+        if (event.code === 4000) {
+            // 空闲断开：不占用服务端连接，发送下一条消息时再重连
+            console.log("WebSocket 因空闲被服务端关闭");
+            idleClosed = true;
+            return;
+        }
+        scheduleReconnect();
     };
 }
-initWebSocket();
+
+// 指数退避重连（1s、2s、4s…最长 30s，加随机抖动），避免服务重启时所有页面同时重连
+function scheduleReconnect() {
+    if (reconnectTimer) return;
+    const delay = Math.min(1000 * 2 ** reconnectAttempts, 30000) * (0.5 + Math.random() / 2);
+    reconnectAttempts++;
+    console.log(`WebSocket 已断开，${Math.round(delay)}ms 后重连...`);
+    addServerMessage("WebSocket 已断开，正在尝试重连...");
+    reconnectTimer = setTimeout(() => {
+        reconnectTimer = null;
+        initWebSocket();
+    }, delay);
+}
+
+// 连接已打开时直接发送，否则排队并在需要时立即重连，连接建立后按顺序发出
+function sendToServer(messageData) {
+    const message = JSON.stringify(messageData);
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(message);
+        return;
+    }
+    outgoingQueue.push(message);
+    if (ws && ws.readyState === WebSocket.CLOSED && (idleClosed || reconnectTimer)) {
+        clearTimeout(reconnectTimer);
+        reconnectTimer = null;
+        idleClosed = false;
+        initWebSocket();
+    }
+}
+// 先取得用户 ID 再连接；取不到时以临时身份连接，对话不会跨连接保留
+ensureUserToken()
+    .catch(error => console.error('获取用户 ID 失败:', error))
+    .finally(initWebSocket);
+
+// 媒体消息：JSON 头中的 source.frame 指向随后第几个二进制帧，收齐后转为 object URL 再渲染
+function startMediaBatch(header) {
+    if (header.frames === 0) {
+        renderServerMessage(header.messages);
+        return;
+    }
+    pendingMediaBatch = { expected: header.frames, messages: header.messages, frames: [] };
+}
+
+function handleBinaryFrame(buffer) {
+    if (!pendingMediaBatch) {
+        console.warn("收到未预期的二进制帧，已忽略");
+        return;
+    }
+    pendingMediaBatch.frames.push(buffer);
+    if (pendingMediaBatch.frames.length < pendingMediaBatch.expected) {
+        return;
+    }
+    const { messages, frames } = pendingMediaBatch;
+    pendingMediaBatch = null;
+    messages.forEach(item => {
+        if (item.source && item.source.frame !== undefined) {
+            const url = URL.createObjectURL(new Blob([frames[item.source.frame]], { type: item.source.mime_type }));
+            mediaObjectUrls.push(url);
+            item.source.url = url;
+        }
+    });
+    renderServerMessage(messages);
+}
 
 (function initMode() {
     if (localStorage.getItem('dark-mode') === 'true') {
@@ -229,6 +345,7 @@ document.body.addEventListener('drop', async (e) => {
     console.log("File dropped, uploading...");
 });
 
+// 附件以原始字节 POST 到 /upload，浏览器直接从磁盘分块发送，不读入内存也不转 base64
 async function uploadFile(file) {
     if (!file) {
         console.error('文件无效');
@@ -242,68 +359,69 @@ async function uploadFile(file) {
     const placeholderNode = pasteToInputBox(placeholder);
 
     try {
-        const reader = new FileReader();
-        reader.onload = (e) => {
-            const base64Data = e.target.result.split(',')[1];
-            const mimeType = file.type || "application/octet-stream";
-            const fileId = Date.now() + Math.random().toString(36).substr(2, 5);
-            uploadedFiles.push({ fileId, file, type: mimeType, base64: base64Data });
-
-            const fileChip = document.createElement('span');
-            fileChip.classList.add('file-chip');
-            if (document.body.classList.contains('dark-mode')) {
-                fileChip.classList.add('dark-mode');
+        const response = await fetch(`${BASE_URL.replace(/^ws/, 'http')}/upload?user_id=${encodeURIComponent(userToken)}`, {
+            method: 'POST',
+            credentials: 'include',
+            headers: {
+                'Content-Type': file.type || 'application/octet-stream',
+                'X-Filename': encodeURIComponent(file.name)
+            },
+            body: file
+        });
+        if (!response.ok) {
+            const error = await response.json().catch(() => ({}));
+            throw new Error(error.detail || `HTTP ${response.status}`);
+        }
+        const uploaded = await response.json();
+        const mimeType = uploaded.mime_type;
+        const fileId = Date.now() + Math.random().toString(36).substr(2, 5);
+        const previewUrl = URL.createObjectURL(file);
+        uploadedFiles.push({ fileId, file, type: mimeType, uploadId: uploaded.upload_id, previewUrl });
+
+        const fileChip = document.createElement('span');
+        fileChip.classList.add('file-chip');
+        if (document.body.classList.contains('dark-mode')) {
+            fileChip.classList.add('dark-mode');
+        }
+        fileChip.setAttribute('contenteditable', 'false'); // 恢复原始设计
+        fileChip.dataset.fileId = fileId;
+
+        const fileNameSpan = document.createElement('span');
+        fileNameSpan.classList.add('file-name');
+        fileNameSpan.textContent = file.name;
+
+        const deleteBtn = document.createElement('button');
+        deleteBtn.classList.add('delete-btn');
+        deleteBtn.textContent = '×';
+        deleteBtn.onclick = (e) => {
+            e.stopPropagation();
+            const fileIndex = uploadedFiles.findIndex(f => f.fileId === fileId);
+            if (fileIndex !== -1) {
+                uploadedFiles.splice(fileIndex, 1);
             }
-            fileChip.setAttribute('contenteditable', 'false'); // 恢复原始设计
-            fileChip.dataset.fileId = fileId;
-
-            const fileNameSpan = document.createElement('span');
-            fileNameSpan.classList.add('file-name');
-            fileNameSpan.textContent = file.name;
-
-            const deleteBtn = document.createElement('button');
-            deleteBtn.classList.add('delete-btn');
-            deleteBtn.textContent = '×';
-            deleteBtn.onclick = (e) => {
-                e.stopPropagation();
-                const fileIndex = uploadedFiles.findIndex(f => f.fileId === fileId);
-                if (fileIndex !== -1) {
-                    uploadedFiles.splice(fileIndex, 1);
-                }
-                fileChip.remove();
-                debouncedAdjustInputHeight();
-            };
-
-            fileChip.onclick = (e) => {
-                e.stopPropagation();
-                const uploadedFile = uploadedFiles.find(f => f.fileId === fileId);
-                if (uploadedFile) {
-                    const { type, base64 } = uploadedFile;
-                    const url = `data:${type};base64,${base64}`;
-                    let previewType = 'file';
-                    if (type.startsWith('image/')) previewType = 'image';
-                    else if (type.startsWith('video/')) previewType = 'video';
-                    else if (type.startsWith('audio/')) previewType = 'audio';
-                    openModal(previewType, url, file.name);
-                }
-            };
-
-            fileChip.appendChild(fileNameSpan);
-            fileChip.appendChild(deleteBtn);
-            replaceInInputBox(placeholderNode, fileChip);
+            URL.revokeObjectURL(previewUrl);
+            fileChip.remove();
             debouncedAdjustInputHeight();
         };
-        reader.onerror = () => {
-            const errorText = document.createTextNode(`${file.name} 读取失败`);
-            replaceInInputBox(placeholderNode, errorText);
-            addServerMessage(`文件读取失败: ${file.name}`);
+
+        fileChip.onclick = (e) => {
+            e.stopPropagation();
+            let previewType = 'file';
+            if (mimeType.startsWith('image/')) previewType = 'image';
+            else if (mimeType.startsWith('video/')) previewType = 'video';
+            else if (mimeType.startsWith('audio/')) previewType = 'audio';
+            openModal(previewType, previewUrl, file.name);
         };
-        reader.readAsDataURL(file);
+
+        fileChip.appendChild(fileNameSpan);
+        fileChip.appendChild(deleteBtn);
+        replaceInInputBox(placeholderNode, fileChip);
+        debouncedAdjustInputHeight();
     } catch (error) {
-        console.error('文件处理失败:', error);
-        const errorText = document.createTextNode(`${file.name} 处理失败: ${error.message}`);
+        console.error('文件上传失败:', error);
+        const errorText = document.createTextNode(`${file.name} 上传失败`);
         replaceInInputBox(placeholderNode, errorText);
-        addServerMessage(`文件处理失败: ${error.message}`);
+        addServerMessage(`文件上传失败: ${file.name}: ${error.message}`);
     }
 }
 
@@ -362,7 +480,7 @@ function getInputContent() {
             const fileId = child.dataset.fileId;
             const uploadedFile = uploadedFiles.find(f => f.fileId === fileId);
             if (uploadedFile) {
-                const { type, base64 } = uploadedFile;
+                const { type, uploadId, previewUrl } = uploadedFile;
                 let msgType = "file";
                 if (type.startsWith('image/')) msgType = "image";
                 else if (type.startsWith('video/')) msgType = "video";
@@ -370,7 +488,8 @@ function getInputContent() {
                 content.push({
                     type: msgType,
                     source: {
-                        base64: base64,
+                        upload_id: uploadId,
+                        url: previewUrl, // 仅用于本地显示，发送时去掉
                         mime_type: type,
                         filename: uploadedFile.file.name
                     }
@@ -384,12 +503,17 @@ function getInputContent() {
     return content;
 }
 
-function createMediaElementFromBase64(type, base64Data, mimeType, name) {
+// 媒体地址：服务端以二进制帧发送的内容已转为 object URL，其余使用 base64 data URL
+function mediaSrc(source) {
+    return source.url || `data:${source.mime_type};base64,${source.base64}`;
+}
+
+function createMediaElementFromUrl(type, src, name) {
     const container = document.createElement('div');
     container.classList.add('media-container');
 
     const media = document.createElement(type);
-    media.src = `data:${mimeType};base64,${base64Data}`;
+    media.src = src;
     media.preload = 'metadata';
 
     const fileNameSpan = document.createElement('span');
@@ -463,12 +587,12 @@ function createMediaElementFromBase64(type, base64Data, mimeType, name) {
     return container;
 }
 
-function renderMediaFromBase64(base64Data, mimeType, alt = "Media", name = "unnamed_image") {
+function renderMediaFromUrl(src, alt = "Media", name = "unnamed_image") {
     const container = document.createElement('div');
     container.classList.add('media-container');
 
     const img = document.createElement('img');
-    img.src = `data:${mimeType};base64,${base64Data}`;
+    img.src = src;
     img.alt = alt;
     img.style.maxWidth = "100%";
 
@@ -484,10 +608,10 @@ function renderMediaFromBase64(base64Data, mimeType, alt = "Media", name = "unna
     return container;
 }
 
-function createAudioInteraction(base64Data, mimeType, name) {
+function createAudioInteraction(src, name) {
     const container = document.createElement('div');
     container.classList.add('audio-interaction');
-    container.onclick = () => openModal('audio', `data:${mimeType};base64,${base64Data}`, name);
+    container.onclick = () => openModal('audio', src, name);
 
     const icon = document.createElement('div');
     icon.classList.add('audio-icon');
@@ -501,7 +625,7 @@ function createAudioInteraction(base64Data, mimeType, name) {
     return container;
 }
 
-function renderFile(base64Data, mimeType, name) {
+function renderFile(src, name) {
     const container = document.createElement('div');
     container.classList.add('file-container');
 
@@ -520,7 +644,7 @@ function renderFile(base64Data, mimeType, name) {
     downloadBtn.classList.add('download-btn');
     downloadBtn.onclick = () => {
         const a = document.createElement('a');
-        a.href = `data:${mimeType};base64,${base64Data}`;
+        a.href = src;
         a.download = name;
         a.click();
     };
@@ -650,18 +774,18 @@ function openNodeModal(messages) {
                     textDiv.innerHTML = htmlContent;
                     messageDiv.appendChild(textDiv);
                 } else if (item.type === 'image') {
-                    const imgContainer = renderMediaFromBase64(item.source.base64, item.source.mime_type, "Image from server", item.source.filename || "unnamed_image");
+                    const imgContainer = renderMediaFromUrl(mediaSrc(item.source), "Image from server", item.source.filename || "unnamed_image");
                     messageDiv.appendChild(imgContainer);
                 } else if (item.type === 'video') {
-                    const videoContainer = createMediaElementFromBase64('video', item.source.base64, item.source.mime_type, item.source.filename || "unnamed_video");
+                    const videoContainer = createMediaElementFromUrl('video', mediaSrc(item.source), item.source.filename || "unnamed_video");
                     const video = videoContainer.querySelector('video');
                     video.onclick = () => openModal('video', video.src, item.source.filename || "unnamed_video");
                     messageDiv.appendChild(videoContainer);
                 } else if (item.type === 'audio') {
-                    const audioInteraction = createAudioInteraction(item.source.base64, item.source.mime_type, item.source.filename || "unnamed_audio");
+                    const audioInteraction = createAudioInteraction(mediaSrc(item.source), item.source.filename || "unnamed_audio");
                     messageDiv.appendChild(audioInteraction);
                 } else if (item.type === 'file') {
-                    const fileContainer = renderFile(item.source.base64, item.source.mime_type, item.source.filename || "unnamed_file");
+                    const fileContainer = renderFile(mediaSrc(item.source), item.source.filename || "unnamed_file");
                     messageDiv.appendChild(fileContainer);
                 }
             });
@@ -672,18 +796,18 @@ function openNodeModal(messages) {
                 textDiv.innerHTML = htmlContent;
                 messageDiv.appendChild(textDiv);
             } else if (message.type === 'image') {
-                const imgContainer = renderMediaFromBase64(message.source.base64, message.source.mime_type, "Image from server", message.source.filename || "unnamed_image");
+                const imgContainer = renderMediaFromUrl(mediaSrc(message.source), "Image from server", message.source.filename || "unnamed_image");
                 messageDiv.appendChild(imgContainer);
             } else if (message.type === 'video') {
-                const videoContainer = createMediaElementFromBase64('video', message.source.base64, message.source.mime_type, message.source.filename || "unnamed_video");
+                const videoContainer = createMediaElementFromUrl('video', mediaSrc(message.source), message.source.filename || "unnamed_video");
                 const video = videoContainer.querySelector('video');
                 video.onclick = () => openModal('video', video.src, message.source.filename || "unnamed_video");
                 messageDiv.appendChild(videoContainer);
             } else if (message.type === 'audio') {
-                const audioInteraction = createAudioInteraction(message.source.base64, message.source.mime_type, message.source.filename || "unnamed_audio");
+                const audioInteraction = createAudioInteraction(mediaSrc(message.source), message.source.filename || "unnamed_audio");
                 messageDiv.appendChild(audioInteraction);
             } else if (message.type === 'file') {
-                const fileContainer = renderFile(message.source.base64, message.source.mime_type, message.source.filename || "unnamed_file");
+                const fileContainer = renderFile(mediaSrc(message.source), message.source.filename || "unnamed_file");
                 messageDiv.appendChild(fileContainer);
             }
         }
@@ -768,7 +892,7 @@ function renderMedia(container, content) {
         const altText = match[1];
         const url = match[2];
         if (url.startsWith('data:')) {
-            const imgContainer = renderMediaFromBase64(url.split(',')[1], url.split(';')[0].split(':')[1], altText, altText || "image");
+            const imgContainer = renderMediaFromUrl(url, altText, altText || "image");
             container.appendChild(imgContainer);
         }
     }
@@ -776,8 +900,7 @@ function renderMedia(container, content) {
         const url = match[1];
         if (url.startsWith('data:')) {
             const mimeType = url.split(';')[0].split(':')[1];
-            const base64Data = url.split(',')[1];
-            const videoContainer = createMediaElementFromBase64('video', base64Data, mimeType, "video." + mimeType.split('/')[1]);
+            const videoContainer = createMediaElementFromUrl('video', url, "video." + mimeType.split('/')[1]);
             container.appendChild(videoContainer);
         }
     }
@@ -785,15 +908,14 @@ function renderMedia(container, content) {
         const url = match[1];
         if (url.startsWith('data:')) {
             const mimeType = url.split(';')[0].split(':')[1];
-            const base64Data = url.split(',')[1];
-            const audioInteraction = createAudioInteraction(base64Data, mimeType, "audio." + mimeType.split('/')[1]);
+            const audioInteraction = createAudioInteraction(url, "audio." + mimeType.split('/')[1]);
             container.appendChild(audioInteraction);
         }
     }
     while ((match = pdfRegex.exec(content)) !== null) {
         const url = match[1];
         if (url.startsWith('data:')) {
-            const fileContainer = renderFile(url.split(',')[1], 'application/pdf', "document.pdf");
+            const fileContainer = renderFile(url, "document.pdf");
             container.appendChild(fileContainer);
         }
     }
@@ -816,27 +938,29 @@ async function sendMessage() {
     const content = getInputContent();
     if (content.length === 0) return;
 
-    const hasFailedUploads = uploadedFiles.some(f => !f.base64);
+    const hasFailedUploads = uploadedFiles.some(f => !f.uploadId);
     if (hasFailedUploads) {
         addServerMessage("存在上传失败的文件，请检查后重新发送");
         return;
     }
 
     addUserMessage(content);
+    // 本地预览地址在聊天记录中继续使用，清空聊天时释放
+    uploadedFiles.forEach(f => mediaObjectUrls.push(f.previewUrl));
 
     const messageData = {
-        message: content,
+        message: content.map(item => {
+            if (!item.source) return item;
+            const { url, ...source } = item.source;
+            return { ...item, source };
+        }),
         isStreaming: isStreamingEnabled
     };
-    if (ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify(messageData));
-        if (isStreamingEnabled) {
-            currentStreamContent = '';
-            currentStreamBubble = null;
-            isStreaming = true;
-        }
-    } else {
-        addServerMessage("WebSocket 未连接，请刷新页面重试");
+    sendToServer(messageData);
+    if (isStreamingEnabled) {
+        currentStreamContent = '';
+        currentStreamBubble = null;
+        isStreaming = true;
     }
 
     input.innerHTML = '';
@@ -876,6 +1000,7 @@ function createStreamingBubbleAsync() {
 
             console.log("流式气泡创建完成（异步）:", messageWrapper);
             currentStreamBubble = messageWrapper;
+            currentStreamRenderer = new StreamingMarkdownRenderer(streamingContainer);
             resolve(currentStreamBubble);
         } catch (error) {
             console.error("创建流式气泡错误（异步）:", error);
@@ -885,30 +1010,9 @@ function createStreamingBubbleAsync() {
     });
 }
 
-function renderStreamingContent(fullContent) {
-    if (!currentStreamBubble) {
-        console.error("currentStreamBubble 不存在，无法渲染流式内容");
-        return;
-    }
-    const streamingContainer = currentStreamBubble.querySelector(".streaming-container");
-    if (!streamingContainer) {
-        console.error("未找到 streaming-container 元素");
-        return;
-    }
-
-    streamingContainer.innerHTML = '';
-    try {
-        const htmlContent = marked.parse(fullContent);
-        streamingContainer.innerHTML = htmlContent;
-        streamingContainer.dataset.content = fullContent;
-    } catch (e) {
-        console.error("Markdown 解析错误:", e);
-        streamingContainer.textContent = fullContent;
-        addServerMessage("Markdown 解析失败，已显示原始文本");
-    }
-
-    const pres = streamingContainer.getElementsByTagName("pre");
-    for (let pre of pres) {
+// 给 root 中还没有复制按钮的代码块加上复制按钮
+function addCopyButtons(root) {
+    for (const pre of root.querySelectorAll("pre")) {
         if (!pre.querySelector(".copy-btn")) {
             const codeContent = pre.textContent;
             const copyBtn = document.createElement("button");
@@ -923,8 +1027,100 @@ function renderStreamingContent(fullContent) {
             pre.appendChild(copyBtn);
         }
     }
+}
 
-    autoScrollIfAtBottom(document.getElementById("chatContainer"));
+function markdownFragment(source) {
+    const template = document.createElement("template");
+    try {
+        template.innerHTML = marked.parse(source);
+    } catch (e) {
+        console.error("Markdown 解析错误:", e);
+        template.content.appendChild(document.createTextNode(source));
+    }
+    return template.content;
+}
+
+// 流式 Markdown 增量渲染：已结束的块只解析一次并保留 DOM，每帧只重新解析最后一个未结束的块。
+// 块边界是代码围栏之外的空行，且其后的行不缩进（缩进行可能属于上一个列表项或缩进代码块）。
+class StreamingMarkdownRenderer {
+    constructor(container) {
+        this.container = container;
+        this.source = "";
+        this.committed = 0;  // source 中已渲染为固定块的长度
+        this.boundary = 0;  // 最近找到的块边界
+        this.scanPos = 0;  // 下一行的起始位置，之前的行已扫描
+        this.blankEnd = -1;  // 最近一个围栏外空行的结束位置
+        this.fence = null;  // 未闭合的代码围栏 {char, length}
+        this.tailNodes = [];
+        this.frame = null;
+    }
+
+    append(text) {
+        this.source += text;
+        if (this.frame === null) {
+            // 同一帧内收到的多个分块合并为一次 DOM 更新
+            this.frame = requestAnimationFrame(() => {
+                this.frame = null;
+                this.flush();
+            });
+        }
+    }
+
+    cancel() {
+        if (this.frame !== null) {
+            cancelAnimationFrame(this.frame);
+            this.frame = null;
+        }
+    }
+
+    // 只扫描新到达的完整行，维护围栏状态并记录块边界
+    scan() {
+        let lineEnd;
+        while ((lineEnd = this.source.indexOf("\n", this.scanPos)) !== -1) {
+            const line = this.source.slice(this.scanPos, lineEnd);
+            const fence = /^ {0,3}(`{3,}|~{3,})(.*)$/.exec(line);
+            if (this.fence) {
+                if (fence && fence[1][0] === this.fence.char && fence[1].length >= this.fence.length && !fence[2].trim()) {
+                    this.fence = null;
+                }
+            } else if (fence && !(fence[1][0] === "`" && fence[2].includes("`"))) {
+                if (this.blankEnd !== -1 && !/^[ \t]/.test(line)) {
+                    this.boundary = this.blankEnd;
+                }
+                this.blankEnd = -1;
+                this.fence = { char: fence[1][0], length: fence[1].length };
+            } else if (!line.trim()) {
+                this.blankEnd = lineEnd + 1;
+            } else {
+                if (this.blankEnd !== -1 && !/^[ \t]/.test(line)) {
+                    this.boundary = this.blankEnd;
+                }
+                this.blankEnd = -1;
+            }
+            this.scanPos = lineEnd + 1;
+        }
+    }
+
+    flush() {
+        this.scan();
+        if (this.boundary > this.committed) {
+            const block = this.source.slice(this.committed, this.boundary);
+            const fragment = markdownFragment(block);
+            renderMedia(fragment, block);
+            addCopyButtons(fragment);
+            this.container.insertBefore(fragment, this.tailNodes[0] || null);
+            this.committed = this.boundary;
+        }
+        for (const node of this.tailNodes) {
+            node.remove();
+        }
+        const tail = markdownFragment(this.source.slice(this.committed));
+        addCopyButtons(tail);
+        this.tailNodes = Array.from(tail.childNodes);
+        this.container.appendChild(tail);
+        this.container.dataset.content = this.source;
+        autoScrollIfAtBottom(document.getElementById("chatContainer"));
+    }
 }
 
 async function handleStreamingMessage(data) {
@@ -969,14 +1165,17 @@ async function handleStreamingMessage(data) {
         }
 
         if (content && currentStreamBubble) {
-            console.log("追加流式内容并重新渲染:", content);
+            console.log("追加流式内容:", content);
             currentStreamContent += content;
-            renderStreamingContent(currentStreamContent);
+            currentStreamRenderer.append(content);
         }
 
-        if (isEnd && currentStreamBubble) {
+        if (isEnd) {
+            // 停止生成时服务端也会发送结束帧，此时可能还没有气泡
             console.log("流式结束");
-            finalizeStreamingMessage();
+            if (currentStreamBubble) {
+                finalizeStreamingMessage();
+            }
             isStreaming = false;
             currentStreamContent = "";
             currentStreamBubble = null;
@@ -1028,33 +1227,24 @@ function finalizeStreamingMessage() {
     const streamingContainer = currentStreamBubble.querySelector(".streaming-container");
 
     messageDiv.classList.remove("streaming-active");
+    if (currentStreamRenderer) {
+        currentStreamRenderer.cancel();
+        currentStreamRenderer = null;
+    }
 
+    // 结束时整体解析一次，引用式链接、松散列表等跨块的语法与非流式渲染一致
     streamingContainer.innerHTML = '';
     try {
         const finalHtml = marked.parse(currentStreamContent);
         streamingContainer.innerHTML = finalHtml;
+        renderMedia(streamingContainer, currentStreamContent);
     } catch (e) {
         console.error("Markdown 最终渲染错误:", e);
         streamingContainer.textContent = currentStreamContent;
         addServerMessage("Markdown 解析失败，已显示原始文本");
     }
-
-    const pres = streamingContainer.getElementsByTagName("pre");
-    for (let pre of pres) {
-        if (!pre.querySelector(".copy-btn")) {
-            const codeContent = pre.textContent;
-            const copyBtn = document.createElement("button");
-            copyBtn.textContent = "复制";
-            copyBtn.classList.add("copy-btn");
-            copyBtn.onclick = () => {
-                navigator.clipboard.writeText(codeContent.trim()).then(() => {
-                    copyBtn.textContent = "已复制";
-                    setTimeout(() => (copyBtn.textContent = "复制"), 2000);
-                });
-            };
-            pre.appendChild(copyBtn);
-        }
-    }
+    streamingContainer.dataset.content = currentStreamContent;
+    addCopyButtons(streamingContainer);
 
     checkMarkdownAndAddClass(messageDiv);
     autoScrollIfAtBottom(document.getElementById("chatContainer"));
@@ -1088,18 +1278,18 @@ function renderServerMessage(data) {
             messageDiv.appendChild(textDiv);
             renderMedia(messageDiv, combinedText); // 添加媒体渲染
         } else if (item.type === "image") {
-            const imgContainer = renderMediaFromBase64(item.source.base64, item.source.mime_type, "Image from server", item.source.filename || "unnamed_image");
+            const imgContainer = renderMediaFromUrl(mediaSrc(item.source), "Image from server", item.source.filename || "unnamed_image");
             messageDiv.appendChild(imgContainer);
         } else if (item.type === "video") {
-            const videoContainer = createMediaElementFromBase64('video', item.source.base64, item.source.mime_type, item.source.filename || "unnamed_video");
+            const videoContainer = createMediaElementFromUrl('video', mediaSrc(item.source), item.source.filename || "unnamed_video");
             const video = videoContainer.querySelector('video');
             video.onclick = () => openModal('video', video.src, item.source.filename || "unnamed_video");
             messageDiv.appendChild(videoContainer);
         } else if (item.type === "audio") {
-            const audioInteraction = createAudioInteraction(item.source.base64, item.source.mime_type, item.source.filename || "unnamed_audio");
+            const audioInteraction = createAudioInteraction(mediaSrc(item.source), item.source.filename || "unnamed_audio");
             messageDiv.appendChild(audioInteraction);
         } else if (item.type === "file") {
-            const fileContainer = renderFile(item.source.base64, item.source.mime_type, item.source.filename || "unnamed_file");
+            const fileContainer = renderFile(mediaSrc(item.source), item.source.filename || "unnamed_file");
             messageDiv.appendChild(fileContainer);
         }
     });
@@ -1134,49 +1324,6 @@ function renderServerMessage(data) {
     autoScrollIfAtBottom(chatContainer);
 }
 
-function renderStreamingContent(fullContent) {
-    if (!currentStreamBubble) {
-        console.error("currentStreamBubble 不存在，无法渲染流式内容");
-        return;
-    }
-    const streamingContainer = currentStreamBubble.querySelector(".streaming-container");
-    if (!streamingContainer) {
-        console.error("未找到 streaming-container 元素");
-        return;
-    }
-
-    streamingContainer.innerHTML = '';
-    try {
-        const htmlContent = marked.parse(fullContent);
-        streamingContainer.innerHTML = htmlContent;
-        streamingContainer.dataset.content = fullContent;
-        renderMedia(streamingContainer, fullContent); // 添加媒体渲染
-    } catch (e) {
-        console.error("Markdown 解析错误:", e);
-        streamingContainer.textContent = fullContent;
-        addServerMessage("Markdown 解析失败，已显示原始文本");
-    }
-
-    const pres = streamingContainer.getElementsByTagName("pre");
-    for (let pre of pres) {
-        if (!pre.querySelector(".copy-btn")) {
-            const codeContent = pre.textContent;
-            const copyBtn = document.createElement("button");
-            copyBtn.textContent = "复制";
-            copyBtn.classList.add("copy-btn");
-            copyBtn.onclick = () => {
-                navigator.clipboard.writeText(codeContent.trim()).then(() => {
-                    copyBtn.textContent = "已复制";
-                    setTimeout(() => (copyBtn.textContent = "复制"), 2000);
-                });
-            };
-            pre.appendChild(copyBtn);
-        }
-    }
-
-    autoScrollIfAtBottom(document.getElementById("chatContainer"));
-}
-
 function addUserMessage(content) {
     const chatContainer = document.getElementById("chatContainer");
     const messageWrapper = document.createElement("div");
@@ -1194,18 +1341,18 @@ function addUserMessage(content) {
             }
             messageDiv.appendChild(textDiv);
         } else if (item.type === 'image') {
-            const imgContainer = renderMediaFromBase64(item.source.base64, item.source.mime_type, "Image from user", item.source.filename);
+            const imgContainer = renderMediaFromUrl(mediaSrc(item.source), "Image from user", item.source.filename);
             messageDiv.appendChild(imgContainer);
         } else if (item.type === 'video') {
-            const videoContainer = createMediaElementFromBase64('video', item.source.base64, item.source.mime_type, item.source.filename);
+            const videoContainer = createMediaElementFromUrl('video', mediaSrc(item.source), item.source.filename);
             const video = videoContainer.querySelector('video');
             video.onclick = () => openModal('video', video.src, item.source.filename);
             messageDiv.appendChild(videoContainer);
         } else if (item.type === 'audio') {
-            const audioInteraction = createAudioInteraction(item.source.base64, item.source.mime_type, item.source.filename);
+            const audioInteraction = createAudioInteraction(mediaSrc(item.source), item.source.filename);
             messageDiv.appendChild(audioInteraction);
         } else if (item.type === 'file') {
-            const fileContainer = renderFile(item.source.base64, item.source.mime_type, item.source.filename);
+            const fileContainer = renderFile(mediaSrc(item.source), item.source.filename);
             messageDiv.appendChild(fileContainer);
         }
     });
@@ -1243,22 +1390,26 @@ function toggleMode() {
     }
 }
 
-async function clearChat() {
+// 停止当前回复：服务端取消上游请求和正在执行的函数调用
+function stopGeneration() {
     if (ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({
-            message: [{ type: "text", content: "/clear" }],
-            isStreaming: false
-        }));
-        document.getElementById('chatContainer').innerHTML = '';
-        currentStreamContent = '';
-        currentStreamBubble = null;
-        isStreaming = false;
-    } else {
-        console.error("WebSocket 未连接，无法清除聊天记录");
-        addServerMessage("WebSocket 未连接，请刷新页面重试");
+        ws.send(JSON.stringify({ type: "stop" }));
     }
 }
 
+async function clearChat() {
+    sendToServer({
+        message: [{ type: "text", content: "/clear" }],
+        isStreaming: false
+    });
+    document.getElementById('chatContainer').innerHTML = '';
+    mediaObjectUrls.forEach(url => URL.revokeObjectURL(url));
+    mediaObjectUrls = [];
+    currentStreamContent = '';
+    currentStreamBubble = null;
+    isStreaming = false;
+}
+
 function addServerMessage(content) {
     const chatContainer = document.getElementById("chatContainer");
     const messageWrapper = document.createElement("div");
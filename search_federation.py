@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from context_window import estimate_text_tokens
+from engine_search import baidu_results, searx_results
+from tool_cache import normalize_url
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认聚合搜索配置，可在 config/api.yaml 的 search 中覆盖
+DEFAULT_SEARCH_CONFIG = {
+    "deadline": 8,  # 整体等待上限（秒），之后未返回的搜索引擎结果被丢弃
+    "max_tokens": 2000,  # 合并后结果的估算 token 上限
+    "max_results": 20,
+    "max_snippet_chars": 300,  # 单条结果摘要最多保留的字符数
+    "engines": {
+        "baidu": {},
+        "searx": {},
+    },
+}
+
+# 单个搜索引擎的默认设置
+DEFAULT_ENGINE_CONFIG = {
+    "enabled": True,
+    "weight": 1.0,  # 排名融合时的权重
+    "timeout": 6,  # 该引擎的截止时间（秒）
+    "hedge_after": 2.5,  # 超过该秒数仍未返回时再发一次相同请求，取先返回的一个；0 表示不对冲
+}
+
+# 排名融合常数，越大则各引擎内的名次差异影响越小
+RRF_K = 60
+
+_WHITESPACE = re.compile(r'\s+')
+
+SearchFunc = Callable[[str], Awaitable[List[Dict[str, str]]]]
+
+# 搜索引擎适配器：名称 -> 返回 [{'title', 'link', 'content'}] 的协程函数
+ENGINES: Dict[str, SearchFunc] = {
+    "baidu": baidu_results,
+    "searx": searx_results,
+}
+
+def register_engine(name: str, search: SearchFunc):
+    """注册搜索引擎适配器，之后可在配置的 engines 中启用"""
+    ENGINES[name] = search
+
+def get_search_config(config) -> Dict:
+    search_config = dict(DEFAULT_SEARCH_CONFIG)
+    search_config.update(config.api.get("search") or {})
+    return search_config
+
+async def hedged_call(search: SearchFunc, query: str, timeout: float, hedge_after: float) -> Tuple[List[Dict[str, str]], bool]:
+    """
+    在 timeout 内执行 search(query)，超过 hedge_after 仍未返回时并发发出第二次请求，
+    返回先成功的结果和是否触发了对冲。两次都失败时抛出最后一个异常，超时抛出 TimeoutError。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    tasks = [asyncio.ensure_future(search(query))]
+    hedged = False
+    error: Optional[BaseException] = None
+    try:
+        while tasks:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            wait = min(remaining, hedge_after) if hedge_after and not hedged else remaining
+            done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tasks.remove(task)
+                if task.exception() is None:
+                    return task.result(), hedged
+                error = task.exception()
+            if not done and hedge_after and not hedged:
+                hedged = True
+                tasks.append(asyncio.ensure_future(search(query)))
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def _title_key(title: str) -> Optional[str]:
+    title = _WHITESPACE.sub(" ", title).strip().lower()
+    return f"title:{title}" if len(title) >= 6 else None
+
+class SearchFederation:
+    """
+    聚合多个搜索引擎：各引擎并发执行并有各自的截止时间和对冲请求，
+    结果按 URL（和标题）去重，按加权倒数排名融合排序，最后截断到 token 预算。
+    """
+
+    def __init__(self, engines: Dict[str, Dict[str, Any]], deadline: float, max_tokens: int, max_results: int,
+                 max_snippet_chars: int):
+        self.engines = engines
+        self.deadline = deadline
+        self.max_tokens = max_tokens
+        self.max_results = max_results
+        self.max_snippet_chars = max_snippet_chars
+
+    @classmethod
+    def from_config(cls, config) -> "SearchFederation":
+        search_config = get_search_config(config)
+        engines = {}
+        for name, engine_config in (search_config.get("engines") or {}).items():
+            merged = dict(DEFAULT_ENGINE_CONFIG)
+            merged.update(engine_config or {})
+            if not merged["enabled"]:
+                continue
+            if name not in ENGINES:
+                logger.warning(f"未知的搜索引擎: {name}")
+                continue
+            engines[name] = merged
+        return cls(engines, search_config["deadline"], search_config["max_tokens"], search_config["max_results"],
+                   search_config["max_snippet_chars"])
+
+    async def _run_engine(self, name: str, query: str) -> Tuple[str, List[Dict[str, str]], Dict[str, Any]]:
+        engine_config = self.engines[name]
+        started = time.perf_counter()
+        stats: Dict[str, Any] = {}
+        try:
+            entries, hedged = await hedged_call(ENGINES[name], query, min(engine_config["timeout"], self.deadline),
+                                                engine_config["hedge_after"])
+            stats.update(status="ok", results=len(entries), hedged=hedged)
+        except asyncio.TimeoutError:
+            entries = []
+            stats["status"] = "timeout"
+        except Exception as e:
+            entries = []
+            stats["status"] = f"error: {str(e) or type(e).__name__}"
+        stats["ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return name, entries, stats
+
+    def merge(self, engine_results: List[Tuple[str, List[Dict[str, str]]]]) -> List[Dict[str, Any]]:
+        """去重并按加权倒数排名融合（RRF）排序，多个引擎都返回的结果排名靠前"""
+        merged: List[Dict[str, Any]] = []
+        index: Dict[str, Dict[str, Any]] = {}
+        for name, entries in engine_results:
+            weight = self.engines[name]["weight"]
+            for rank, entry in enumerate(entries, start=1):
+                link = entry.get("link") or ""
+                keys = [normalize_url(link)] if link.startswith(("http://", "https://")) else []
+                title_key = _title_key(entry.get("title") or "")
+                if title_key:
+                    keys.append(title_key)
+                item = next((index[key] for key in keys if key in index), None)
+                if item is None:
+                    item = {"title": entry.get("title") or "无标题", "link": link, "content": entry.get("content") or "",
+                            "engines": [], "score": 0.0}
+                    merged.append(item)
+                elif len(entry.get("content") or "") > len(item["content"]):
+                    item["content"] = entry["content"]
+                if name not in item["engines"]:
+                    item["engines"].append(name)
+                    item["score"] += weight / (RRF_K + rank)
+                for key in keys:
+                    index.setdefault(key, item)
+        merged.sort(key=lambda item: item["score"], reverse=True)
+        return merged[:self.max_results]
+
+    def format(self, results: List[Dict[str, Any]], stats: Dict[str, Dict[str, Any]]) -> str:
+        """把结果格式化为文本，超出 token 预算的结果被省略"""
+        sources = ", ".join(f"{name} {engine_stats.get('results', 0)} 条" for name, engine_stats in stats.items())
+        header = f"搜索结果（{sources}，去重后 {len(results)} 条）:\n"
+        blocks = []
+        used = estimate_text_tokens(header)
+        for item in results:
+            content = item["content"]
+            if len(content) > self.max_snippet_chars:
+                content = content[:self.max_snippet_chars] + "..."
+            block = (f"标题: {item['title']}\n链接: {item['link']}\n内容: {content}\n"
+                     f"来源: {', '.join(item['engines'])}\n{'-' * 20}")
+            tokens = estimate_text_tokens(block)
+            if used + tokens > self.max_tokens and blocks:
+                blocks.append(f"...(另有 {len(results) - len(blocks)} 条结果因长度限制省略)")
+                break
+            blocks.append(block)
+            used += tokens
+        return header + "\n".join(blocks)
+
+    async def search(self, query: str) -> str:
+        """并发查询所有启用的搜索引擎并返回合并后的文本，全部失败时返回空字符串"""
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(self._run_engine(name, query) for name in self.engines))
+        stats = {name: engine_stats for name, _, engine_stats in outcomes}
+        results = self.merge([(name, entries) for name, entries, _ in outcomes])
+        logger.info(f"聚合搜索 {query!r}: {(time.perf_counter() - started) * 1000:.1f}ms {stats}")
+        if not results:
+            return ""
+        return self.format(results, stats)
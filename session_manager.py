@@ -0,0 +1,357 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import re
+import secrets
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Set
+from history_store import HistoryStore, MemoryHistoryStore, create_history_store
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认会话配置，可在 config/api.yaml 的 session 中覆盖
+DEFAULT_SESSION_CONFIG = {
+    "max_sessions": 1000,
+    "max_memory_mb": 512,
+    "idle_timeout": 3600,
+    "lease_ttl": 600,  # 多 worker 时会话租约的有效期（秒），持有租约的进程异常退出后由其他进程接管
+    "secret": "",  # 签名 user_id 的密钥，留空时使用环境变量 CHAT_SESSION_SECRET 或 secret_path 中自动生成的密钥
+    "secret_path": "data/session_secret",
+}
+
+USER_ID_COOKIE = "user_id"
+
+_USER_ID_PATTERN = re.compile(r'^[A-Za-z0-9_\-]{1,64}$')
+
+def estimate_history_bytes(history: List[Dict[str, Any]]) -> int:
+    """粗略估计对话历史占用的字节数（只统计字符串长度）"""
+    total = 0
+    stack: List[Any] = [history]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, str):
+            total += len(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return total
+
+async def run_to_completion(coro):
+    """
+    执行存储写入，调用方被取消（如客户端断开）时仍等待写入完成后再抛出 CancelledError。
+
+    直接取消 to_thread 会丢弃尚未开始执行的写入：本轮历史丢失，或者租约一直保留到过期，
+    期间其他进程无法处理该会话。
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await asyncio.wait([task])
+        raise
+
+def load_secret(path: str) -> bytes:
+    """读取密钥文件，不存在时生成；多个 worker 同时启动时只有一个能创建成功，其余读取它"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip().encode("utf-8")
+    except FileNotFoundError:
+        pass
+    fd, temp_path = tempfile.mkstemp(dir=directory or ".")  # 权限为 0600
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(temp_path, path)  # 原子创建，已存在时失败
+            logger.info(f"已生成 user_id 签名密钥: {path}")
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(temp_path)
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip().encode("utf-8")
+
+class UserIdSigner:
+    """
+    服务端签发的 user_id：<id>.<HMAC-SHA256 签名>。
+
+    会话按 id 区分，客户端提交的值只有签名有效时才被采用，知道或猜到别人的 id 也无法读写其会话。
+    """
+
+    def __init__(self, secret: bytes):
+        self.secret = secret
+
+    @classmethod
+    def from_config(cls, config) -> "UserIdSigner":
+        session_config = dict(DEFAULT_SESSION_CONFIG)
+        session_config.update(config.api.get("session") or {})
+        secret = session_config["secret"] or os.environ.get("CHAT_SESSION_SECRET")
+        return cls(secret.encode("utf-8") if secret else load_secret(session_config["secret_path"]))
+
+    def _signature(self, user_id: str) -> str:
+        return hmac.new(self.secret, user_id.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def sign(self, user_id: str) -> str:
+        return f"{user_id}.{self._signature(user_id)}"
+
+    def issue(self) -> str:
+        """签发新的 user_id"""
+        return self.sign(uuid.uuid4().hex)
+
+    def verify(self, token: Optional[str]) -> Optional[str]:
+        """签名有效时返回其中的 id，否则返回 None"""
+        if not token or "." not in token:
+            return None
+        user_id, signature = token.rsplit(".", 1)
+        if not _USER_ID_PATTERN.match(user_id) or not hmac.compare_digest(signature, self._signature(user_id)):
+            return None
+        return user_id
+
+    def token(self, request) -> Optional[str]:
+        """从查询参数或 cookie 中取出签名有效的 user_id（完整的签名形式）"""
+        for token in (request.query_params.get("user_id"), request.cookies.get(USER_ID_COOKIE)):
+            if self.verify(token):
+                return token
+        return None
+
+    def resolve(self, request, fallback: str) -> str:
+        """确定 WebSocket/HTTP 请求所属的用户；没有签名有效的 user_id 时使用 fallback（如连接 ID）"""
+        token = self.token(request)
+        if token is not None:
+            return self.verify(token)
+        if request.query_params.get("user_id") or request.cookies.get(USER_ID_COOKIE):
+            logger.warning("拒绝未签名或签名无效的 user_id")
+        return fallback
+
+class Session:
+    """单个用户的对话会话，lock 保证同一用户的对话轮次串行执行"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.history: List[Dict[str, Any]] = []
+        self.summary_cache: Dict[str, str] = {}  # 被移出窗口的历史的摘要
+        self.lock = asyncio.Lock()
+        self.last_active = time.monotonic()
+        self.size = 0
+        # 持久化状态：history[0] 的序号、已写入存储的前缀长度、需要重写的下标
+        self.loaded = False
+        self.first_seq = 0
+        self.persisted = 0
+        self.dirty: Set[int] = set()
+        self.revision: Optional[float] = None  # 加载或保存时存储中的会话版本
+        # 正在进行的对话轮次及发起它的连接，可被停止指令、新消息或断开取消
+        self.turn_task: Optional[asyncio.Task] = None
+        self.turn_client: Optional[str] = None
+        self.users = 0  # 已通过 turn()/clear() 使用（包括等待锁）的次数，大于 0 时不会被淘汰
+
+    @property
+    def in_use(self) -> bool:
+        return bool(self.users) or self.lock.locked() or (self.turn_task is not None and not self.turn_task.done())
+
+    def cancel_turn(self, client_id: Optional[str] = None) -> bool:
+        """取消正在进行的轮次；指定 client_id 时只取消该连接发起的轮次"""
+        task = self.turn_task
+        if task is None or task.done() or (client_id is not None and self.turn_client != client_id):
+            return False
+        task.cancel()
+        return True
+
+    def reset(self):
+        """丢弃内存中的历史，下次 load 时从存储重新读取"""
+        self.history.clear()
+        self.summary_cache.clear()
+        self.loaded = False
+        self.first_seq = 0
+        self.persisted = 0
+        self.dirty = set()
+        self.revision = None
+
+    def touch(self):
+        self.last_active = time.monotonic()
+        self.size = estimate_history_bytes(self.history)
+
+    def record_trim(self, report: Dict[str, Any]):
+        """根据上下文窗口的裁剪结果更新持久化状态"""
+        dropped = report.get("dropped", 0)
+        self.first_seq += dropped
+        self.persisted = max(self.persisted - dropped, 0)
+        self.dirty = {index - dropped for index in self.dirty if index >= dropped}
+        self.dirty.update(report.get("modified", []))
+
+class SessionManager:
+    """
+    按 user_id 管理会话，超过数量/内存上限或空闲过久时按 LRU 淘汰。
+
+    会话首次使用时从 store 懒加载，每轮对话结束后增量写回，淘汰只释放内存。
+    多个 worker 共享同一个 store 时，对话轮次通过 store 的租约跨进程串行执行，
+    其他进程写入过的会话在下一轮开始时重新加载。
+    """
+
+    def __init__(self, max_sessions: int = 1000, max_memory_mb: int = 512, idle_timeout: float = 3600,
+                 lease_ttl: float = 600, store: Optional[HistoryStore] = None):
+        self.store = store or MemoryHistoryStore()
+        self.max_sessions = max_sessions
+        self.max_bytes = max_memory_mb * 1024 * 1024
+        self.idle_timeout = idle_timeout
+        self.lease_ttl = lease_ttl
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+    @classmethod
+    def from_config(cls, config) -> "SessionManager":
+        session_config = dict(DEFAULT_SESSION_CONFIG)
+        session_config.update(config.api.get("session") or {})
+        del session_config["secret"], session_config["secret_path"]  # 由 UserIdSigner 使用
+        return cls(store=create_history_store(config), **session_config)
+
+    def get(self, user_id: str) -> Session:
+        """获取会话，不存在时创建，并标记为最近使用"""
+        self.evict(reserve=0 if user_id in self._sessions else 1, keep=user_id)
+        session = self._sessions.get(user_id)
+        if session is None:
+            logger.info(f"初始化新对话会话，用户: {user_id}")
+            session = Session(user_id)
+            self._sessions[user_id] = session
+        else:
+            self._sessions.move_to_end(user_id)
+        session.last_active = time.monotonic()
+        return session
+
+    def peek(self, user_id: str) -> Optional[Session]:
+        return self._sessions.get(user_id)
+
+    @asynccontextmanager
+    async def turn(self, session: Session):
+        """持有会话的进程内锁和跨进程租约，并确保会话历史是存储中的最新版本"""
+        session.users += 1
+        try:
+            async with session.lock:
+                await self._acquire_lease(session.user_id)
+                try:
+                    await self.load(session)
+                    yield session
+                finally:
+                    await self._release_lease(session.user_id)
+        finally:
+            session.users -= 1
+
+    async def run_turn(self, session: Session, coro, client_id: str) -> asyncio.Task:
+        """
+        在 turn() 内把本轮对话作为单独的任务执行，session.cancel_turn() 只取消本轮，
+        调用方被取消（如连接断开）时同样取消本轮并等待其收尾。返回已结束的任务。
+        """
+        task = asyncio.ensure_future(coro)
+        session.turn_task, session.turn_client = task, client_id
+        try:
+            await asyncio.wait([task])
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait([task])
+            session.turn_task = session.turn_client = None
+        return task
+
+    async def _acquire_lease(self, user_id: str):
+        delay = 0.01
+        try:
+            while not await self.store.acquire_lease(user_id, self.owner, self.lease_ttl):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.2)
+        except asyncio.CancelledError:
+            # 取消时线程中的写入可能已经生效
+            await self._release_lease(user_id)
+            raise
+
+    async def _release_lease(self, user_id: str):
+        await run_to_completion(self.store.release_lease(user_id, self.owner))
+
+    async def load(self, session: Session):
+        """从存储中加载会话历史，需在持有 session.lock 时调用"""
+        revision = await self.store.revision(session.user_id)
+        if session.loaded:
+            if revision == session.revision:
+                return
+            logger.info(f"会话 {session.user_id} 已被其他进程更新，重新加载")
+            session.reset()
+        history, summary_cache, first_seq = await self.store.load(session.user_id)
+        session.history[:0] = history
+        session.summary_cache.update(summary_cache)
+        session.first_seq = first_seq
+        session.persisted = len(history)
+        session.revision = revision
+        session.loaded = True
+        session.touch()
+        if history:
+            logger.info(f"已加载对话会话: {session.user_id} ({len(history)} 条消息)")
+
+    async def persist(self, session: Session):
+        """把本轮新增/改写的消息写回存储，需在持有 session.lock 时调用"""
+        if not session.loaded:
+            return
+        try:
+            session.revision = await run_to_completion(self.store.save(
+                session.user_id, session.history, session.summary_cache, session.first_seq, session.persisted, session.dirty))
+            session.persisted = len(session.history)
+            session.dirty = set()
+        except Exception as e:
+            logger.error(f"保存对话会话失败 {session.user_id}: {str(e)}")
+
+    async def clear(self, user_id: str):
+        session = self.get(user_id)
+        session.users += 1
+        try:
+            async with session.lock:
+                await self._acquire_lease(user_id)
+                try:
+                    session.reset()
+                    await self.store.clear(user_id)
+                    session.revision = await self.store.revision(user_id)
+                    session.loaded = True
+                    session.touch()
+                finally:
+                    await self._release_lease(user_id)
+        finally:
+            session.users -= 1
+
+    async def close(self):
+        await self.store.close()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(session.size for session in self._sessions.values())
+
+    def evict(self, reserve: int = 0, keep: Optional[str] = None):
+        """
+        淘汰空闲过久的会话，再按 LRU 淘汰直到满足数量和内存上限；正在使用的会话（持有或等待锁、
+        轮次未结束）不会被淘汰，否则同一用户会出现两个 Session，它们的轮次不再串行。
+
+        :param reserve: 为即将创建的会话预留的数量
+        :param keep: 不淘汰的会话（get() 即将返回的会话）
+        """
+        now = time.monotonic()
+        total_bytes = self.total_bytes
+        for user_id, session in list(self._sessions.items()):
+            over_limit = len(self._sessions) + reserve > self.max_sessions or total_bytes > self.max_bytes
+            idle = now - session.last_active > self.idle_timeout
+            if not over_limit and not idle:
+                # 越往后越是最近使用的会话，无需继续检查
+                break
+            if user_id == keep or session.in_use:
+                continue
+            del self._sessions[user_id]
+            total_bytes -= session.size
+            logger.info(f"淘汰对话会话: {user_id} ({'空闲' if idle else '超出上限'})")
+
+    def __len__(self) -> int:
+        return len(self._sessions)
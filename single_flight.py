@@ -0,0 +1,38 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+
+class SingleFlight:
+    """
+    合并相同键的并发调用：第一个调用者在独立任务中执行 call()，其余调用者等待同一个任务。
+
+    某个调用者被取消（停止指令、连接断开）时只是不再等待，不影响其他调用者；
+    所有调用者都离开后才取消该任务。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, List] = {}  # 键 -> [任务, 等待者数量]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._calls
+
+    async def run(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(call())
+            # 没有等待者时也标记异常已读取，避免未取回异常的警告
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda t: self._forget(key, entry))
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                self._forget(key, entry)
+                task.cancel()
+
+    def _forget(self, key: str, entry: List):
+        if self._calls.get(key) is entry:
+            del self._calls[key]
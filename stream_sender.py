@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional
+from fastapi import WebSocket
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认合并窗口，可在 config/api.yaml 的 streaming 中覆盖
+DEFAULT_STREAM_CONFIG = {
+    "flush_interval_ms": 16,
+    "flush_bytes": 4096,
+    "max_pending_bytes": 1024 * 1024,
+    "binary_media": True,  # 客户端支持时，非流式消息中的媒体以二进制帧发送
+}
+
+class StreamStats:
+    """单次流式回复的统计信息"""
+
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self.started_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.tokens = 0  # 上游内容分块数，近似 token 数
+        self.chars = 0
+        self.frames = 0  # 实际发送的 WebSocket 帧数
+        self.bytes_sent = 0
+
+    @property
+    def ttft(self) -> Optional[float]:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def tokens_per_second(self) -> float:
+        if self.first_token_at is None or self.finished_at is None:
+            return 0.0
+        elapsed = self.finished_at - self.first_token_at
+        return self.tokens / elapsed if elapsed > 0 else float(self.tokens)
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "ttft_ms": round(self.ttft * 1000, 1) if self.ttft is not None else None,
+            "tokens_per_second": round(self.tokens_per_second, 1),
+            "tokens": self.tokens,
+            "chars": self.chars,
+            "frames": self.frames,
+            "bytes_sent": self.bytes_sent,
+        }
+
+# 每个客户端最近一次流式回复的统计
+stream_stats: Dict[str, StreamStats] = {}
+
+def get_stream_config(config) -> Dict:
+    stream_config = dict(DEFAULT_STREAM_CONFIG)
+    if config is not None:
+        stream_config.update(config.api.get("streaming") or {})
+    return stream_config
+
+def _inspect_chunk(chunk: str):
+    """解析 'data: {...}' 分块，返回 (内容, 是否为开始/结束帧)"""
+    if not chunk.startswith("data: "):
+        return "", False
+    try:
+        data = json.loads(chunk[6:])
+    except json.JSONDecodeError:
+        return "", False
+    return data.get("content") or "", bool(data.get("start_stream") or data.get("end_stream"))
+
+async def send_stream(websocket: WebSocket, chunks: AsyncIterator[str], client_id: str, config=None) -> StreamStats:
+    """
+    把上游的 'data: ...' 分块按时间/大小窗口合并后发送到 WebSocket。
+
+    发送在对端拥塞时会阻塞，期间到达的分块继续在缓冲区中合并；
+    缓冲区超过 max_pending_bytes 时暂停读取上游，形成反压。
+    开始/结束帧立即发送，保证首字时间准确。
+
+    :param websocket: 目标连接
+    :param chunks: 流式请求返回的异步生成器
+    :param client_id: 客户端 ID，用于统计和日志
+    """
+    stream_config = get_stream_config(config)
+    flush_interval = stream_config["flush_interval_ms"] / 1000
+    flush_bytes = stream_config["flush_bytes"]
+    max_pending_bytes = stream_config["max_pending_bytes"]
+
+    stats = StreamStats(client_id)
+    buffer: List[str] = []
+    state = {"bytes": 0, "urgent": False, "done": False, "first_at": 0.0}
+    data_ready = asyncio.Event()
+    size_reached = asyncio.Event()
+    space_free = asyncio.Event()
+    space_free.set()
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                while state["bytes"] >= max_pending_bytes:
+                    space_free.clear()
+                    await space_free.wait()
+                content, urgent = _inspect_chunk(chunk)
+                if content:
+                    if stats.first_token_at is None:
+                        stats.first_token_at = time.perf_counter()
+                    stats.tokens += 1
+                    stats.chars += len(content)
+                if not buffer:
+                    state["first_at"] = time.perf_counter()
+                buffer.append(chunk)
+                state["bytes"] += len(chunk)
+                state["urgent"] = state["urgent"] or urgent
+                if state["urgent"] or state["bytes"] >= flush_bytes:
+                    size_reached.set()
+                data_ready.set()
+        finally:
+            state["done"] = True
+            size_reached.set()
+            data_ready.set()
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            if not buffer:
+                if state["done"]:
+                    break
+                data_ready.clear()
+                await data_ready.wait()
+                continue
+            remaining = state["first_at"] + flush_interval - time.perf_counter()
+            if remaining > 0 and not size_reached.is_set():
+                try:
+                    await asyncio.wait_for(size_reached.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            frame = "".join(buffer)
+            buffer.clear()
+            state["bytes"] = 0
+            state["urgent"] = False
+            if not state["done"]:
+                size_reached.clear()
+            space_free.set()
+
+            await websocket.send_text(frame)
+            stats.frames += 1
+            stats.bytes_sent += len(frame)
+            logger.debug(f"客户端 {client_id}: 流式帧已发送 ({len(frame)} 字节)")
+        # 把上游异常（如果有）抛给调用方
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except (asyncio.CancelledError, Exception):
+                pass
+        stats.finished_at = time.perf_counter()
+        stream_stats[client_id] = stats
+        logger.info(f"客户端 {client_id}: 流式发送完成 {stats.to_dict()}")
+    return stats
+
+# 同一连接上的多帧消息需要连续发送，按连接加锁
+_frame_locks: Dict[int, asyncio.Lock] = {}
+
+def media_item_type(mime_type: str) -> str:
+    """按 mime 类型确定前端渲染的消息类型"""
+    for prefix in ("image", "audio", "video"):
+        if mime_type.startswith(f"{prefix}/"):
+            return prefix
+    return "file"
+
+async def send_framed(websocket: WebSocket, messages: List[Dict], frames: List[bytes]) -> int:
+    """
+    发送带二进制附件的消息：先发 JSON 头 {"type": "media_batch", "frames": N, "messages": [...]}，
+    其中媒体项的 source.frame 指向随后第几个二进制帧，再依次发送 N 个二进制帧。
+
+    返回发送的总字节数。
+    """
+    header = json.dumps({"type": "media_batch", "frames": len(frames), "messages": messages}, ensure_ascii=False)
+    lock = _frame_locks.setdefault(id(websocket), asyncio.Lock())
+    async with lock:
+        await websocket.send_text(header)
+        for frame in frames:
+            await websocket.send_bytes(frame)
+    return len(header.encode("utf-8")) + sum(len(frame) for frame in frames)
+
+def release_frame_lock(websocket: WebSocket):
+    _frame_locks.pop(id(websocket), None)
+
+# 基准测试：模拟上游逐 token 输出，比较逐块发送和合并发送的帧数、CPU 时间和总耗时；
+# 以及媒体消息以 base64 JSON 和二进制帧发送时的线上字节数和 CPU 时间
+async def main():
+    class BenchWebSocket:
+        """记录发送的帧，每帧模拟 send_delay 秒的发送耗时（对端越慢越大）"""
+
+        def __init__(self, send_delay: float):
+            self.send_delay = send_delay
+            self.frames: List[str] = []
+
+        async def send_text(self, text: str):
+            self.frames.append(text)
+            await asyncio.sleep(self.send_delay)
+
+        async def send_bytes(self, data: bytes):
+            self.frames.append(data)
+            await asyncio.sleep(self.send_delay)
+
+    def frame(data: Dict) -> str:
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    async def upstream(tokens: int, interval: float):
+        yield frame({"content": "", "start_stream": True, "end_stream": False})
+        for index in range(tokens):
+            yield frame({"content": f"第{index}个字 ", "start_stream": False, "end_stream": False})
+            await asyncio.sleep(interval)
+        yield frame({"content": "", "start_stream": False, "end_stream": True})
+
+    async def per_chunk(websocket, chunks):
+        async for chunk in chunks:
+            await websocket.send_text(chunk)
+
+    tokens = 2000
+    scenarios = [("上游突发输出", 0.0, 0.0), ("上游每 1ms 一个 token", 0.001, 0.0), ("对端拥塞 (每帧 2ms)", 0.0, 0.002)]
+    for label, interval, send_delay in scenarios:
+        for mode in ("逐块发送", "合并发送"):
+            websocket = BenchWebSocket(send_delay)
+            cpu_started, started = time.process_time(), time.perf_counter()
+            if mode == "逐块发送":
+                await per_chunk(websocket, upstream(tokens, interval))
+            else:
+                await send_stream(websocket, upstream(tokens, interval), "bench")
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu_started
+            assert "".join(websocket.frames) == "".join([chunk async for chunk in upstream(tokens, 0)])
+            print(f"{label} / {mode}: {len(websocket.frames)} 帧，{sum(map(len, websocket.frames))} 字符，"
+                  f"CPU {cpu * 1000:.0f}ms，总耗时 {elapsed * 1000:.0f}ms")
+
+    # 非流式媒体消息：base64 内嵌在 JSON 中，与 JSON 头 + 二进制帧（send_framed）比较线上字节数和 CPU 时间
+    import base64
+    import os
+    media = [("image/png", 200 * 1024), ("audio/mpeg", 5 * 1024 * 1024), ("video/mp4", 50 * 1024 * 1024)]
+    for mime_type, size in media:
+        data = os.urandom(size)
+        websocket = BenchWebSocket(0.0)
+        cpu_started = time.process_time()
+        message_json = json.dumps([{"type": media_item_type(mime_type), "source": {
+            "base64": base64.b64encode(data).decode("ascii"), "mime_type": mime_type, "filename": "媒体文件"}}])
+        await websocket.send_text(message_json)
+        base64_cpu = time.process_time() - cpu_started
+        base64_bytes = len(message_json.encode("utf-8"))
+
+        websocket = BenchWebSocket(0.0)
+        cpu_started = time.process_time()
+        framed_bytes = await send_framed(websocket, [{"type": media_item_type(mime_type), "source": {
+            "frame": 0, "size": size, "mime_type": mime_type, "filename": "媒体文件"}}], [data])
+        framed_cpu = time.process_time() - cpu_started
+        print(f"{mime_type} {size // 1024} KiB: base64 JSON {base64_bytes} 字节 / CPU {base64_cpu * 1000:.1f}ms，"
+              f"二进制帧 {framed_bytes} 字节 / CPU {framed_cpu * 1000:.2f}ms "
+              f"(节省 {(1 - framed_bytes / base64_bytes) * 100:.1f}%)")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main())
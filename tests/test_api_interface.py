@@ -0,0 +1,87 @@
+import asyncio
+import random
+import types
+import httpx
+import pytest
+from api_interface import construct_concurrently, open_stream
+from key_pool import KeyPool
+
+def make_config(limit: int):
+    return types.SimpleNamespace(api={"upload": {"max_concurrent_attachments": limit}})
+
+def test_results_keep_input_order():
+    message_list = [{"type": "image", "index": index} for index in range(20)]
+    rng = random.Random(0)
+
+    async def build(item):
+        await asyncio.sleep(rng.uniform(0, 0.02))
+        # 文本项之外返回 None 的项被忽略
+        return None if item["index"] % 5 == 0 else item["index"]
+
+    results = asyncio.run(construct_concurrently(message_list, build, make_config(8)))
+    assert results == [index for index in range(20) if index % 5]
+
+def test_concurrency_is_bounded():
+    running = {"now": 0, "max": 0}
+
+    async def build(item):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        return item["index"]
+
+    message_list = [{"type": "image", "index": index} for index in range(10)]
+    assert asyncio.run(construct_concurrently(message_list, build, make_config(3))) == list(range(10))
+    assert running["max"] == 3
+    # 配置为 0 时按 1 处理
+    running["max"] = 0
+    asyncio.run(construct_concurrently(message_list[:3], build, make_config(0)))
+    assert running["max"] == 1
+
+def test_failure_cancels_remaining_items():
+    cancelled = []
+
+    async def build(item):
+        if item["index"] == 0:
+            await asyncio.sleep(0.01)
+            raise ValueError("下载失败")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(item["index"])
+            raise
+
+    message_list = [{"type": "image", "index": index} for index in range(4)]
+    with pytest.raises(ValueError):
+        asyncio.run(construct_concurrently(message_list, build, make_config(4)))
+    assert sorted(cancelled) == [1, 2, 3]
+
+def test_open_stream_holds_key_until_body_is_read():
+    pool = KeyPool("test", ["key-a"])
+    inflight = []
+    closed = []
+
+    class Body(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            for index in range(3):
+                # 正文读取期间 key 仍计为进行中
+                inflight.append(pool.states["key-a"].inflight)
+                yield f"data: {index}\n\n".encode()
+
+        async def aclose(self):
+            closed.append(True)
+
+    def handler(request):
+        assert request.url.params["key"] == "key-a"
+        return httpx.Response(200, stream=Body())
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            build = lambda key: client.build_request("POST", "https://llm.test/stream", params={"key": key})
+            async with open_stream(client, pool, build, "s1", None, 10) as response:
+                return [line async for line in response.aiter_lines() if line]
+
+    assert asyncio.run(run()) == ["data: 0", "data: 1", "data: 2"]
+    assert inflight == [1, 1, 1]
+    assert closed and pool.states["key-a"].inflight == 0
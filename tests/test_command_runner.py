@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+import time
+import pytest
+from command_runner import HeadTailBuffer, LiveOutput, run_shell
+
+posix_only = pytest.mark.skipif(os.name == "nt", reason="使用 POSIX shell 和进程组")
+
+def test_head_tail_buffer_keeps_both_ends():
+    buffer = HeadTailBuffer(4, 6)
+    for chunk in (b"ab", b"cdef", b"0123456789", b"XYZ"):
+        buffer.write(chunk)
+    assert bytes(buffer.head) == b"abcd" and bytes(buffer.tail) == b"789XYZ"
+    assert buffer.total == 19 and buffer.dropped == 9
+    assert buffer.getvalue() == "abcd\n...(省略中间 9 字节输出)...\n789XYZ"
+
+def test_head_tail_buffer_without_truncation():
+    buffer = HeadTailBuffer(4, 6)
+    buffer.write(b"short")
+    buffer.write(b"text")
+    assert buffer.dropped == 0 and buffer.getvalue() == "shorttext"
+
+def test_head_tail_buffer_head_only():
+    buffer = HeadTailBuffer(3, 0)
+    buffer.write(b"abcdef")
+    assert buffer.getvalue() == "abc\n...(省略中间 3 字节输出)...\n"
+
+@posix_only
+def test_large_output_is_truncated_by_head_ratio():
+    total = 200 * 1024 * 1024
+    command = f"printf START; head -c {total} /dev/zero | tr '\\0' x; printf END >&2"
+    result = asyncio.run(run_shell(command, timeout=30, max_output_bytes=1000, head_ratio=0.25))
+    assert result.returncode == 0 and not result.timed_out
+    assert result.total_bytes == total + len("START") + len("END")
+    head, _, tail = result.output.partition("\n...(省略中间")
+    # 1000 字节的上限中 250 字节给开头，750 字节给结尾
+    assert head == "START" + "x" * 245
+    assert tail.endswith("\n" + "x" * 747 + "END")
+    assert f"{result.total_bytes - 1000} 字节输出" in result.output
+
+def process_gone(pid: int) -> bool:
+    """进程已退出（或只剩等待回收的僵尸进程）"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] == "Z"
+    except FileNotFoundError:
+        return True
+
+@posix_only
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="通过 /proc 检查子进程")
+def test_timeout_kills_process_group():
+    started = time.perf_counter()
+    result = asyncio.run(run_shell("sh -c 'sleep 30 & echo $!; sleep 30'", timeout=0.5, max_output_bytes=1000))
+    assert result.timed_out and time.perf_counter() - started < 5
+    # 后台的 sleep 不再持有输出管道，否则要等它退出才能返回
+    background = int(result.output.split()[0])
+    deadline = time.monotonic() + 2
+    while not process_gone(background) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert process_gone(background), f"进程 {background} 在超时后仍在运行"
+
+@posix_only
+def test_live_output_is_capped():
+    sent = []
+
+    async def send(text: str):
+        sent.append(text)
+
+    async def run():
+        live = LiveOutput(send, interval=0, max_bytes=10)
+        await run_shell("printf 0123456789abcdef", timeout=5, max_output_bytes=100, on_output=live.write)
+        await live.flush()
+
+    asyncio.run(run())
+    assert sent == ["0123456789\n...(输出过多，不再实时显示)"]
@@ -0,0 +1,108 @@
+import asyncio
+import gzip
+import types
+import zlib
+import httpx
+import engine_search
+from engine_search import fetch_page, get_html_read_config
+
+def run_fetch(handler, **overrides):
+    read_config = {**get_html_read_config(None), **overrides}
+
+    async def fetch():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await fetch_page(client, "https://page.test/", {}, httpx.Timeout(5), read_config)
+    return asyncio.run(fetch())
+
+class ChunkedBody:
+    """按块返回正文，并记录服务端实际送出的块数"""
+
+    def __init__(self, data: bytes, chunk_size: int = 1024):
+        self.chunks = [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+        self.sent = 0
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.sent += 1
+            yield chunk
+
+def test_body_is_capped_at_max_bytes():
+    body = ChunkedBody(b"<p>" + b"x" * 100_000 + b"</p>")
+
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/html; charset=utf-8"}, content=body)
+
+    page = run_fetch(handler, max_bytes=10_000)
+    assert page.truncated and not page.skipped
+    assert len(page.body) == 10_000
+    assert page.body.startswith(b"<p>xxx")
+    assert page.encoding == "utf-8" and page.content_type == "text/html"
+    # 达到上限后停止读取，剩余的块不再拉取
+    assert body.sent < len(body.chunks)
+
+def test_small_body_is_not_truncated():
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/plain"}, content=ChunkedBody(b"hello world"))
+
+    page = run_fetch(handler, max_bytes=10_000)
+    assert page.body == b"hello world"
+    assert not page.truncated and page.content_type == "text/plain"
+
+def test_gzip_decompression_is_limited():
+    # 约 100 KiB 的压缩数据解压后为 100 MiB
+    bomb = gzip.compress(b"<html><body>" + b"a" * (100 * 1024 * 1024), compresslevel=9)
+    body = ChunkedBody(bomb, chunk_size=4096)
+
+    def handler(request):
+        assert "gzip" in request.headers["accept-encoding"]
+        return httpx.Response(200, headers={"content-type": "text/html", "content-encoding": "gzip"}, content=body)
+
+    page = run_fetch(handler, max_bytes=64 * 1024)
+    assert page.truncated
+    assert len(page.body) == 64 * 1024
+    assert page.body.startswith(b"<html><body>aaa")
+    # 解压到上限即停止，只消费了开头的少量压缩数据
+    assert body.sent < len(body.chunks)
+
+def test_deflate_body_is_decompressed():
+    html = b"<html><body><p>deflate</p></body></html>"
+
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/html", "content-encoding": "deflate"},
+                              content=ChunkedBody(zlib.compress(html)))
+
+    page = run_fetch(handler)
+    assert page.body == html and not page.truncated
+
+def test_binary_content_type_is_skipped_without_reading():
+    body = ChunkedBody(b"\x89PNG\r\n\x1a\n" + b"\x00" * 10_000)
+
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "image/png"}, content=body)
+
+    page = run_fetch(handler)
+    assert page.skipped and page.body == b""
+    assert page.content_type == "image/png"
+    assert body.sent == 0
+
+def test_binary_signature_is_skipped_despite_html_content_type():
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/html"},
+                              content=ChunkedBody(b"%PDF-1.7\n" + b"1 0 obj" * 1000))
+
+    page = run_fetch(handler)
+    assert page.skipped and page.body == b""
+    # 声明的类型不可信，清空后由调用方按二进制提示
+    assert page.content_type == ""
+
+def test_timeout_keeps_received_part(monkeypatch):
+    clock = iter(range(0, 1000, 10))
+    monkeypatch.setattr(engine_search, "time", types.SimpleNamespace(monotonic=lambda: next(clock)))
+
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/html"}, content=ChunkedBody(b"y" * 10_000))
+
+    # deadline = 0 + 25，第三块之后超时
+    page = run_fetch(handler, total_timeout=25)
+    assert page.timed_out and not page.truncated
+    assert page.body == b"y" * 3072
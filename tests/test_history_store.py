@@ -0,0 +1,74 @@
+import asyncio
+import base64
+from history_store import SQLiteHistoryStore
+
+IMAGE = base64.b64encode(b"\x89PNG fake image").decode("utf-8")
+OTHER_IMAGE = base64.b64encode(b"\x89PNG another image").decode("utf-8")
+
+def image_message(data: str, text: str = "看这张图"):
+    return {"role": "user", "parts": [{"text": text}, {"inline_data": {"mime_type": "image/png", "data": data}}]}
+
+def reply(text: str):
+    return {"role": "model", "parts": [{"text": text}]}
+
+def count(store: SQLiteHistoryStore, table: str) -> int:
+    return store._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+def save(store, user_id, history, first_seq=0, persisted=0, dirty=(), summary=None):
+    return asyncio.run(store.save(user_id, history, summary or {}, first_seq, persisted, dirty))
+
+def test_round_trip_restores_media(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    history = [
+        image_message(IMAGE),
+        reply("好的"),
+        {"role": "user", "parts": [{"image_url": {"url": f"data:image/png;base64,{OTHER_IMAGE}"}}]},
+    ]
+    save(store, "alice", history, summary={"summary": "之前聊过天气"})
+    loaded, summary_cache, first_seq = asyncio.run(store.load("alice"))
+    assert loaded == history and summary_cache == {"summary": "之前聊过天气"} and first_seq == 0
+    # 消息表中只保存媒体的哈希
+    assert IMAGE not in "".join(row[0] for row in store._conn.execute("SELECT parts FROM messages"))
+    asyncio.run(store.close())
+
+def test_blobs_are_deduplicated(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    save(store, "alice", [image_message(IMAGE), reply("a"), image_message(IMAGE, "再看一次")])
+    save(store, "bob", [image_message(IMAGE)])
+    assert count(store, "blobs") == 1
+    assert count(store, "message_blobs") == 3
+    assert asyncio.run(store.load("bob"))[0] == [image_message(IMAGE)]
+    asyncio.run(store.close())
+
+def test_incremental_save_trims_and_rewrites(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    history = [reply(f"message {i}") for i in range(4)]
+    save(store, "alice", history)
+    # 窗口裁剪掉前两条，改写第一条保留的消息，并追加一条新消息
+    history = [reply("message 2 (summarized)"), reply("message 3"), reply("message 4")]
+    save(store, "alice", history, first_seq=2, persisted=2, dirty=[0])
+    loaded, _, first_seq = asyncio.run(store.load("alice"))
+    assert loaded == history and first_seq == 2
+    asyncio.run(store.close())
+
+def test_compaction_removes_unreferenced_blobs(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"), compact_every=3)
+    save(store, "alice", [image_message(IMAGE)])
+    save(store, "bob", [image_message(OTHER_IMAGE), reply("好的")])
+    asyncio.run(store.clear("alice"))
+    # 清除的会话不再引用 IMAGE，但压缩前仍保留
+    assert count(store, "blobs") == 2
+    # 第 3 次保存触发压缩：裁剪掉 bob 的图片消息后，两个媒体都不再被引用
+    save(store, "bob", [reply("好的")], first_seq=1, persisted=1)
+    assert count(store, "blobs") == 0 and count(store, "message_blobs") == 0
+    asyncio.run(store.close())
+
+def test_compaction_keeps_referenced_blobs(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"), compact_every=1)
+    save(store, "alice", [image_message(IMAGE)])
+    save(store, "bob", [image_message(IMAGE), image_message(OTHER_IMAGE)])
+    asyncio.run(store.clear("bob"))
+    save(store, "carol", [reply("hi")])
+    assert count(store, "blobs") == 1
+    assert asyncio.run(store.load("alice"))[0] == [image_message(IMAGE)]
+    asyncio.run(store.close())
@@ -0,0 +1,62 @@
+import os
+import pytest
+from html_extract import (LXML_AVAILABLE, NoHTMLError, TRUNCATED_MESSAGE, _recursive_markdown, html_to_markdown,
+                          nested_page)
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "html")
+BASE_URL = "https://example.com/docs/page.html"
+ENGINES = ["bs4", pytest.param("lxml", marks=pytest.mark.skipif(not LXML_AVAILABLE, reason="未安装 lxml"))]
+
+def fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+@pytest.mark.parametrize("name", sorted(os.listdir(FIXTURES)))
+def test_bs4_matches_recursive_extractor(name):
+    html = fixture(name)
+    assert html_to_markdown(html, BASE_URL, "bs4") == _recursive_markdown(html, BASE_URL)
+
+@pytest.mark.skipif(not LXML_AVAILABLE, reason="未安装 lxml")
+@pytest.mark.parametrize("name", sorted(os.listdir(FIXTURES)))
+def test_lxml_matches_bs4(name):
+    html = fixture(name)
+    assert html_to_markdown(html, BASE_URL, "lxml") == html_to_markdown(html, BASE_URL, "bs4")
+
+def test_article_output():
+    lines = html_to_markdown(fixture("article.html"), BASE_URL, "bs4").split("\n")
+    assert "      [博客](https://example.com/blog/)" in lines
+    assert not any("登录" in line or "analytics" in line or "trackRead" in line for line in lines)
+    # 相对链接按页面地址补全，没有 alt 的图片使用默认说明
+    assert "      [事件循环示意图](https://example.com/docs/images/diagram.png)" in lines
+    assert "      [No description](https://example.com/docs/images/no-alt.png)" in lines
+    assert "          [robots.txt](https://example.com/robots.html)" in lines
+    # 按 <span> 分行的代码块保留缩进，去掉空行
+    code = lines.index("      ```yaml")
+    assert lines[code + 1:code + 6] == ["      import asyncio", "      import httpx", "      async def fetch(client, url):",
+                                         "          response = await client.get(url)", "          return response.text"]
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_deeply_nested_document(engine):
+    depth = 5000
+    html = nested_page(depth)
+    with pytest.raises(RecursionError):
+        _recursive_markdown(html, BASE_URL)
+    lines = html_to_markdown(html, BASE_URL, engine).split("\n")
+    assert len(lines) == depth * 2 + 1
+    assert lines[0] == "    第0层" and lines[1] == "    [链接0](https://example.com/level/0)"
+    assert lines[-1] == "  " * (depth + 1) + "最深处"
+
+@pytest.mark.skipif(not LXML_AVAILABLE, reason="未安装 lxml")
+def test_engines_agree_on_deeply_nested_document():
+    html = nested_page(5000)
+    assert html_to_markdown(html, BASE_URL, "lxml") == html_to_markdown(html, BASE_URL, "bs4")
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_truncation_stops_early(engine):
+    output = html_to_markdown(nested_page(5000), BASE_URL, engine, max_chars=1000)
+    assert output.endswith(TRUNCATED_MESSAGE) and len(output) < 1200
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_no_html_tag(engine):
+    with pytest.raises(NoHTMLError):
+        html_to_markdown("<p>只是片段</p>", BASE_URL, engine)
@@ -0,0 +1,51 @@
+import json
+import random
+from json_stream import JSONArrayStreamParser
+
+# 按 streamGenerateContent 实际返回的格式构造：元素之间是 ",\r\n"，字符串中含转义、花括号和中文
+ELEMENTS = [
+    {"candidates": [{"content": {"parts": [{"text": "你好！{这是} \"引号\" 和 \\ 反斜杠"}], "role": "model"},
+                     "index": 0}],
+     "usageMetadata": {"promptTokenCount": 12, "totalTokenCount": 12}, "modelVersion": "gemini-2.0-flash-001"},
+    {"candidates": [{"content": {"parts": [{"text": "第二段\n```json\n{\"a\": [1, 2]}\n```\\"}], "role": "model"},
+                     "index": 0}]},
+    {"candidates": [{"content": {"parts": [{"functionCall": {"name": "search_net", "args": {"query": "}{]["}}}],
+                                 "role": "model"}, "finishReason": "STOP", "index": 0}],
+     "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": 30, "totalTokenCount": 42}},
+]
+STREAM = "[" + ",\r\n".join(json.dumps(element, ensure_ascii=False, indent=2) for element in ELEMENTS) + "]"
+
+def parse_chunks(chunks):
+    parser = JSONArrayStreamParser()
+    objects = []
+    for chunk in chunks:
+        objects.extend(parser.feed(chunk))
+    assert not parser.pending
+    return objects
+
+def test_whole_stream():
+    assert parse_chunks([STREAM]) == json.loads(STREAM)
+
+def test_every_split_point():
+    expected = json.loads(STREAM)
+    for i in range(len(STREAM) + 1):
+        assert parse_chunks([STREAM[:i], STREAM[i:]]) == expected, f"在偏移 {i} 处切分"
+
+def test_single_characters():
+    assert parse_chunks(list(STREAM)) == json.loads(STREAM)
+
+def test_random_splits():
+    expected = json.loads(STREAM)
+    rng = random.Random(0)
+    for _ in range(500):
+        cuts = sorted(rng.sample(range(1, len(STREAM)), rng.randint(1, 20)))
+        chunks = [STREAM[start:end] for start, end in zip([0] + cuts, cuts + [len(STREAM)])]
+        assert parse_chunks(chunks) == expected, f"切分位置 {cuts}"
+
+def test_objects_returned_when_closed():
+    parser = JSONArrayStreamParser()
+    first = json.dumps(ELEMENTS[0], ensure_ascii=False)
+    assert parser.feed("[" + first[:-1]) == []
+    assert parser.pending
+    assert parser.feed(first[-1] + ",\r\n") == [ELEMENTS[0]]
+    assert not parser.pending
@@ -0,0 +1,174 @@
+import asyncio
+import types
+import pytest
+import key_pool
+from key_pool import KeyPool, KeyPoolExhausted, RateLimitedError, get_llm_key_pool, llm_provider, parse_retry_after
+
+class FakeClock:
+    """替换 key_pool 中的 time 和 asyncio.sleep，等待时直接推进时间"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(key_pool, "time", fake)
+    monkeypatch.setattr(key_pool, "asyncio", types.SimpleNamespace(sleep=fake.sleep))
+    return fake
+
+async def echo(key: str) -> str:
+    return key
+
+def test_rpm_accounting(clock):
+    pool = KeyPool("test", ["key-a", "key-b"], rpm=2, max_wait=120)
+
+    async def run():
+        return [await pool.call(echo) for _ in range(4)]
+
+    used = asyncio.run(run())
+    # 按负载轮流使用，两个 key 各用满 2 次
+    assert sorted(used) == ["key-a", "key-a", "key-b", "key-b"]
+    assert pool.select() == (None, 60.0)
+    assert pool.stats()["...ey-a"]["rpm"] == 2
+
+    # 第 5 次请求等到最早的请求移出窗口
+    asyncio.run(pool.call(echo))
+    assert clock.slept == [60.0]
+
+def test_tpm_accounting(clock):
+    pool = KeyPool("test", ["key-a"], tpm=100, max_wait=120)
+    asyncio.run(pool.call(echo, tokens=60))
+    clock.now += 10
+    assert pool.select(tokens=30) == ("key-a", 0.0)
+    key, wait = pool.select(tokens=60)
+    assert key is None and wait == 50.0
+    asyncio.run(pool.call(echo, tokens=60))
+    assert clock.slept == [50.0]
+
+def test_rate_limited_key_cools_down_and_fails_over(clock):
+    pool = KeyPool("test", ["key-a", "key-b"], cooldown=60)
+    attempts = []
+
+    async def limited_a(key: str) -> str:
+        attempts.append(key)
+        if key == "key-a":
+            raise RateLimitedError(30.0, "quota exceeded")
+        return key
+
+    assert asyncio.run(pool.call(limited_a, session_id="s1", key="key-a")) == "key-b"
+    assert attempts == ["key-a", "key-b"] and pool.failovers == 1
+    assert pool.stats()["...ey-a"]["cooldown_s"] == 30.0
+    assert pool.stats()["...ey-a"]["rate_limited"] == 1
+    # 冷却期间只选 key-b，冷却结束后 key-a 重新可用
+    assert pool.select(exclude=["key-b"]) == (None, 30.0)
+    clock.now += 30
+    assert pool.select(exclude=["key-b"]) == ("key-a", 0.0)
+
+def test_cooldown_without_retry_after_is_capped(clock):
+    pool = KeyPool("test", ["key-a"], cooldown=60, max_cooldown=600)
+    pool.penalize("key-a", None)
+    assert pool.stats()["...ey-a"]["cooldown_s"] == 60.0
+    pool.penalize("key-a", 3600.0)
+    assert pool.stats()["...ey-a"]["cooldown_s"] == 600.0
+
+def test_all_keys_rate_limited(clock):
+    pool = KeyPool("test", ["key-a", "key-b"], max_attempts=3, max_wait=10, cooldown=60)
+
+    async def always_limited(key: str) -> str:
+        raise RateLimitedError(None, "quota exceeded")
+
+    with pytest.raises(KeyPoolExhausted) as excinfo:
+        asyncio.run(pool.call(always_limited))
+    # 两个 key 都冷却 60 秒，超过 max_wait，不再等待
+    assert excinfo.value.retry_after == 60.0
+    assert clock.slept == []
+
+def test_sticky_session_and_fallback(clock):
+    pool = KeyPool("test", ["key-a", "key-b", "key-c"], sticky_ttl=1800)
+
+    async def run(session_id: str, count: int):
+        return {await pool.call(echo, session_id=session_id) for _ in range(count)}
+
+    (first,) = asyncio.run(run("s1", 5))
+    # 其他会话的请求让负载更高的 key 仍然被 s1 沿用
+    asyncio.run(run("s2", 3))
+    assert asyncio.run(run("s1", 3)) == {first}
+
+    # 绑定的 key 冷却时改用其他 key，并把会话绑定到新 key
+    pool.penalize(first, 120.0)
+    (second,) = asyncio.run(run("s1", 2))
+    assert second != first
+    clock.now += 120
+    assert asyncio.run(run("s1", 1)) == {second}
+
+    # 绑定过期后按负载重新选择
+    clock.now += 1801
+    assert pool._sticky_key("s1", clock.now) is None
+
+def test_lease_holds_inflight_until_exit(clock):
+    pool = KeyPool("test", ["key-a", "key-b"])
+    seen = {}
+
+    async def run():
+        async with pool.lease(echo) as first:
+            seen["during"] = pool.stats()[f"...{first[-4:]}"]["inflight"]
+            # 第一个 key 仍在进行中，第二个请求选择空闲的 key
+            async with pool.lease(echo) as second:
+                seen["keys"] = (first, second)
+        with pytest.raises(RuntimeError):
+            async with pool.lease(echo):
+                raise RuntimeError("stream broken")
+
+    asyncio.run(run())
+    first, second = seen["keys"]
+    assert seen["during"] == 1 and first != second
+    assert all(stats["inflight"] == 0 for stats in pool.stats().values())
+
+def test_lease_releases_inflight_when_attempt_fails(clock):
+    pool = KeyPool("test", ["key-a", "key-b"])
+
+    async def limited(key: str) -> str:
+        raise RateLimitedError(10.0, "quota exceeded")
+
+    async def broken(key: str) -> str:
+        raise ValueError("bad request")
+
+    async def run(attempt, error):
+        with pytest.raises(error):
+            async with pool.lease(attempt):
+                pass
+
+    asyncio.run(run(limited, KeyPoolExhausted))
+    clock.now += 10
+    asyncio.run(run(broken, ValueError))
+    assert all(stats["inflight"] == 0 for stats in pool.stats().values())
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after": "12"}) == 12.0
+    assert parse_retry_after({}, '{"error": {"details": [{"retryDelay": "7s"}]}}') == 7.0
+    assert parse_retry_after({}, "") is None
+
+def make_config(model: str):
+    llm = {"model": model, "gemini": {"api_keys": ["gemini-key"]}, "openai": {"api_keys": ["openai-key"]}}
+    return types.SimpleNamespace(api={"llm": llm})
+
+@pytest.mark.parametrize("model, provider", [("gemini", "gemini"), ("default", "gemini"), ("openai", "openai")])
+def test_llm_key_pool_for_model(monkeypatch, model, provider):
+    monkeypatch.setattr(key_pool, "_pools", {})
+    config = make_config(model)
+    assert llm_provider(config) == provider
+    pool = get_llm_key_pool(config)
+    assert pool.name == provider
+    assert asyncio.run(pool.acquire("s1")) == f"{provider}-key"
@@ -0,0 +1,46 @@
+import base64
+import json
+import logging
+import os
+import log_utils
+from log_utils import LazyJSON, LazyText, redact, redact_text
+
+IMAGE = base64.b64encode(os.urandom(3000)).decode()
+
+def test_base64_fields_are_replaced():
+    payload = {"contents": [{"role": "user", "parts": [
+        {"text": "描述这张图片"},
+        {"inline_data": {"mime_type": "image/png", "data": IMAGE}},
+        {"image_url": {"url": f"data:image/png;base64,{IMAGE}"}},
+    ]}]}
+    parts = redact(payload)["contents"][0]["parts"]
+    assert parts[0] == {"text": "描述这张图片"}
+    assert parts[1]["inline_data"] == {"mime_type": "image/png", "data": f"<base64 {len(IMAGE)} 字符>"}
+    assert parts[2]["image_url"]["url"] == f"data:image/png;base64,<base64 {len(IMAGE)} 字符>"
+    # 原对象不被修改
+    assert payload["contents"][0]["parts"][1]["inline_data"]["data"] == IMAGE
+
+def test_long_text_is_truncated():
+    text = "这是一段很长的文本。" * 100
+    assert redact_text(text, 20) == f"{text[:20]}...(共 {len(text)} 字符)"
+    assert redact_text("short", 20) == "short"
+    assert redact({"raw": b"\x00" * 10, "items": (1, "a")}) == {"raw": "<10 字节>", "items": [1, "a"]}
+
+def test_lazy_json_does_no_work_when_debug_is_off(monkeypatch, caplog):
+    calls = []
+    original = log_utils.redact
+    monkeypatch.setattr(log_utils, "redact", lambda obj, limit=None: calls.append(obj) or original(obj, limit))
+    logger = logging.getLogger("test_log_utils")
+    payload = {"inline_data": {"data": IMAGE}}
+
+    with caplog.at_level(logging.INFO, logger="test_log_utils"):
+        logger.debug("请求内容: %s", LazyJSON(payload))
+        logger.debug("响应内容: %s", LazyText(IMAGE))
+    assert calls == [] and caplog.records == []
+
+    with caplog.at_level(logging.DEBUG, logger="test_log_utils"):
+        logger.debug("请求内容: %s", LazyJSON(payload))
+    assert calls and calls[0] is payload
+    logged = caplog.records[0].getMessage()
+    assert IMAGE not in logged
+    assert json.loads(logged.split(": ", 1)[1]) == {"inline_data": {"data": f"<base64 {len(IMAGE)} 字符>"}}
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import time
+import media_cache
+from media_cache import MediaUploadCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+def counting_upload(uploads, uri, delay: float = 0):
+    async def upload():
+        uploads.append(asyncio.current_task())
+        await asyncio.sleep(delay)
+        return uri
+    return upload
+
+def test_ttl_per_provider(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(media_cache.time, "time", clock)
+    cache = MediaUploadCache(None, 10, {"gemini": 3600, "openai": 0})
+    uploads = []
+
+    async def get(provider):
+        return await cache.get_or_upload(provider, "key", b"content", counting_upload(uploads, f"{provider}-file"))
+
+    assert asyncio.run(get("gemini")) == "gemini-file"
+    assert asyncio.run(get("openai")) == "openai-file"
+    clock.now += 3599
+    asyncio.run(get("gemini"))
+    assert len(uploads) == 2 and cache.stats()["hits"] == 1
+    # Gemini 文件过期后重新上传，OpenAI 文件不过期
+    clock.now += 2
+    asyncio.run(get("gemini"))
+    asyncio.run(get("openai"))
+    assert len(uploads) == 3 and cache.stats()["hits"] == 2
+
+def test_lru_eviction():
+    cache = MediaUploadCache(None, 2, {"gemini": 0})
+    uploads = []
+
+    async def get(raw: bytes):
+        return await cache.get_or_upload("gemini", "key", raw, counting_upload(uploads, raw.decode()))
+
+    for raw in (b"a", b"b", b"a", b"c"):
+        asyncio.run(get(raw))
+    # 访问过的 a 保留，最久未使用的 b 被淘汰
+    assert cache.stats()["entries"] == 2 and len(uploads) == 3
+    asyncio.run(get(b"a"))
+    assert len(uploads) == 3
+    asyncio.run(get(b"b"))
+    assert len(uploads) == 4
+
+def test_key_includes_api_key():
+    cache = MediaUploadCache(None, 10, {"gemini": 0})
+    uploads = []
+    for api_key in ("key-a", "key-b", "key-a"):
+        asyncio.run(cache.get_or_upload("gemini", api_key, b"content", counting_upload(uploads, api_key)))
+    assert len(uploads) == 2
+
+def test_persistence_reload(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(media_cache.time, "time", clock)
+    path = str(tmp_path / "cache" / "media_cache.json")
+    cache = MediaUploadCache(path, 10, {"gemini": 3600, "openai": 0})
+    uploads = []
+    asyncio.run(cache.get_or_upload("gemini", "key", b"video", counting_upload(uploads, "files/video")))
+    asyncio.run(cache.get_or_upload("openai", "key", b"doc", counting_upload(uploads, "file-doc")))
+    assert len(json.load(open(path, encoding="utf-8"))) == 2
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    reopened = MediaUploadCache(path, 10, {"gemini": 3600, "openai": 0})
+    assert asyncio.run(reopened.get_or_upload("gemini", "key", b"video", counting_upload(uploads, None))) == "files/video"
+    assert len(uploads) == 2
+
+    # 加载时跳过已过期的条目
+    clock.now += 3601
+    expired = MediaUploadCache(path, 10, {"gemini": 3600, "openai": 0})
+    assert expired.stats()["entries"] == 1
+
+def test_corrupt_file_is_ignored(tmp_path):
+    path = tmp_path / "media_cache.json"
+    path.write_text("{not json", encoding="utf-8")
+    assert MediaUploadCache(str(path), 10, {}).stats()["entries"] == 0
+
+def test_concurrent_same_content_uploads_once():
+    cache = MediaUploadCache(None, 10, {"gemini": 3600})
+    uploads = []
+
+    async def run():
+        upload = counting_upload(uploads, "files/abc", delay=0.05)
+        return await asyncio.gather(*(cache.get_or_upload("gemini", "key", b"same content", upload) for _ in range(10)))
+
+    assert asyncio.run(run()) == ["files/abc"] * 10
+    assert len(uploads) == 1
+    assert cache.stats() == {"entries": 1, "hits": 9, "misses": 1}
+
+def test_cancelled_caller_does_not_poison_entry():
+    cache = MediaUploadCache(None, 10, {"gemini": 3600})
+    uploads = []
+
+    async def run():
+        upload = counting_upload(uploads, "files/abc", delay=0.1)
+        a = asyncio.ensure_future(cache.get_or_upload("gemini", "key", b"same content", upload))
+        b = asyncio.ensure_future(cache.get_or_upload("gemini", "key", b"same content", upload))
+        await asyncio.sleep(0.01)
+        a.cancel()
+        assert await b == "files/abc" and not b.cancelled()
+        assert a.cancelled() and len(uploads) == 1
+        # 结果照常写入缓存
+        assert await cache.get_or_upload("gemini", "key", b"same content", upload) == "files/abc"
+        assert len(uploads) == 1
+
+        # 唯一的调用者取消时上传被取消，也不留下缓存条目，之后可以重新上传
+        c = asyncio.ensure_future(cache.get_or_upload("gemini", "key", b"other content", upload))
+        await asyncio.sleep(0.01)
+        c.cancel()
+        await asyncio.sleep(0.01)
+        assert uploads[-1].cancelled() and cache.stats()["entries"] == 1
+        assert await cache.get_or_upload("gemini", "key", b"other content", upload) == "files/abc"
+        assert len(uploads) == 3
+
+    asyncio.run(run())
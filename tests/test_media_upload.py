@@ -0,0 +1,111 @@
+import asyncio
+import os
+import httpx
+from media_upload import GRANULARITY, GeminiResumableUpload, open_for_multipart
+
+UPLOAD_URL = "https://upload.test/session/1"
+
+class StubUploadServer:
+    """
+    模拟 Gemini 可恢复上传：drop_at 中的偏移所在的块只收下一半就断开连接，
+    之后客户端通过 query 得知已收到的字节数并续传。
+    """
+
+    def __init__(self, drop_at=()):
+        self.received = bytearray()
+        self.drop_at = set(drop_at)
+        self.finalized = False
+        self.upload_offsets = []  # 每次 upload 请求携带的偏移
+        self.queries = 0
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        command = request.headers.get("x-goog-upload-command", "")
+        if command == "start":
+            return httpx.Response(200, headers={"x-goog-upload-url": UPLOAD_URL})
+        if command == "query":
+            self.queries += 1
+            status = "final" if self.finalized else "active"
+            return httpx.Response(200, headers={"x-goog-upload-status": status,
+                                                "x-goog-upload-size-received": str(len(self.received))})
+        offset = int(request.headers["x-goog-upload-offset"])
+        self.upload_offsets.append(offset)
+        assert offset == len(self.received), "续传偏移应等于服务端已收到的字节数"
+        body = request.read()
+        if offset in self.drop_at:
+            self.drop_at.discard(offset)
+            self.received += body[:len(body) // 2]
+            raise httpx.ReadError("connection reset", request=request)
+        self.received += body
+        if "finalize" in command:
+            self.finalized = True
+            return httpx.Response(200, json={"file": {"uri": "files/abc", "sizeBytes": str(len(self.received))}})
+        return httpx.Response(200)
+
+def run_upload(server: StubUploadServer, source):
+    async def upload():
+        upload_config = {"chunk_size": GRANULARITY, "max_retries": 3, "retry_backoff": 0, "chunk_timeout": 10}
+        async with httpx.AsyncClient(transport=httpx.MockTransport(server.handler)) as client:
+            uploader = GeminiResumableUpload(client, "https://api.test", "key", upload_config)
+            file_info = await uploader.upload(source, "video/mp4")
+            return file_info, uploader.retries
+    return asyncio.run(upload())
+
+def test_resume_after_dropped_connection():
+    data = os.urandom(GRANULARITY * 3 + 1000)
+    server = StubUploadServer(drop_at=[GRANULARITY])
+    file_info, retries = run_upload(server, data)
+    assert bytes(server.received) == data
+    assert file_info["uri"] == "files/abc"
+    assert retries == 1 and server.queries == 1
+    # 第二块收到一半时断开，续传从服务端报告的偏移开始，而不是从块首重发
+    assert server.upload_offsets == [0, GRANULARITY, GRANULARITY + GRANULARITY // 2, GRANULARITY * 2, GRANULARITY * 3]
+
+def test_resume_final_chunk():
+    data = os.urandom(GRANULARITY + 10)
+    server = StubUploadServer(drop_at=[GRANULARITY])
+    file_info, retries = run_upload(server, data)
+    assert bytes(server.received) == data
+    assert server.finalized and file_info["uri"] == "files/abc"
+    assert server.upload_offsets == [0, GRANULARITY, GRANULARITY + 5]
+
+def test_upload_from_file(tmp_path):
+    data = os.urandom(GRANULARITY * 2)
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+    server = StubUploadServer()
+    file_info, retries = run_upload(server, str(path))
+    assert bytes(server.received) == data and retries == 0
+    assert server.upload_offsets == [0, GRANULARITY]
+
+def test_multipart_reader_streams_from_view():
+    data = bytearray(os.urandom(1000))
+
+    async def open_reader():
+        return await open_for_multipart(memoryview(data))
+
+    reader = asyncio.run(open_reader())
+    assert reader.read(300) == bytes(data[:300])
+    # 读取的是原缓冲区本身，没有预先复制
+    data[300] = data[300] ^ 0xFF
+    assert reader.read(1) == bytes(data[300:301])
+    assert reader.seek(0, os.SEEK_END) == 1000 and reader.read(10) == b""
+    reader.seek(0)
+    assert reader.read() == bytes(data) and reader.tell() == 1000
+    reader.close()
+
+def test_multipart_upload_body():
+    data = os.urandom(200 * 1024)
+    received = {}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        received["body"] = request.read()
+        return httpx.Response(200, json={"id": "file-1"})
+
+    async def upload():
+        fileobj = await open_for_multipart(memoryview(data))
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await client.post("https://api.test/files", files={"file": ("a.bin", fileobj, "application/octet-stream")})
+        return fileobj.tell()
+
+    assert asyncio.run(upload()) == len(data)
+    assert data in received["body"]
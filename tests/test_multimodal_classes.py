@@ -0,0 +1,37 @@
+import asyncio
+import base64
+import json
+from multimodal_classes import Image, MediaBlob
+
+def test_source_base64_compatibility():
+    image = Image(byte=b"abc", mime_type="image/png")
+    assert "base64" in image.source
+    assert image.source["base64"] == image.source.get("base64") == base64.b64encode(b"abc").decode()
+    # 序列化 source 时不带 base64
+    assert json.loads(json.dumps(image.source)) == {"mime_type": "image/png", "filename": "byte_image"}
+
+def test_source_base64_assignment_replaces_blob():
+    image = Image(url="https://example.com/a.png")
+    assert "base64" not in image.source and image.source.get("base64") is None
+    image.source["base64"] = base64.b64encode(b"xyz").decode()
+    assert image.blob.tobytes() == b"xyz"
+    assert asyncio.run(image.to_dict()) == {"inline_data": {"mime_type": "image/jpeg", "data": "eHl6"}}
+
+def test_blob_from_path_is_mapped(tmp_path):
+    path = tmp_path / "a.png"
+    path.write_bytes(b"\x89PNG" + bytes(100))
+    image = Image(path=str(path))
+    assert image.source["mime_type"] == "image/png" and image.blob.nbytes == 104
+    assert image.blob.view().tobytes() == path.read_bytes()
+    assert MediaBlob.from_base64(image.blob.b64).tobytes() == path.read_bytes()
+    image.blob.close()
+
+def test_nbytes_ignores_whitespace_in_base64():
+    for size in range(0, 200, 7):
+        raw = bytes(range(256))[:size] * 3
+        wrapped = base64.encodebytes(raw).decode()  # MIME 风格，每 76 个字符换行
+        for text in (base64.b64encode(raw).decode(), wrapped, wrapped.replace("\n", "\r\n"), f"  {wrapped} \n"):
+            blob = MediaBlob.from_base64(text)
+            assert blob.nbytes == len(raw), (size, text)
+            assert blob.tobytes() == raw
+            assert asyncio.run(MediaBlob.from_base64(text).aview()).tobytes() == raw
@@ -0,0 +1,89 @@
+import asyncio
+import search_federation
+from search_federation import RRF_K, SearchFederation, hedged_call
+
+def entry(name: str, content: str = ""):
+    return {"title": f"页面标题 {name}", "link": f"https://{name}.test/", "content": content}
+
+def make_federation(monkeypatch, engines, weights=None, hedge_after=0.05, timeout=1.0):
+    monkeypatch.setattr(search_federation, "ENGINES", dict(engines))
+    configs = {name: {"enabled": True, "weight": (weights or {}).get(name, 1.0), "timeout": timeout,
+                      "hedge_after": hedge_after} for name in engines}
+    return SearchFederation(configs, deadline=2.0, max_tokens=2000, max_results=20, max_snippet_chars=300)
+
+def test_hedge_fires_for_slow_engine():
+    calls = []
+
+    async def slow_first(query):
+        calls.append(query)
+        if len(calls) == 1:
+            await asyncio.sleep(5)  # 第一次请求卡住，对冲请求立即返回
+        return [entry("a")]
+
+    results, hedged = asyncio.run(hedged_call(slow_first, "q", timeout=1.0, hedge_after=0.05))
+    assert hedged and len(calls) == 2
+    assert results == [entry("a")]
+
+def test_no_hedge_when_fast():
+    calls = []
+
+    async def fast(query):
+        calls.append(query)
+        return []
+
+    assert asyncio.run(hedged_call(fast, "q", timeout=1.0, hedge_after=0.05)) == ([], False)
+    assert len(calls) == 1
+
+def test_federated_search_with_slow_and_failing_engines(monkeypatch):
+    slow_calls = []
+
+    async def slow(query):
+        slow_calls.append(query)
+        if len(slow_calls) == 1:
+            await asyncio.sleep(5)
+        return [entry("a"), entry("b"), entry("c")]
+
+    async def fast(query):
+        return [entry("c", "更长的摘要内容"), entry("d"), entry("a")]
+
+    async def failing(query):
+        raise RuntimeError("engine down")
+
+    federation = make_federation(monkeypatch, {"slow": slow, "fast": fast, "failing": failing})
+
+    async def run_engines():
+        return await asyncio.gather(*(federation._run_engine(name, "q") for name in federation.engines))
+
+    outcomes = asyncio.run(run_engines())
+    stats = {name: engine_stats for name, _, engine_stats in outcomes}
+    assert stats["slow"]["status"] == "ok" and stats["slow"]["hedged"] is True
+    assert stats["fast"]["hedged"] is False
+    assert stats["failing"]["status"] == "error: engine down"
+
+    results = federation.merge([(name, entries) for name, entries, _ in outcomes])
+    # a: 1/(k+1) + 1/(k+3)，c: 1/(k+3) + 1/(k+1)，两者相同时保持首次出现的顺序；b: 1/(k+2)，d: 1/(k+2)
+    assert [item["link"] for item in results] == ["https://a.test/", "https://c.test/", "https://b.test/", "https://d.test/"]
+    assert results[0]["score"] == 1 / (RRF_K + 1) + 1 / (RRF_K + 3)
+    assert results[0]["engines"] == ["slow", "fast"]
+    assert results[1]["content"] == "更长的摘要内容"
+
+    text = asyncio.run(federation.search("q"))
+    assert "去重后 4 条" in text and "failing 0 条" in text
+
+def test_weights_and_title_dedup(monkeypatch):
+    federation = make_federation(monkeypatch, {"x": None, "y": None}, weights={"x": 1.0, "y": 3.0})
+    results = federation.merge([
+        ("x", [entry("a"), entry("b")]),
+        # 链接不同但标题相同，视为同一结果
+        ("y", [{"title": "页面标题  B", "link": "https://mirror.test/b", "content": ""}, entry("e")]),
+    ])
+    assert [item["link"] for item in results] == ["https://b.test/", "https://e.test/", "https://a.test/"]
+    assert results[0]["engines"] == ["x", "y"]
+
+def test_deadline_drops_hanging_engine(monkeypatch):
+    async def hang(query):
+        await asyncio.sleep(5)
+
+    federation = make_federation(monkeypatch, {"hang": hang}, hedge_after=0, timeout=0.1)
+    name, entries, stats = asyncio.run(federation._run_engine("hang", "q"))
+    assert entries == [] and stats["status"] == "timeout"
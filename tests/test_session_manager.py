@@ -0,0 +1,167 @@
+import asyncio
+import os
+from history_store import SQLiteHistoryStore
+from session_manager import SessionManager, UserIdSigner, load_secret
+
+async def run_turn(sessions: SessionManager, user_id: str, name: str, events: list, delay: float = 0.02):
+    session = sessions.get(user_id)
+    async with sessions.turn(session):
+        events.append(("start", name))
+        session.history.append({"role": "user", "parts": [{"text": name}]})
+        await asyncio.sleep(delay)
+        session.history.append({"role": "model", "parts": [{"text": f"re: {name}"}]})
+        events.append(("end", name))
+        session.touch()
+        await sessions.persist(session)
+
+def assert_serial(events: list):
+    """每一轮开始后，下一轮开始前必须先结束"""
+    for index in range(0, len(events), 2):
+        assert events[index][0] == "start" and events[index + 1] == ("end", events[index][1]), events
+
+def test_same_user_turns_run_one_after_another():
+    sessions = SessionManager()
+    events = []
+
+    async def run():
+        await asyncio.gather(*(run_turn(sessions, "alice", f"turn-{i}", events) for i in range(5)))
+
+    asyncio.run(run())
+    assert_serial(events)
+    history = sessions.get("alice").history
+    assert [message["role"] for message in history] == ["user", "model"] * 5
+
+def test_different_users_run_concurrently():
+    sessions = SessionManager()
+    events = []
+
+    async def run():
+        await asyncio.gather(run_turn(sessions, "alice", "a", events, 0.05), run_turn(sessions, "bob", "b", events, 0.05))
+
+    asyncio.run(run())
+    assert [kind for kind, _ in events[:2]] == ["start", "start"]
+
+def test_turns_serialized_across_managers_sharing_a_store(tmp_path):
+    # 两个 SessionManager 模拟两个 worker 进程，通过存储的租约串行执行同一用户的轮次
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    workers = [SessionManager(store=store), SessionManager(store=store)]
+    events = []
+
+    async def run():
+        await asyncio.gather(*(run_turn(workers[i % 2], "alice", f"turn-{i}", events) for i in range(6)))
+
+    asyncio.run(run())
+    assert_serial(events)
+    history, _, _ = asyncio.run(store.load("alice"))
+    assert len(history) == 12
+    asyncio.run(store.close())
+
+def test_evict_skips_sessions_in_use():
+    sessions = SessionManager(max_sessions=2)
+
+    async def run():
+        busy = sessions.get("busy")
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def hold():
+            async with sessions.turn(busy):
+                started.set()
+                await release.wait()
+
+        holder = asyncio.ensure_future(hold())
+        await started.wait()
+        # 已进入 turn() 但尚未拿到锁（例如上一轮正在交出锁）的会话同样不能被淘汰
+        queued = sessions.get("queued")
+        queued.users += 1
+
+        sessions.get("idle-1")
+        assert sessions.peek("busy") is busy, "持有锁的会话不应被淘汰"
+        assert sessions.peek("queued") is queued, "等待锁的会话不应被淘汰"
+        sessions.get("idle-2")
+        assert sessions.peek("idle-1") is None, "超出上限时淘汰空闲的会话"
+        assert sessions.peek("busy") is busy and sessions.peek("queued") is queued
+
+        release.set()
+        await holder
+        queued.users -= 1
+        sessions.get("idle-3")
+        assert sessions.peek("busy") is None and sessions.peek("queued") is None, "使用结束后可以被淘汰"
+
+    asyncio.run(run())
+
+def test_evict_idle_sessions():
+    sessions = SessionManager(idle_timeout=60)
+    stale = sessions.get("stale")
+    stale.last_active -= 120
+    sessions.get("fresh")
+    assert sessions.peek("stale") is None and len(sessions) == 1
+
+class FakeRequest:
+    def __init__(self, query=None, cookies=None):
+        self.query_params = query or {}
+        self.cookies = cookies or {}
+
+def test_signed_user_ids(tmp_path):
+    signer = UserIdSigner(load_secret(str(tmp_path / "secret")))
+    token = signer.issue()
+    user_id = signer.verify(token)
+    assert user_id and token.startswith(user_id + ".")
+    assert signer.resolve(FakeRequest(query={"user_id": token}), "conn-1") == user_id
+    assert signer.resolve(FakeRequest(cookies={"user_id": token}), "conn-1") == user_id
+
+    # 未签名、签名错误或用其他密钥签名的 ID 都被拒绝，改用连接 ID
+    other = UserIdSigner(b"another secret")
+    for forged in (user_id, f"{user_id}.{'0' * 64}", other.sign(user_id), "bad id.x", ""):
+        assert signer.verify(forged) is None
+        assert signer.resolve(FakeRequest(query={"user_id": forged}), "conn-1") == "conn-1"
+
+def test_secret_is_shared_and_kept(tmp_path):
+    path = str(tmp_path / "data" / "secret")
+    first = load_secret(path)
+    assert load_secret(path) == first and len(first) == 64
+    assert oct(os.stat(path).st_mode & 0o777) == "0o600"
+    assert UserIdSigner(first).sign("alice") == UserIdSigner(load_secret(path)).sign("alice")
+
+def test_500_concurrent_users(tmp_path):
+    # 500 个用户，每个用户 4 个并发轮次，分给共享存储的两个 SessionManager；
+    # 会话数上限小于用户数，轮次之间会话会被淘汰并从存储重新加载
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"))
+    workers = [SessionManager(max_sessions=100, store=store), SessionManager(max_sessions=100, store=store)]
+    users, turns = 500, 4
+    active = {}
+    overlap = {"max": 0, "current": 0}
+
+    async def user_turn(index: int, turn: int):
+        user_id = f"user-{index}"
+        sessions = workers[(index + turn) % 2]
+        session = sessions.get(user_id)
+        async with sessions.turn(session):
+            active[user_id] = active.get(user_id, 0) + 1
+            assert active[user_id] == 1, f"{user_id} 的轮次并发执行"
+            overlap["current"] += 1
+            overlap["max"] = max(overlap["max"], overlap["current"])
+            session.history.append({"role": "user", "parts": [{"text": f"{user_id} turn {turn}"}]})
+            await asyncio.sleep(0.001)
+            session.history.append({"role": "model", "parts": [{"text": f"re: {user_id} turn {turn}"}]})
+            overlap["current"] -= 1
+            active[user_id] -= 1
+            session.touch()
+            await sessions.persist(session)
+
+    async def run():
+        await asyncio.gather(*(user_turn(index, turn) for turn in range(turns) for index in range(users)))
+
+    asyncio.run(run())
+    assert overlap["max"] > 1, "不同用户的轮次应并发执行"
+    # 所有轮次结束后没有会话仍处于使用中，可以淘汰到上限以内
+    for sessions in workers:
+        sessions.evict()
+        assert len(sessions) <= 100
+    for index in range(users):
+        history, _, _ = asyncio.run(store.load(f"user-{index}"))
+        texts = [message["parts"][0]["text"] for message in history]
+        assert len(texts) == turns * 2, f"user-{index} 的历史丢失: {texts}"
+        assert sorted(texts[0::2]) == [f"user-{index} turn {turn}" for turn in range(turns)]
+        assert all(reply == f"re: {question}" for question, reply in zip(texts[0::2], texts[1::2]))
+    asyncio.run(store.close())
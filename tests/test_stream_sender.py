@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+import types
+import os
+from multimodal_classes import Audio, CustomFile, Image, Video
+from stream_sender import media_item_type, send_framed, send_stream
+
+def make_config(**streaming):
+    return types.SimpleNamespace(api={"streaming": streaming})
+
+def chunk(content: str = "", start: bool = False, end: bool = False) -> str:
+    return f"data: {json.dumps({'content': content, 'start_stream': start, 'end_stream': end})}\n\n"
+
+class FakeWebSocket:
+    """记录发送的帧和发送时间；gate 未打开时发送一直阻塞，模拟拥塞的客户端"""
+
+    def __init__(self, blocked: bool = False):
+        self.frames = []
+        self.sent_at = []
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def send_text(self, text: str):
+        await self.gate.wait()
+        self.frames.append(text)
+        self.sent_at.append(time.perf_counter())
+
+def test_slow_websocket_pauses_producer():
+    chunks = [chunk("x" * 1000) for _ in range(100)]
+    size = len(chunks[0])
+    pulled = []
+
+    async def upstream():
+        for item in chunks:
+            pulled.append(item)
+            yield item
+            await asyncio.sleep(0)
+
+    async def run():
+        websocket = FakeWebSocket(blocked=True)
+        config = make_config(flush_interval_ms=1, flush_bytes=size, max_pending_bytes=4 * size)
+        sending = asyncio.ensure_future(send_stream(websocket, upstream(), "c1", config))
+        await asyncio.sleep(0.1)
+        # 第一帧阻塞在发送中，缓冲区攒满 max_pending_bytes 后不再读取上游
+        assert len(pulled) <= 1 + 4 + 1, len(pulled)
+        websocket.gate.set()
+        stats = await sending
+        assert "".join(websocket.frames) == "".join(chunks)
+        assert stats.tokens == 100 and stats.bytes_sent == 100 * size
+
+    asyncio.run(run())
+
+def test_coalescing_respects_flush_bytes():
+    chunks = [chunk(f"token {i} ") for i in range(200)]
+    flush_bytes = 1000
+
+    async def upstream():
+        for item in chunks:
+            yield item
+            await asyncio.sleep(0)
+
+    async def run():
+        websocket = FakeWebSocket()
+        # 时间窗口足够长，只有攒够 flush_bytes 才发送
+        config = make_config(flush_interval_ms=10000, flush_bytes=flush_bytes)
+        stats = await send_stream(websocket, upstream(), "c1", config)
+        assert "".join(websocket.frames) == "".join(chunks)
+        assert all(len(frame) >= flush_bytes for frame in websocket.frames[:-1])
+        assert stats.frames == len(websocket.frames) <= sum(map(len, chunks)) // flush_bytes + 1
+
+    asyncio.run(run())
+
+def test_coalescing_respects_flush_interval():
+    chunks = [chunk(start=True)] + [chunk(f"token {i} ") for i in range(20)] + [chunk(end=True)]
+    interval_ms = 30
+
+    async def upstream():
+        for item in chunks:
+            yield item
+            await asyncio.sleep(0.005)
+
+    async def run():
+        websocket = FakeWebSocket()
+        started = time.perf_counter()
+        config = make_config(flush_interval_ms=interval_ms, flush_bytes=1024 * 1024)
+        await send_stream(websocket, upstream(), "c1", config)
+        assert "".join(websocket.frames) == "".join(chunks)
+        # 开始帧立即单独发送，之后约每 30ms 一帧，而不是每个分块一帧
+        assert websocket.frames[0] == chunks[0]
+        assert websocket.sent_at[0] - started < interval_ms / 1000
+        assert 2 <= len(websocket.frames) <= 8
+        # 结束帧触发立即发送，是最后一帧的结尾
+        assert websocket.frames[-1].endswith(chunks[-1])
+
+    asyncio.run(run())
+
+def test_upstream_error_is_raised():
+    async def upstream():
+        yield chunk("partial")
+        raise RuntimeError("upstream closed")
+
+    async def run():
+        websocket = FakeWebSocket()
+        try:
+            await send_stream(websocket, upstream(), "c1", make_config())
+        except RuntimeError as e:
+            assert str(e) == "upstream closed"
+        else:
+            raise AssertionError("上游异常应抛给调用方")
+        assert websocket.frames == [chunk("partial")]
+
+    asyncio.run(run())
+
+class FrameRecorder:
+    """按顺序记录文本帧和二进制帧"""
+
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text: str):
+        self.frames.append(text)
+
+    async def send_bytes(self, data: bytes):
+        self.frames.append(data)
+
+def test_send_framed_round_trips_every_media_class():
+    media = [cls(byte=os.urandom(1000 + index), mime_type=mime_type)
+             for index, (cls, mime_type) in enumerate([(Image, "image/png"), (Audio, "audio/ogg"),
+                                                       (Video, "video/webm"), (CustomFile, "application/pdf")])]
+    # 各类的默认 mime 类型也应映射回该类
+    media += [cls(byte=b"default") for cls in (Image, Audio, Video, CustomFile)]
+
+    async def run():
+        messages, frames = [{"type": "text", "content": "附件如下"}], []
+        for item in media:
+            blob = await item.load()
+            messages.append({"type": media_item_type(item.source["mime_type"]), "source": {
+                "frame": len(frames), "size": blob.nbytes, "mime_type": item.source["mime_type"],
+                "filename": f"文件{len(frames)}"}})
+            frames.append((await blob.aview()).tobytes())
+        websocket = FrameRecorder()
+        sent = await send_framed(websocket, messages, frames)
+        return messages, frames, websocket.frames, sent
+
+    messages, frames, sent_frames, sent = asyncio.run(run())
+    header, binary = json.loads(sent_frames[0]), sent_frames[1:]
+    assert header == {"type": "media_batch", "frames": len(media), "messages": messages}
+    assert "文件0" in sent_frames[0]  # 头部不转义中文
+    assert sent == len(sent_frames[0].encode("utf-8")) + sum(map(len, frames))
+    assert binary == frames
+    for item, message in zip(media, header["messages"][1:]):
+        assert message["type"] == item.type
+        assert binary[message["source"]["frame"]] == item.blob.tobytes()
+        assert message["source"]["size"] == len(binary[message["source"]["frame"]])
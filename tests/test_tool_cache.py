@@ -0,0 +1,111 @@
+import asyncio
+import time
+import tool_cache
+from tool_cache import ToolResultCache, normalize_url
+
+class FakeClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+def counting_call(calls, result, delay: float = 0):
+    async def call():
+        calls.append(asyncio.current_task())
+        await asyncio.sleep(delay)
+        return result
+    return call
+
+def test_concurrent_identical_calls_run_once():
+    cache = ToolResultCache({"search_net": 60})
+    calls = []
+
+    async def run():
+        call = counting_call(calls, "结果", delay=0.05)
+        # 参数只差空白和大小写，规范化后是同一个键
+        queries = ["Python  asyncio", " python asyncio", "PYTHON asyncio "] * 10
+        return await asyncio.gather(*(cache.get_or_call("search_net", {"query": q}, call) for q in queries))
+
+    results = asyncio.run(run())
+    assert results == ["结果"] * 30
+    assert len(calls) == 1
+    assert cache.stats()["misses"] == 1 and cache.stats()["shared"] == 29
+
+def test_ttl_expiry(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(tool_cache.time, "time", clock)
+    cache = ToolResultCache({"read_html": 60}, disk_path=str(tmp_path / "cache.db"))
+    calls = []
+    call = counting_call(calls, {"text": "页面"})
+    args = {"url": "https://example.com/page"}
+
+    async def get():
+        return await cache.get_or_call("read_html", args, call)
+
+    assert asyncio.run(get()) == {"text": "页面"}
+    clock.now += 59
+    asyncio.run(get())
+    assert len(calls) == 1 and cache.stats()["hits"] == 1
+    # 内存和磁盘中的结果都已过期
+    clock.now += 2
+    asyncio.run(get())
+    assert len(calls) == 2 and cache.stats()["disk_hits"] == 0
+    cache.close()
+
+def test_disk_layer_and_lru(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ToolResultCache({"read_html": 60}, max_entries=2, disk_path=path)
+    calls = []
+
+    async def get(url):
+        return await cache.get_or_call("read_html", {"url": url}, counting_call(calls, {"text": url}))
+
+    for url in ("https://a.test/", "https://b.test/", "https://c.test/"):
+        asyncio.run(get(url))
+    assert cache.stats()["entries"] == 2
+    # 被 LRU 淘汰的结果从磁盘层读回
+    assert asyncio.run(get("https://a.test/")) == {"text": "https://a.test/"}
+    assert len(calls) == 3 and cache.stats()["disk_hits"] == 1
+    cache.close()
+
+    reopened = ToolResultCache({"read_html": 60}, disk_path=path)
+    assert asyncio.run(reopened.get_or_call("read_html", {"url": "https://b.test"}, counting_call(calls, None))) \
+        == {"text": "https://b.test/"}
+    assert len(calls) == 3
+    reopened.close()
+
+def test_errors_not_cached():
+    cache = ToolResultCache({"read_html": 60})
+    calls = []
+    call = counting_call(calls, {"error": "timeout"})
+    for _ in range(2):
+        asyncio.run(cache.get_or_call("read_html", {"url": "https://a.test"}, call))
+    assert len(calls) == 2
+
+def test_cancelled_caller_does_not_cancel_others():
+    cache = ToolResultCache({"read_html": 60})
+    calls = []
+
+    async def run():
+        call = counting_call(calls, {"text": "页面内容"}, delay=0.1)
+        a = asyncio.ensure_future(cache.get_or_call("read_html", {"url": "https://example.com"}, call))
+        b = asyncio.ensure_future(cache.get_or_call("read_html", {"url": "https://example.com/"}, call))
+        await asyncio.sleep(0.01)
+        a.cancel()
+        assert await b == {"text": "页面内容"} and not b.cancelled()
+        assert a.cancelled() and len(calls) == 1 and cache.stats()["shared"] == 1
+
+        # 没有等待者时取消调用
+        c = asyncio.ensure_future(cache.get_or_call("read_html", {"url": "https://example.org"}, call))
+        await asyncio.sleep(0.01)
+        c.cancel()
+        await asyncio.sleep(0.01)
+        assert calls[-1].cancelled()
+
+    asyncio.run(run())
+
+def test_normalize_url():
+    assert normalize_url("HTTPS://Example.com:443") == "https://example.com/"
+    assert normalize_url("http://example.com:80/a?q=1#frag") == "http://example.com/a?q=1"
+    assert normalize_url("https://example.com/a/") != normalize_url("https://example.com/a")
@@ -0,0 +1,78 @@
+import asyncio
+import types
+import tool_loop
+import webui_handlers
+from tool_loop import ToolExecutor, ToolLoop, tool_loop_stats
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self) -> float:
+        return self.now
+
+def test_rounds_budget_and_frozen_total(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(tool_loop, "time", clock)
+    loop = ToolLoop("client-1", max_rounds=2, max_seconds=60)
+    assert tool_loop_stats["client-1"] is loop
+
+    async def run_round(tools):
+        round_stats = loop.begin_round()
+        clock.now += 0.5
+        round_stats.first_byte()
+        executor = ToolExecutor(lambda call: asyncio.sleep(0, {"name": call["name"]}), round_stats)
+        for name in tools:
+            executor.start({"name": name})
+        clock.now += 1.0
+        round_stats.response_done()
+        return await executor.results()
+
+    assert asyncio.run(run_round(["search"])) == [{"name": "search"}]
+    assert not loop.exhausted()
+    asyncio.run(run_round(["read", "search"]))
+    assert loop.exhausted()  # 两轮函数调用用完预算
+    asyncio.run(run_round([]))
+    loop.finish()
+
+    stats = loop.to_dict()
+    clock.now += 30
+    # 结束后总耗时不再随时间增长
+    assert loop.to_dict() == stats
+    assert stats["total_ms"] == 4500.0 and stats["tool_rounds"] == 2 and stats["max_rounds"] == 2
+    assert [round_stats["tools"] for round_stats in stats["rounds"]] == [["search"], ["read", "search"], []]
+    assert stats["rounds"][0]["first_byte_ms"] == 500.0 and stats["rounds"][0]["response_ms"] == 1500.0
+    tool_loop_stats.pop("client-1")
+
+def test_exhausted_by_time(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(tool_loop, "time", clock)
+    loop = ToolLoop(None, max_rounds=5, max_seconds=10)
+    assert not loop.exhausted()
+    clock.now += 10
+    assert loop.exhausted()
+
+def test_stats_command_reports_tool_loop(monkeypatch):
+    monkeypatch.setattr(webui_handlers, "webui_listeners", [])
+    monkeypatch.setattr(webui_handlers, "get_llm_key_pool", lambda config: types.SimpleNamespace(stats=lambda: {}))
+    monkeypatch.setattr(webui_handlers, "get_connections",
+                        lambda config: types.SimpleNamespace(stats=lambda: {"connections": 1}))
+    webui_handlers.webui_main(types.SimpleNamespace(api={}))
+    (loop_stats,) = [listener for listener in webui_handlers.webui_listeners if listener.__name__ == "loop_stats"]
+    sent = []
+
+    async def send_message(client_id, message_list):
+        sent.append((client_id, message_list[0].content))
+
+    def ask(client_id):
+        event = webui_handlers.WebUIEvent([{"type": "text", "content": "/运行状态"}], client_id)
+        asyncio.run(loop_stats(event, send_message))
+        return sent[-1][1]
+
+    assert ask("client-2").endswith("最近一次回复的函数调用: 无")
+    loop = ToolLoop("client-2", max_rounds=5, max_seconds=120)
+    loop.begin_round().tools.append("search")
+    loop.finish()
+    text = ask("client-2")
+    assert "'tool_rounds': 1" in text and "'tools': ['search']" in text
+    tool_loop_stats.pop("client-2")
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import pytest
+import upload_store
+from media_upload import UploadError
+from upload_store import UploadStore
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+def make_store(tmp_path, **options) -> UploadStore:
+    settings = dict(max_bytes=1000, ttl=60, write_buffer=16, user_quota_bytes=1500, total_quota_bytes=2500)
+    settings.update(options)
+    return UploadStore(str(tmp_path / "uploads"), **settings)
+
+def save(store: UploadStore, user_id: str, *chunks, expected_size=None):
+    return asyncio.run(store.save(stream(*chunks), "a.bin", "application/octet-stream", user_id, expected_size))
+
+def test_save_and_resolve(tmp_path):
+    store = make_store(tmp_path)
+    meta = save(store, "alice", b"x" * 100, b"y" * 50)
+    resolved = store.resolve(meta["upload_id"])
+    with open(resolved["path"], "rb") as f:
+        assert f.read() == b"x" * 100 + b"y" * 50
+    assert resolved["user_id"] == "alice" and store.usage("alice") == 150
+
+def test_user_quota(tmp_path):
+    store = make_store(tmp_path)
+    save(store, "alice", b"x" * 800)
+    save(store, "alice", b"x" * 600)
+    # 声明的长度超出配额时直接拒绝
+    with pytest.raises(UploadError) as excinfo:
+        save(store, "alice", b"x" * 200, expected_size=200)
+    assert excinfo.value.status_code == 413
+    # 没有声明长度时在接收过程中拒绝，并删除已写入的部分
+    with pytest.raises(UploadError) as excinfo:
+        save(store, "alice", b"x" * 50, b"x" * 50, b"x" * 50)
+    assert excinfo.value.status_code == 413
+    assert store.usage("alice") == 1400
+    assert len(os.listdir(store.directory)) == 4
+    # 其他用户不受影响
+    save(store, "bob", b"x" * 900)
+
+def test_total_quota(tmp_path):
+    store = make_store(tmp_path)
+    save(store, "alice", b"x" * 900)
+    save(store, "bob", b"x" * 900)
+    with pytest.raises(UploadError) as excinfo:
+        save(store, "carol", b"x" * 800)
+    assert excinfo.value.status_code == 413
+    assert store.total_usage == 1800
+
+def test_concurrent_uploads_count_towards_quota(tmp_path):
+    store = make_store(tmp_path)
+
+    async def slow_stream():
+        for _ in range(10):
+            yield b"x" * 100
+            await asyncio.sleep(0.001)
+
+    async def run():
+        return await asyncio.gather(
+            *(store.save(slow_stream(), "a.bin", "application/octet-stream", "alice") for _ in range(2)),
+            return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert sum(isinstance(result, UploadError) for result in results) == 1
+    assert store.usage("alice") == 1000
+
+def test_expired_uploads_are_removed(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    meta = save(store, "alice", b"x" * 1000)
+    now = upload_store.time.time()
+    monkeypatch.setattr(upload_store.time, "time", lambda: now + 61)
+    with pytest.raises(UploadError) as excinfo:
+        store.resolve(meta["upload_id"])
+    assert excinfo.value.status_code == 404
+    asyncio.run(store.sweep(force=True))
+    assert os.listdir(store.directory) == [] and store.usage("alice") == 0
+    # 配额随之释放
+    save(store, "alice", b"x" * 1000)
+
+def test_usage_counted_from_disk(tmp_path):
+    # 另一个 worker（或重启前）写入的附件在清理时计入配额
+    save(make_store(tmp_path), "alice", b"x" * 1000)
+    store = make_store(tmp_path)
+    asyncio.run(store.sweep(force=True))
+    assert store.usage("alice") == 1000
+    with pytest.raises(UploadError):
+        save(store, "alice", b"x" * 600)
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+from single_flight import SingleFlight
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认工具缓存配置，可在 config/api.yaml 的 tool_cache 中覆盖
+DEFAULT_TOOL_CACHE_CONFIG = {
+    "enabled": True,
+    "max_entries": 256,  # 内存 LRU 条数
+    "disk_path": "data/tool_cache.db",  # 为空时只使用内存缓存
+    "ttl": {"search_net": 600, "read_html": 3600},  # 各工具结果的有效秒数，未列出的工具不缓存
+}
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_url(url: str) -> str:
+    """
+    规范化 URL：协议和域名小写，去掉默认端口和片段，空路径视为 "/"。
+
+    路径末尾的斜杠保留，/a/ 和 /a 在很多网站上是不同的页面。
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    path = parts.path or "/"
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+def normalize_args(tool: str, args: Dict[str, Any]) -> str:
+    """把参数转成稳定的缓存键：字符串去掉首尾空白并合并连续空白，url 参数额外规范化"""
+    normalized = {}
+    for name, value in args.items():
+        if isinstance(value, str):
+            value = _WHITESPACE.sub(" ", value.strip())
+            if name == "url":
+                value = normalize_url(value)
+            elif name == "query":
+                value = value.lower()
+        normalized[name] = value
+    return f"{tool}:{json.dumps(normalized, ensure_ascii=False, sort_keys=True)}"
+
+class ToolResultCache:
+    """
+    工具调用结果缓存：内存 LRU + 可选的 SQLite 磁盘层，按工具设置过期时间。
+
+    相同参数的并发调用只执行一次，其余调用等待同一结果。
+    """
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int = 256, disk_path: Optional[str] = None):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.shared = 0  # 合并到进行中调用的次数
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()  # 键 -> (结果, 过期时间戳)
+        self._inflight = SingleFlight()
+        self._conn = None
+        self._lock = threading.Lock()
+        if disk_path:
+            directory = os.path.dirname(disk_path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            self._conn = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            os.chmod(disk_path, 0o600)  # 包含用户的搜索词和读取过的网页，只允许运行服务的用户读写
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")  # 多个 worker 共享数据库时等待写锁
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tool_cache (key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute("DELETE FROM tool_cache WHERE expires_at <= ?", (time.time(),))
+
+    @classmethod
+    def from_config(cls, config) -> "ToolResultCache":
+        cache_config = dict(DEFAULT_TOOL_CACHE_CONFIG)
+        cache_config.update(config.api.get("tool_cache") or {})
+        ttls = dict(DEFAULT_TOOL_CACHE_CONFIG["ttl"])
+        ttls.update(cache_config.get("ttl") or {})
+        if not cache_config["enabled"]:
+            ttls = {}
+        return cls(ttls, cache_config["max_entries"], cache_config["disk_path"] or None)
+
+    # 磁盘层，在线程中执行
+    def _disk_get(self, key: str) -> Optional[Tuple[Any, float]]:
+        with self._lock:
+            row = self._conn.execute("SELECT result, expires_at FROM tool_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _disk_put(self, key: str, result: Any, expires_at: float):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO tool_cache (key, result, expires_at) VALUES (?, ?, ?)",
+                               (key, json.dumps(result, ensure_ascii=False), expires_at))
+
+    async def _lookup(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._entries[key]
+        if self._conn is not None:
+            entry = await asyncio.to_thread(self._disk_get, key)
+            if entry is not None:
+                self._remember(key, *entry)
+                self.disk_hits += 1
+                return entry[0]
+        return None
+
+    def _remember(self, key: str, result: Any, expires_at: float):
+        self._entries[key] = (result, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_call(self, tool: str, args: Dict[str, Any], call: Callable[[], Awaitable[Any]],
+                          cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        返回缓存结果，未命中时执行 call() 并缓存。
+
+        结果为空、包含 error 或 cacheable(result) 为假时不缓存。未配置 TTL 的工具直接执行。
+        """
+        ttl = self.ttls.get(tool)
+        if not ttl:
+            return await call()
+        key = normalize_args(tool, args)
+        result = await self._lookup(key)
+        if result is not None:
+            logger.info(f"工具缓存命中: {key}")
+            return result
+
+        if key in self._inflight:
+            self.shared += 1
+        else:
+            self.misses += 1
+        return await self._inflight.run(key, lambda: self._call(key, ttl, call, cacheable))
+
+    async def _call(self, key: str, ttl: float, call: Callable[[], Awaitable[Any]],
+                    cacheable: Optional[Callable[[Any], bool]]) -> Any:
+        result = await call()
+        if result and not (isinstance(result, dict) and "error" in result) and (cacheable is None or cacheable(result)):
+            expires_at = time.time() + ttl
+            self._remember(key, result, expires_at)
+            if self._conn is not None:
+                try:
+                    await asyncio.to_thread(self._disk_put, key, result, expires_at)
+                except (sqlite3.Error, TypeError, ValueError) as e:
+                    logger.warning(f"工具缓存写入磁盘失败: {str(e)}")
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "shared": self.shared,
+        }
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+_tool_cache: Optional[ToolResultCache] = None
+
+def get_tool_cache(config) -> ToolResultCache:
+    """全局工具结果缓存，首次使用时按配置创建"""
+    global _tool_cache
+    if _tool_cache is None:
+        _tool_cache = ToolResultCache.from_config(config)
+    return _tool_cache
+
+def close_tool_cache():
+    if _tool_cache is not None:
+        _tool_cache.close()
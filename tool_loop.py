@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认函数调用预算，可在 config/api.yaml 的 tool_loop 中覆盖
+DEFAULT_TOOL_LOOP_CONFIG = {
+    "max_rounds": 5,  # 一次回复中最多执行几轮函数调用
+    "max_seconds": 120,  # 一次回复（含所有轮次）的时间预算
+}
+
+def get_tool_loop_config(config) -> Dict:
+    loop_config = dict(DEFAULT_TOOL_LOOP_CONFIG)
+    loop_config.update(config.api.get("tool_loop") or {})
+    return loop_config
+
+class RoundStats:
+    """单轮模型请求 + 函数调用的耗时拆分"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.started_at = time.perf_counter()
+        self.first_byte_at: Optional[float] = None
+        self.response_done_at: Optional[float] = None
+        self.tools_done_at: Optional[float] = None
+        self.tools: List[str] = []
+        self.tool_ms: List[Optional[float]] = []  # 与 tools 一一对应
+
+    def first_byte(self):
+        if self.first_byte_at is None:
+            self.first_byte_at = time.perf_counter()
+
+    def response_done(self):
+        self.first_byte()
+        self.response_done_at = time.perf_counter()
+
+    def tools_done(self):
+        self.tools_done_at = time.perf_counter()
+
+    def _ms(self, start: Optional[float], end: Optional[float]) -> Optional[float]:
+        if start is None or end is None:
+            return None
+        return round((end - start) * 1000, 1)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "round": self.index,
+            "first_byte_ms": self._ms(self.started_at, self.first_byte_at),
+            "response_ms": self._ms(self.started_at, self.response_done_at),
+            # 响应结束后还需等待函数调用完成的时间，提前执行时通常小于函数本身耗时
+            "tool_wait_ms": self._ms(self.response_done_at, self.tools_done_at),
+            "tools": self.tools,
+            "tool_ms": self.tool_ms,
+        }
+
+class ToolLoop:
+    """
+    一次回复中的函数调用循环：记录每轮耗时，并在轮数或时间预算耗尽时
+    通知调用方禁用函数调用，让模型直接给出回答。
+    """
+
+    def __init__(self, client_id: Optional[str], max_rounds: int, max_seconds: float):
+        self.client_id = client_id
+        self.max_rounds = max_rounds
+        self.max_seconds = max_seconds
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+        self.rounds: List[RoundStats] = []
+        if client_id is not None:
+            tool_loop_stats[client_id] = self
+
+    @classmethod
+    def from_config(cls, config, client_id: Optional[str]) -> "ToolLoop":
+        return cls(client_id, **get_tool_loop_config(config))
+
+    def begin_round(self) -> RoundStats:
+        round_stats = RoundStats(len(self.rounds) + 1)
+        self.rounds.append(round_stats)
+        return round_stats
+
+    @property
+    def tool_rounds(self) -> int:
+        return sum(1 for round_stats in self.rounds if round_stats.tools)
+
+    def exhausted(self) -> bool:
+        """是否已用完函数调用预算，之后的请求应禁止函数调用"""
+        elapsed = time.perf_counter() - self.started_at
+        return self.tool_rounds >= self.max_rounds or elapsed >= self.max_seconds
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        if self.tool_rounds:
+            logger.info(f"客户端 {self.client_id}: 函数调用循环结束 {self.to_dict()}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            # 结束后固定为整个循环的耗时，供 /运行状态 查看
+            "total_ms": round(((self.finished_at or time.perf_counter()) - self.started_at) * 1000, 1),
+            "tool_rounds": self.tool_rounds,
+            "max_rounds": self.max_rounds,
+            "max_seconds": self.max_seconds,
+            "rounds": [round_stats.to_dict() for round_stats in self.rounds],
+        }
+
+# 每个客户端最近一次回复的函数调用统计，通过 /运行状态 查看，客户端断开时移除
+tool_loop_stats: Dict[str, ToolLoop] = {}
+
+class ToolExecutor:
+    """
+    在流式响应到达过程中提前启动函数调用：每解析出一个完整的调用就立即创建任务，
+    响应结束后按调用顺序收集结果。
+    """
+
+    def __init__(self, run: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]], round_stats: RoundStats):
+        self._run = run
+        self.round_stats = round_stats
+        self.calls: List[Dict[str, Any]] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, function_call: Dict[str, Any]):
+        self.calls.append(function_call)
+        self.round_stats.tools.append(function_call.get("name"))
+        self.round_stats.tool_ms.append(None)
+        index = len(self._tasks)
+        self._tasks.append(asyncio.ensure_future(self._timed(index, function_call)))
+
+    async def _timed(self, index: int, function_call: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            return await self._run(function_call)
+        finally:
+            self.round_stats.tool_ms[index] = round((time.perf_counter() - started) * 1000, 1)
+
+    def __bool__(self) -> bool:
+        return bool(self._tasks)
+
+    async def results(self) -> List[Dict[str, Any]]:
+        try:
+            return list(await asyncio.gather(*self._tasks))
+        except asyncio.CancelledError:
+            # 本轮回复被取消：等函数调用收尾（如终止命令的进程树）后再继续传播
+            await self.cancel()
+            raise
+        finally:
+            self.round_stats.tools_done()
+
+    async def cancel(self):
+        """取消尚未完成的函数调用并等待它们结束"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
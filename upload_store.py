@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from typing import AsyncIterator, Dict, Optional, Tuple
+from media_upload import UploadError
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认附件上传配置，可在 config/api.yaml 的 client_upload 中覆盖
+DEFAULT_CLIENT_UPLOAD_CONFIG = {
+    "dir": "data/uploads",
+    "max_bytes": 2 * 1024 * 1024 * 1024,  # 单个附件上限
+    "ttl": 6 * 3600,  # 上传后多久删除临时文件（秒）
+    "write_buffer": 1024 * 1024,  # 攒够该字节数再在线程中写入磁盘
+    "user_quota_bytes": 4 * 1024 * 1024 * 1024,  # 每个用户未过期附件的总字节数上限
+    "total_quota_bytes": 20 * 1024 * 1024 * 1024,  # 所有用户未过期附件的总字节数上限
+    "sweep_interval": 60,  # 定期删除过期附件的间隔（秒）
+}
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+def _private(path: str, flags: int) -> int:
+    """open() 的 opener：附件只允许运行服务的用户读写"""
+    return os.open(path, flags, 0o600)
+
+def get_client_upload_config(config) -> Dict:
+    upload_config = dict(DEFAULT_CLIENT_UPLOAD_CONFIG)
+    upload_config.update(config.api.get("client_upload") or {})
+    return upload_config
+
+class UploadStore:
+    """
+    浏览器附件的临时存储：请求体按块写入 <id>.bin，元数据写入 <id>.json，
+    聊天消息只携带 upload_id，构造提示时按路径读取（mmap），不经过 base64。
+
+    元数据放在磁盘上，多个 worker 进程共享同一目录时都能解析 upload_id。
+    upload_id 是附件的私有句柄：目录不经 HTTP 提供，文件只允许运行服务的用户读写。
+
+    每个用户和全部用户的未过期附件各有总字节数上限（超出时返回 413）。已完成的附件按磁盘上的
+    元数据统计（每次清理时重新统计，包括其他 worker 写入的），正在上传的按本进程已收到的字节数计入。
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float, write_buffer: int,
+                 user_quota_bytes: int = 0, total_quota_bytes: int = 0, sweep_interval: float = 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.write_buffer = write_buffer
+        self.user_quota_bytes = user_quota_bytes
+        self.total_quota_bytes = total_quota_bytes
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._stored: Dict[str, int] = {}  # user_id -> 磁盘上未过期附件的字节数
+        self._receiving: Dict[str, int] = {}  # user_id -> 本进程正在接收的字节数
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config) -> "UploadStore":
+        upload_config = get_client_upload_config(config)
+        directory = upload_config.pop("dir")
+        return cls(directory, **upload_config)
+
+    def usage(self, user_id: str) -> int:
+        return self._stored.get(user_id, 0) + self._receiving.get(user_id, 0)
+
+    @property
+    def total_usage(self) -> int:
+        return sum(self._stored.values()) + sum(self._receiving.values())
+
+    def _check_quota(self, user_id: str, incoming: int):
+        """再接收 incoming 字节会超出用户或全局配额时抛出 413"""
+        if self.user_quota_bytes and self.usage(user_id) + incoming > self.user_quota_bytes:
+            raise UploadError(413, f"附件总量超出配额 {self.user_quota_bytes} 字节，请稍后再试或使用较小的文件")
+        if self.total_quota_bytes and self.total_usage + incoming > self.total_quota_bytes:
+            raise UploadError(413, "服务器附件存储空间已满，请稍后再试")
+
+    def _paths(self, upload_id: str):
+        base = os.path.join(self.directory, upload_id)
+        return base + ".bin", base + ".json"
+
+    async def save(self, chunks: AsyncIterator[bytes], filename: str, mime_type: str, user_id: str,
+                   expected_size: Optional[int] = None) -> Dict:
+        """把异步字节流写入临时文件，超过 max_bytes 或配额时中止并删除，返回元数据"""
+        if expected_size is not None and expected_size > self.max_bytes:
+            raise UploadError(413, f"文件过大: {expected_size} 字节，上限 {self.max_bytes} 字节")
+        await self.sweep()
+        self._check_quota(user_id, expected_size or 0)
+        upload_id = uuid.uuid4().hex
+        data_path, meta_path = self._paths(upload_id)
+        started = time.perf_counter()
+        size = 0
+        buffer = bytearray()
+        f = await asyncio.to_thread(open, data_path, "wb", opener=_private)
+        try:
+            async for chunk in chunks:
+                if size + len(chunk) > self.max_bytes:
+                    raise UploadError(413, f"文件过大，上限 {self.max_bytes} 字节")
+                self._check_quota(user_id, len(chunk))
+                size += len(chunk)
+                self._receiving[user_id] = self._receiving.get(user_id, 0) + len(chunk)
+                buffer += chunk
+                if len(buffer) >= self.write_buffer:
+                    data = bytes(buffer)
+                    buffer.clear()
+                    await asyncio.to_thread(f.write, data)
+            if buffer:
+                await asyncio.to_thread(f.write, bytes(buffer))
+            await asyncio.to_thread(f.close)
+            if expected_size is not None and size != expected_size:
+                raise UploadError(400, f"上传不完整: 收到 {size} / {expected_size} 字节")
+            meta = {"upload_id": upload_id, "filename": filename, "mime_type": mime_type, "size": size,
+                    "user_id": user_id, "expires_at": time.time() + self.ttl}
+            await asyncio.to_thread(self._write_meta, meta_path, meta)
+        except BaseException:
+            # 客户端断开、超出上限或取消时不留下残缺文件
+            await asyncio.to_thread(f.close)
+            await asyncio.to_thread(self._remove, upload_id)
+            raise
+        finally:
+            self._release(user_id, size)
+        self._stored[user_id] = self._stored.get(user_id, 0) + size
+        elapsed = time.perf_counter() - started
+        logger.info(f"附件已接收: {filename} ({size / 1024 / 1024:.1f} MiB, {elapsed:.2f}s) -> {upload_id}")
+        return meta
+
+    def _release(self, user_id: str, size: int):
+        remaining = self._receiving.get(user_id, 0) - size
+        if remaining > 0:
+            self._receiving[user_id] = remaining
+        else:
+            self._receiving.pop(user_id, None)
+
+    def _write_meta(self, meta_path: str, meta: Dict):
+        with open(meta_path, "w", encoding="utf-8", opener=_private) as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    def resolve(self, upload_id: str) -> Dict:
+        """返回元数据和文件路径，upload_id 无效或已过期时抛出 UploadError"""
+        if not isinstance(upload_id, str) or not _UPLOAD_ID.match(upload_id):
+            raise UploadError(400, "无效的 upload_id")
+        data_path, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise UploadError(404, "附件不存在或已过期，请重新上传")
+        if meta.get("expires_at", 0) <= time.time() or not os.path.exists(data_path):
+            raise UploadError(404, "附件不存在或已过期，请重新上传")
+        meta["path"] = data_path
+        return meta
+
+    def _remove(self, upload_id: str):
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _sweep(self, now: float) -> Tuple[int, Dict[str, int]]:
+        """删除过期的附件，返回删除的个数和各用户剩余附件的字节数"""
+        removed = 0
+        stored: Dict[str, int] = {}
+        for name in os.listdir(self.directory):
+            upload_id, ext = os.path.splitext(name)
+            if not _UPLOAD_ID.match(upload_id):
+                continue
+            if ext == ".bin":
+                # 进程中途退出时留下的没有元数据的文件
+                try:
+                    expired = os.path.getmtime(os.path.join(self.directory, name)) + self.ttl <= now
+                except OSError:
+                    continue
+                if expired and not os.path.exists(self._paths(upload_id)[1]):
+                    self._remove(upload_id)
+                    removed += 1
+                continue
+            if ext != ".json":
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = {}
+            if meta.get("expires_at", 0) <= now:
+                self._remove(upload_id)
+                removed += 1
+            else:
+                user_id = meta.get("user_id", "")
+                stored[user_id] = stored.get(user_id, 0) + meta.get("size", 0)
+        return removed, stored
+
+    async def sweep(self, force: bool = False):
+        """删除过期的临时文件并重新统计配额用量，不带 force 时最多每 sweep_interval 秒执行一次"""
+        now = time.time()
+        if not force and now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        removed, self._stored = await asyncio.to_thread(self._sweep, now)
+        if removed:
+            logger.info(f"已删除 {removed} 个过期附件")
+
+    async def run_cleanup(self):
+        """定期清理，没有新的上传时过期附件同样会被删除；在应用启动时作为后台任务运行"""
+        while True:
+            try:
+                await self.sweep(force=True)
+            except OSError as e:
+                logger.error(f"清理过期附件失败: {str(e)}")
+            await asyncio.sleep(self.sweep_interval)
+
+_upload_store: Optional[UploadStore] = None
+
+def get_upload_store(config) -> UploadStore:
+    """全局附件存储，首次使用时按配置创建"""
+    global _upload_store
+    if _upload_store is None:
+        _upload_store = UploadStore.from_config(config)
+    return _upload_store
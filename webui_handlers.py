@@ -3,6 +3,13 @@ from typing import List, Dict, Any, Callable
 from multimodal_classes import *
 import asyncio
 from chara_read import use_folder_chara, get_folder_chara
+from log_utils import LazyText
+from media_cache import get_media_cache
+from tool_cache import get_tool_cache
+from executors import loop_lag
+from key_pool import get_llm_key_pool
+from connection_manager import get_connections
+from tool_loop import tool_loop_stats
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -47,7 +54,7 @@ def webui_main(config):
             file = event.plain.replace("/切人设", "")
             await send_message(event.client_id, [Text("正在更换人设...")])
             chara = (await use_folder_chara(file)).replace("{bot_name}", config.api["llm"]["bot_name"]).replace("{用户}", config.api["llm"]["user_name"])
-            print(chara)
+            logger.debug("新人设: %s", LazyText(chara))
             config.api["llm"]["system"] = chara
             config.save_yaml("api")
             await send_message(event.client_id, [Text(f"人设更换完成,已切换为{file}")])
@@ -56,4 +63,22 @@ def webui_main(config):
     async def get_chara(event: WebUIEvent, send_message: Callable):
         if "/查人设" in event.plain:
             charas = await get_folder_chara()
-            await send_message(event.client_id, [Text(charas)])
\ No newline at end of file
+            await send_message(event.client_id, [Text(charas)])
+
+    @webui
+    async def cache_stats(event: WebUIEvent, send_message: Callable):
+        if "/缓存统计" in event.plain:
+            tool_stats = get_tool_cache(config).stats()
+            media_stats = get_media_cache(config).stats()
+            await send_message(event.client_id, [Text(f"工具结果缓存: {tool_stats}\n媒体上传缓存: {media_stats}")])
+
+    @webui
+    async def loop_stats(event: WebUIEvent, send_message: Callable):
+        if "/运行状态" in event.plain:
+            key_stats = get_llm_key_pool(config).stats()
+            connection_stats = get_connections(config).stats()
+            tool_loop = tool_loop_stats.get(event.client_id)
+            tool_loop_text = tool_loop.to_dict() if tool_loop is not None else "无"
+            await send_message(event.client_id, [Text(f"事件循环延迟: {loop_lag.stats()}\nAPI key 用量: {key_stats}\n"
+                                                      f"连接: {connection_stats}\n"
+                                                      f"最近一次回复的函数调用: {tool_loop_text}")])